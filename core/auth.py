@@ -1,17 +1,18 @@
-from typing import Dict, List, Any, Optional
-import bisect
+from typing import Dict, List, Any, Optional, Tuple
+import heapq
 from time import time as time_builtin
 from functools import total_ordering
 from util.hash import gen_salt
 
 class AuthService:
-	__slots__ = ('_time', '_ordered', '_bytoken', '_idxbase')
+	__slots__ = ('_time', '_bytoken', '_expiry_heap', '_seq', '_count_by_purpose')
 	
 	_time: Any
-	# Ordered by TokenData.expiry
-	_ordered: List['TokenData']
-	_bytoken: Dict[str, int]
-	_idxbase: int
+	_bytoken: Dict[str, 'TokenData']
+	# (expiry, seq, TokenData); entries for popped tokens stay until they expire or the heap is compacted
+	_expiry_heap: List[Tuple[int, int, 'TokenData']]
+	_seq: int
+	_count_by_purpose: Dict[str, int]
 	
 	@classmethod
 	def GenTokenStr(cls, *, trim: int = 20) -> str:
@@ -21,57 +22,67 @@ class AuthService:
 		if time is None:
 			time = time_builtin
 		self._time = time
-		self._ordered = []
 		self._bytoken = {}
-		self._idxbase = 0
+		self._expiry_heap = []
+		self._seq = 0
+		self._count_by_purpose = {}
 	
 	def create_token(self, purpose: str, data: Any, *, token: Optional[str] = None, lifetime: int = 30) -> str:
-		self._remove_expired()
 		td = TokenData(purpose, data, self._time() + lifetime, token = AuthService.GenTokenStr() if token is None else token)
 		assert td.token not in self._bytoken
-		idx = bisect.bisect_left(self._ordered, td)
-		self._ordered.insert(idx, td)
-		self._bytoken[td.token] = idx + self._idxbase
+		self._bytoken[td.token] = td
+		self._seq += 1
+		heapq.heappush(self._expiry_heap, (td.expiry, self._seq, td))
+		self._count_by_purpose[purpose] = self._count_by_purpose.get(purpose, 0) + 1
 		return td.token
 	
 	def pop_token(self, purpose: str, token: str) -> Optional[Any]:
-		self._remove_expired()
-		idx = self._bytoken.pop(token, None)
-		if idx is None: return None
-		idx -= self._idxbase
-		td = self._ordered[idx]
+		td = self._bytoken.pop(token, None)
+		if td is None: return None
+		self._uncount(td)
 		if not td.validate(purpose, token, self._time()): return None
 		return td.data
 	
 	def get_token(self, purpose: str, token: str) -> Optional[Any]:
-		self._remove_expired()
-		idx = self._bytoken.get(token)
-		if idx is None: return None
-		idx -= self._idxbase
-		td = self._ordered[idx]
+		td = self._bytoken.get(token)
+		if td is None: return None
 		if not td.validate(purpose, token, self._time()): return None
 		return td.data
 	
 	def get_token_expiry(self, purpose: str, token: str) -> Optional[int]:
-		self._remove_expired()
-		idx = self._bytoken.get(token)
-		if idx is None: return None
-		idx -= self._idxbase
-		td = self._ordered[idx]
+		td = self._bytoken.get(token)
+		if td is None: return None
 		if not td.validate(purpose, token, self._time()): return None
 		return td.expiry
 	
-	def _remove_expired(self) -> None:
-		# TODO: This seems to remove perfectly good tokens (e.g., 1-day tokens; this causes errors when the MSN
-		# frontend tries to retreive the session ID for SOAP responses). Fix ASAP.
-		if not self._ordered: return
-		dummy = TokenData('', None, self._time(), '')
-		idx = bisect.bisect(self._ordered, dummy)
-		if idx < 1: return
-		self._idxbase += idx
-		for td in self._ordered[:idx]:
-			self._bytoken.pop(td.token, None)
-		self._ordered = self._ordered[idx:]
+	def counts_by_purpose(self) -> Dict[str, int]:
+		# Includes tokens that have expired but haven't been swept yet
+		return dict(self._count_by_purpose)
+	
+	def sweep(self) -> int:
+		# Drops expired tokens; expected to be called periodically (see `Backend._worker_sweep_tokens`).
+		# Lookups check expiry themselves, so this only bounds memory.
+		now = self._time()
+		heap = self._expiry_heap
+		removed = 0
+		while heap and heap[0][0] <= now:
+			_, _, td = heapq.heappop(heap)
+			if self._bytoken.get(td.token) is not td: continue
+			del self._bytoken[td.token]
+			self._uncount(td)
+			removed += 1
+		if len(heap) > 2 * len(self._bytoken) + 1024:
+			# Mostly entries for tokens that were popped early; rebuild without them
+			self._expiry_heap = [entry for entry in heap if self._bytoken.get(entry[2].token) is entry[2]]
+			heapq.heapify(self._expiry_heap)
+		return removed
+	
+	def _uncount(self, td: 'TokenData') -> None:
+		count = self._count_by_purpose.get(td.purpose, 0) - 1
+		if count > 0:
+			self._count_by_purpose[td.purpose] = count
+		else:
+			self._count_by_purpose.pop(td.purpose, None)
 
 @total_ordering
 class TokenData:
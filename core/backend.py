@@ -1,12 +1,16 @@
-from typing import Dict, List, Set, Any, Tuple, Optional, Callable, Sequence, FrozenSet, Iterable
+from typing import Dict, List, Set, Any, Tuple, Optional, Callable, Sequence, FrozenSet, Iterable, Collection
 from abc import ABCMeta, abstractmethod
-import asyncio, time, traceback
+import asyncio, traceback
+from datetime import datetime
 from collections import defaultdict
 from enum import IntFlag
 
 from util.misc import gen_uuid, last_in_iterable, EMPTY_SET, run_loop, Runner, server_temp_cleanup
+from util.cache import Cache
+from util.timer import TimerWheel
+from util import metrics
 
-from .user import UserService
+from .user import UserService, USER_CACHE_SIZE, CACHE_TTL, NEGATIVE_CACHE_TTL
 from .auth import AuthService
 from .stats import Stats
 from .client import Client
@@ -21,13 +25,15 @@ class Ack(IntFlag):
 
 class Backend:
 	__slots__ = (
-		'user_service', 'auth_service', 'loop', 'notify_maintenance', 'maintenance_mode', 'maintenance_mins',  '_stats', '_sc',
+		'user_service', 'auth_service', 'loop', 'timers', 'notify_maintenance', 'maintenance_mode', 'maintenance_mins',  '_stats', '_sc',
 		'_chats_by_id', '_cses_by_bs_by_groupchat_id', '_user_by_uuid', '_worklist_sync_db', '_worklist_sync_groupchats', '_worklist_notify', '_worklist_notify_self', '_runners', '_dev',
 	)
 	
 	user_service: UserService
 	auth_service: AuthService
 	loop: asyncio.AbstractEventLoop
+	# Shared by all connection timeouts and expiries
+	timers: TimerWheel
 	notify_maintenance: bool
 	maintenance_mode: bool
 	maintenance_mins: int
@@ -35,7 +41,7 @@ class Backend:
 	_sc: '_SessionCollection'
 	_chats_by_id: Dict[Tuple[str, str], 'Chat']
 	_cses_by_bs_by_groupchat_id: Dict[str, Dict['BackendSession', 'ChatSession']]
-	_user_by_uuid: Dict[str, User]
+	_user_by_uuid: Cache[str, User]
 	_worklist_sync_db: Dict[User, UserDetail]
 	_worklist_sync_groupchats: Dict[str, GroupChat]
 	_worklist_notify: Dict[str, Tuple['BackendSession', Optional[int], bool, Optional[Dict[str, Any]], bool, bool, bool]]
@@ -47,6 +53,7 @@ class Backend:
 		self.user_service = user_service or UserService()
 		self.auth_service = auth_service or AuthService()
 		self.loop = loop
+		self.timers = TimerWheel(loop)
 		self.notify_maintenance = False
 		self.maintenance_mode = False
 		self.maintenance_mins = 0
@@ -54,7 +61,7 @@ class Backend:
 		self._sc = _SessionCollection()
 		self._chats_by_id = {}
 		self._cses_by_bs_by_groupchat_id = {}
-		self._user_by_uuid = {}
+		self._user_by_uuid = Cache(maxsize = USER_CACHE_SIZE, ttl = CACHE_TTL, negative_ttl = NEGATIVE_CACHE_TTL, keep_identity = True)
 		self._worklist_sync_db = {}
 		self._worklist_sync_groupchats = {}
 		self._worklist_notify = {}
@@ -67,10 +74,12 @@ class Backend:
 		
 		loop.create_task(self._worker_sync_db())
 		loop.create_task(self._worker_sync_groupchats())
-		loop.create_task(self._worker_clean_sessions())
+		loop.create_task(self._worker_sweep_tokens())
+		loop.create_task(self._worker_compact_oims())
 		loop.create_task(self._worker_sync_stats())
 		loop.create_task(self._worker_notify())
 		loop.create_task(self._worker_notify_self())
+		loop.create_task(self._worker_loop_lag())
 	
 	def push_system_message(self, *args: Any, message: str = '', **kwargs: Any) -> None:
 		for bs in self._sc.iter_sessions():
@@ -105,11 +114,14 @@ class Backend:
 		self._stats.on_logout()
 		self._sc.remove_session(sess)
 		if not self._sc.get_sessions_by_user(user):
+			self._unpin_user(user)
 			# User is offline, send notifications
 			user.status.substatus = Substatus.Offline
 			self._sync_contact_statuses(user)
 			self._notify_contacts(sess, for_logout = True)
-		for cs_dict in self._cses_by_bs_by_groupchat_id.values():
+		for chat_id in list(self.user_service.get_groupchat_ids(user)):
+			cs_dict = self._cses_by_bs_by_groupchat_id.get(chat_id)
+			if cs_dict is None: continue
 			cs = cs_dict.get(sess)
 			if cs is not None:
 				cs.close()
@@ -126,7 +138,7 @@ class Backend:
 		bs_others = self._sc.get_sessions_by_user(user)
 		if only_once and bs_others:
 			return None
-		self.user_service.update_date_login(uuid)
+		self.loop.create_task(self.user_service.update_date_login_async(uuid))
 		
 		for bs_other in bs_others:
 			try:
@@ -141,17 +153,36 @@ class Backend:
 		bs.evt.bs = bs
 		self._stats.on_login()
 		self._stats.on_user_active(user, client)
-		self._sc.add_session(bs)
 		user.detail = self._load_detail(user)
+		self._sc.add_session(bs)
+		self._pin_user(user)
 		bs.evt.on_open()
 		return bs
 	
 	def _load_user_record(self, uuid: str) -> Optional[User]:
-		if uuid not in self._user_by_uuid:
-			user = self.user_service.get(uuid)
-			if user is None: return None
-			self._user_by_uuid[uuid] = user
-		return self._user_by_uuid[uuid]
+		return self._user_by_uuid.get_or_load(uuid, self.user_service.get)
+	
+	def _pin_user(self, user: User) -> None:
+		# `User` objects are compared by identity all over, so online users must never drop out of the caches
+		self._user_by_uuid.pin(user.uuid, user)
+		self.user_service.pin_user(user)
+	
+	def _unpin_user(self, user: User) -> None:
+		self._user_by_uuid.unpin(user.uuid)
+		self.user_service.unpin_user(user)
+	
+	async def preload_user(self, uuid: str) -> Optional[User]:
+		# Loads `uuid`'s record and contact list on the `UserService` executor,
+		# so the `login` that usually follows doesn't have to block the loop on it.
+		found, user = self._user_by_uuid.lookup(uuid)
+		if not found:
+			user = self._user_by_uuid.setdefault(uuid, await self.user_service.get_async(uuid))
+		if user is None: return None
+		if user.detail is None:
+			detail = await self.user_service.get_detail_async(uuid)
+			if user.detail is None:
+				user.detail = detail
+		return user
 	
 	def _load_detail(self, user: User) -> UserDetail:
 		if user.detail: return user.detail
@@ -188,11 +219,16 @@ class Backend:
 	def _sync_contact_statuses(self, user: User) -> None:
 		detail = user.detail
 		if detail is None: return
+		list_changed = False
 		for ctc in detail.contacts.values():
 			if ctc.lists & Lst.FL:
 				ctc.status.old_substatus = ctc.status.substatus
 				ctc.status.old_message = ctc.status.message
+				name = ctc.status.name
 				ctc.compute_visible_status(user)
+				if ctc.status.name != name:
+					ctc.touch()
+					list_changed = True
 			
 			# If the contact lists ever become inconsistent (FL without matching RL),
 			# the contact that's missing the RL will always see the other user as offline.
@@ -205,7 +241,14 @@ class Backend:
 			if ctc_rev is None: continue
 			ctc_rev.status.old_substatus = ctc_rev.status.substatus
 			ctc_rev.status.old_message = ctc_rev.status.message
+			name = ctc_rev.status.name
 			ctc_rev.compute_visible_status(ctc.head)
+			if ctc_rev.status.name != name:
+				# Contact names are part of the cached list too
+				ctc_rev.touch()
+				self._mark_modified(ctc.head, list_changed = True)
+		if list_changed:
+			self._mark_modified(user, list_changed = True)
 	
 	def _notify_contacts(self, bs: 'BackendSession', *, for_logout: bool = False, sess_id: Optional[int] = None, on_contact_add: bool = False, updated_phone_info: Optional[Dict[str, Any]] = None, update_status: bool = True, send_notif_to_self: bool = True) -> None:
 		uuid = bs.user.uuid
@@ -219,18 +262,46 @@ class Backend:
 			return
 		self._worklist_notify_self[uuid] = bs
 	
-	def _mark_modified(self, user: User, *, detail: Optional[UserDetail] = None) -> None:
+	def _mark_modified(self, user: User, *, detail: Optional[UserDetail] = None, list_changed: bool = False) -> None:
 		ud = user.detail or detail
 		if detail: assert ud is detail
 		assert ud is not None
+		if list_changed:
+			ud.bump_list_version()
 		self._worklist_sync_db[user] = ud
 	
+	def _bump_list_versions(self, users: List[User]) -> None:
+		# Loaded details are bumped in place; the rest get one UPDATE on the
+		# `UserService` executor, without loading or rewriting their contact lists.
+		offline = [] # type: List[User]
+		for user in users:
+			if user.detail is None:
+				offline.append(user)
+			else:
+				self._mark_modified(user, list_changed = True)
+		if offline:
+			self.loop.create_task(self._bump_offline_list_versions(offline))
+	
+	async def _bump_offline_list_versions(self, users: List[User]) -> None:
+		try:
+			await self.user_service.bump_list_versions_async([user.uuid for user in users])
+		except:
+			traceback.print_exc()
+			return
+		# Any that logged in meanwhile may have loaded their old version
+		for user in users:
+			if user.detail is not None:
+				self._mark_modified(user, list_changed = True)
+	
 	def _mark_groupchat_modified(self, groupchat: GroupChat) -> None:
 		self._worklist_sync_groupchats[groupchat.chat_id] = groupchat
 	
 	def util_get_uuid_from_email(self, email: str) -> Optional[str]:
 		return self.user_service.get_uuid(email)
 	
+	async def util_get_uuid_from_email_async(self, email: str) -> Optional[str]:
+		return await self.user_service.get_uuid_async(email)
+	
 	def util_set_sess_token(self, sess: 'BackendSession', token: str) -> None:
 		self._sc.set_nc_by_token(sess, token)
 	
@@ -251,9 +322,9 @@ class Backend:
 	async def _worker_sync_db(self) -> None:
 		while True:
 			await asyncio.sleep(1)
-			self._sync_db_impl()
+			await self._sync_db_impl()
 	
-	def _sync_db_impl(self) -> None:
+	async def _sync_db_impl(self) -> None:
 		if not self._worklist_sync_db: return
 		try:
 			users = list(self._worklist_sync_db.keys())[:100]
@@ -262,7 +333,7 @@ class Backend:
 				detail = self._worklist_sync_db.pop(user, None)
 				if detail is None: continue
 				batch.append((user, detail))
-			self.user_service.save_batch(batch)
+			await self.user_service.save_batch_async(batch)
 		except:
 			traceback.print_exc()
 	
@@ -284,30 +355,67 @@ class Backend:
 		except:
 			traceback.print_exc()
 	
-	async def _worker_clean_sessions(self) -> None:
+	async def _worker_sweep_tokens(self) -> None:
 		while True:
 			await asyncio.sleep(10)
-			now = time.time()
-			closed = []
-			
 			try:
-				for sess in self._sc.iter_sessions():
-					if sess.closed:
-						closed.append(sess)
+				self.auth_service.sweep()
+			except:
+				traceback.print_exc()
+	
+	async def _worker_compact_oims(self) -> None:
+		while True:
+			await asyncio.sleep(3600)
+			try:
+				await self.user_service.compact_oims_async()
 			except:
 				traceback.print_exc()
-			
-			for sess in closed:
-				self._sc.remove_session(sess)
 	
 	async def _worker_sync_stats(self) -> None:
 		while True:
 			await asyncio.sleep(60)
 			try:
-				self._stats.flush()
+				await self._stats.flush_async()
 			except:
 				traceback.print_exc()
 	
+	async def _worker_loop_lag(self) -> None:
+		child = metrics.loop_lag.labels()
+		while True:
+			start = self.loop.time()
+			await asyncio.sleep(1)
+			child.observe(max(0, self.loop.time() - start - 1))
+	
+	def register_metrics(self) -> None:
+		# Everything here is read at scrape time
+		metrics.registry.add_collector(self._collect_metrics)
+		metrics.add_caches(self._cache_stats)
+	
+	def _cache_stats(self) -> Dict[str, Dict[str, int]]:
+		return { 'backend_users': self._user_by_uuid.stats(), **self.user_service.cache_stats() }
+	
+	def _collect_metrics(self) -> Iterable[metrics.Family]:
+		yield metrics.gauge_family('escargot_backend_sessions', "Logged-in sessions, all frontends", {
+			(): len(self._sc._sessions),
+		})
+		yield metrics.gauge_family('escargot_chats', "Open chats", { (): len(self._chats_by_id) })
+		yield metrics.gauge_family('escargot_worklist_depth', "Items waiting in each backend worklist", {
+			('sync_db',): len(self._worklist_sync_db), ('sync_groupchats',): len(self._worklist_sync_groupchats),
+			('notify',): len(self._worklist_notify), ('notify_self',): len(self._worklist_notify_self),
+		}, ('worklist',))
+		yield metrics.stats_family('escargot_timers', "Backend timer wheel", { 'backend': self.timers.stats() }, 'wheel')
+		yield metrics.stats_family('escargot_password_verify', "Password verification queue and counts", {
+			'login': self.user_service.login_stats(),
+		}, 'kind')
+		yield metrics.gauge_family('escargot_auth_tokens', "Live auth tokens by purpose", {
+			(purpose,): count for purpose, count in self.auth_service.counts_by_purpose().items()
+		}, ('purpose',))
+		totals = self._stats.totals()
+		yield metrics.gauge_family('escargot_logged_in', "Logged-in users, as counted by `Stats`", { (): self._stats.logged_in })
+		yield metrics.gauge_family('escargot_messages_hour', "Messages this hour", {
+			('sent',): totals['messages_sent'], ('received',): totals['messages_received'],
+		}, ('direction',))
+	
 	async def _worker_notify(self) -> None:
 		# Notify relevant `BackendSession`s of status, name, message, media, etc. changes
 		worklist = self._worklist_notify
@@ -316,23 +424,19 @@ class Backend:
 			try:
 				for bs, sess_id, on_contact_add, updated_phone_info, update_status, send_notif_to_self, for_logout in worklist.values():
 					user = bs.user
-					detail = user.detail
-					assert detail is not None
-					for ctc in detail.contacts.values():
-						for bs_other in self._sc.get_sessions_by_user(ctc.head):
-							if bs_other.user is user and not send_notif_to_self: continue
-							detail_other = bs_other.user.detail
-							if detail_other is None: continue
-							ctc_me = detail_other.contacts.get(user.uuid)
-							# This shouldn't be `None`, since every contact should have
-							# an `RL` contact on the other users' list (at the very least).
-							if ctc_me is None: continue
-							if not ctc_me.lists & Lst.FL: continue
-							bs_other.evt.on_presence_notification(bs, ctc_me, on_contact_add, sess_id = sess_id, update_status = update_status, updated_phone_info = updated_phone_info)
-					for groupchat in self.user_service.get_groupchat_batch(user):
-						if groupchat.chat_id not in self._cses_by_bs_by_groupchat_id: continue
-						if bs not in self._cses_by_bs_by_groupchat_id[groupchat.chat_id]: continue
-						cs = self._cses_by_bs_by_groupchat_id[groupchat.chat_id][bs]
+					for bs_other in list(self._sc.get_watchers(user)):
+						if bs_other.user is user and not send_notif_to_self: continue
+						detail_other = bs_other.user.detail
+						if detail_other is None: continue
+						ctc_me = detail_other.contacts.get(user.uuid)
+						if ctc_me is None: continue
+						if not ctc_me.lists & Lst.FL: continue
+						bs_other.evt.on_presence_notification(bs, ctc_me, on_contact_add, sess_id = sess_id, update_status = update_status, updated_phone_info = updated_phone_info)
+					for chat_id in self.user_service.get_groupchat_ids(user):
+						cs_dict = self._cses_by_bs_by_groupchat_id.get(chat_id)
+						if cs_dict is None: continue
+						cs = cs_dict.get(bs)
+						if cs is None: continue
 						cs.chat.send_participant_presence(cs)
 					if for_logout:
 						if not self._sc.get_sessions_by_user(user): user.detail = None
@@ -389,11 +493,15 @@ class BackendSession(Session):
 		self.front_data = {}
 	
 	def _on_close(self, **kwargs: Any) -> None:
+		backend = self.backend
+		# In case anything registers the session again (e.g. a token) after it's gone
+		backend.timers.call_later(SESSION_REAP_DELAY, backend._sc.reap_session, self)
 		if not kwargs.get('passthrough'): self.evt.on_close()
-		self.backend.on_leave(self, sess_id = kwargs.get('sess_id'))
+		backend.on_leave(self, sess_id = kwargs.get('sess_id'))
 	
 	def me_update(self, fields: Dict[str, Any]) -> None:
 		user = self.user
+		user.presence_version += 1
 		
 		needs_notify = False
 		notify_status = False
@@ -473,7 +581,15 @@ class BackendSession(Session):
 		if 'mpop' in fields:
 			user.settings['MPOP'] = fields['mpop']
 		
-		self.backend._mark_modified(user)
+		# Everything a client keeps in its cached list (see `UserDetail.list_version`)
+		list_changed = any(field in fields for field in ('name', 'home_phone', 'work_phone', 'mobile_phone', 'blp', 'mob', 'mbe', 'gtc'))
+		self.backend._mark_modified(user, list_changed = list_changed)
+		if updated_phone_info:
+			# Contacts' lists carry this user's phone numbers, so all of their cached lists are stale,
+			# online or not; offline ones would otherwise be told at their next `SYN` that theirs is current.
+			detail = user.detail
+			assert detail is not None
+			self.backend._bump_list_versions([ctc.head for ctc in detail.contacts.values() if ctc.lists & (Lst.FL | Lst.RL)])
 		if needs_notify:
 			self.backend._sync_contact_statuses(user)
 			self.backend._notify_contacts(self, updated_phone_info = updated_phone_info, update_status = notify_status, send_notif_to_self = send_notif_to_self)
@@ -493,7 +609,7 @@ class BackendSession(Session):
 			name += str(len(groups))
 		group = Group(_gen_group_id(detail), gen_uuid(), name, False)
 		detail.insert_group(group)
-		self.backend._mark_modified(user)
+		self.backend._mark_modified(user, list_changed = True)
 		return group
 	
 	def me_group_remove(self, group_id: str) -> None:
@@ -506,9 +622,12 @@ class BackendSession(Session):
 		if group is None:
 			raise error.GroupDoesNotExist()
 		detail.delete_group(group)
+		detail.date_ab_removed = datetime.utcnow()
 		for ctc in detail.contacts.values():
-			ctc.remove_from_group(group)
-		self.backend._mark_modified(user)
+			if ctc.group_in_entry(group):
+				ctc.remove_from_group(group)
+				ctc.touch()
+		self.backend._mark_modified(user, list_changed = True)
 	
 	def me_group_edit(self, group_id: str, *, new_name: Optional[str] = None, is_favorite: Optional[bool] = None) -> None:
 		user = self.user
@@ -525,7 +644,8 @@ class BackendSession(Session):
 			g.name = new_name
 		if is_favorite is not None:
 			g.is_favorite = is_favorite
-		self.backend._mark_modified(user)
+		g.date_modified = datetime.utcnow()
+		self.backend._mark_modified(user, list_changed = True)
 	
 	def me_group_contact_add(self, group_id: str, contact_uuid: str) -> None:
 		if group_id == '0': return
@@ -541,7 +661,8 @@ class BackendSession(Session):
 		if ctc.group_in_entry(group):
 			raise error.ContactAlreadyOnList()
 		ctc.add_group_to_entry(group)
-		self.backend._mark_modified(user)
+		ctc.touch()
+		self.backend._mark_modified(user, list_changed = True)
 	
 	def me_group_contact_remove(self, group_id: str, contact_uuid: str) -> None:
 		user = self.user
@@ -555,7 +676,8 @@ class BackendSession(Session):
 			if group is None:
 				raise error.GroupDoesNotExist()
 			ctc.remove_from_group(group)
-			self.backend._mark_modified(user)
+			ctc.touch()
+			self.backend._mark_modified(user, list_changed = True)
 	
 	def me_contact_add(self, contact_uuid: str, lst: Lst, *, trid: Optional[str] = None, name: Optional[str] = None, nickname: Optional[str] = None, message: Optional[TextWithData] = None, group_id: Optional[str] = None, adder_id: Optional[str] = None, needs_notify: bool = False) -> Tuple[Contact, User]:
 		assert not lst & Lst.PL
@@ -602,7 +724,8 @@ class BackendSession(Session):
 			raise error.NicknameExceedsLengthLimit()
 		
 		ctc.status.name = new_name
-		self.backend._mark_modified(user)
+		ctc.touch()
+		self.backend._mark_modified(user, list_changed = True)
 	
 	def me_contact_remove(self, contact_uuid: str, lst: Lst, *, group_id: Optional[str] = None) -> None:
 		backend = self.backend
@@ -650,6 +773,7 @@ class BackendSession(Session):
 			contacts[ctc_head.uuid] = Contact(ctc_head, set(), Lst.Empty, UserStatus(name), ContactDetail(_gen_contact_id(detail)))
 			updated = True
 		ctc = contacts[ctc_head.uuid]
+		lists_before = ctc.lists
 		
 		if (ctc.lists & lst) != lst:
 			ctc.lists |= lst
@@ -676,8 +800,12 @@ class BackendSession(Session):
 				except Exception as ex:
 					raise ex
 		
+		if lst & Lst.FL:
+			self.backend._sc.add_watch(user, ctc_head)
+		
 		if updated:
-			self.backend._mark_modified(user, detail = detail)
+			ctc.touch(lists_before = lists_before)
+			self.backend._mark_modified(user, detail = detail, list_changed = True)
 			self.backend._sync_contact_statuses(user)
 		
 		return ctc
@@ -688,6 +816,7 @@ class BackendSession(Session):
 		contacts = detail.contacts
 		ctc = contacts.get(ctc_head.uuid)
 		if ctc is None: return
+		lists_before = ctc.lists
 		
 		updated = False
 		if ctc.lists & lst:
@@ -697,19 +826,25 @@ class BackendSession(Session):
 				except Exception as ex:
 					raise ex
 				updated = True
-				
+			
 			if (lst == Lst.FL and group_id is None) or not lst & Lst.FL:
 				ctc.lists &= ~lst
 				if lst == Lst.FL:
 					ctc._groups = set()
 				updated = True
 		
+		if not ctc.lists & Lst.FL:
+			self.backend._sc.remove_watch(user, ctc_head)
+		
 		if not ctc.lists:
 			del contacts[ctc_head.uuid]
+			detail.date_ab_removed = datetime.utcnow()
 			updated = True
+		elif updated:
+			ctc.touch(lists_before = lists_before)
 		
 		if updated:
-			self.backend._mark_modified(user, detail = detail)
+			self.backend._mark_modified(user, detail = detail, list_changed = True)
 			self.backend._sync_contact_statuses(user)
 	
 	def me_contact_notify_oim(self, uuid: str, oim: OIM) -> None:
@@ -741,6 +876,7 @@ class BackendSession(Session):
 			groupchat.chat_id, user_other,
 			GroupChatRole.Empty, GroupChatState.Empty,
 		)
+		self.backend.user_service.add_groupchat_member(groupchat.chat_id, user_other.uuid)
 		
 		self.backend._mark_groupchat_modified(groupchat)
 	
@@ -803,18 +939,23 @@ class BackendSession(Session):
 			sess_notify.evt.msn_on_uun_sent(self.user, type, data, pop_id_sender = pop_id_sender, pop_id = pop_id)
 
 class _SessionCollection:
-	__slots__ = ('_sessions', '_sessions_by_user', '_sess_by_token', '_tokens_by_sess')
+	__slots__ = ('_sessions', '_sessions_by_user', '_sess_by_token', '_tokens_by_sess', '_watchers_by_uuid', '_watching_by_sess')
 	
 	_sessions: Set[BackendSession]
 	_sessions_by_user: Dict[User, List[BackendSession]]
 	_sess_by_token: Dict[str, BackendSession]
 	_tokens_by_sess: Dict[BackendSession, Set[str]]
+	# Reverse-contact index: uuid of `X` -> online sessions that have `X` on their FL
+	_watchers_by_uuid: Dict[str, Set[BackendSession]]
+	_watching_by_sess: Dict[BackendSession, Set[str]]
 	
 	def __init__(self) -> None:
 		self._sessions = set()
 		self._sessions_by_user = defaultdict(list)
 		self._sess_by_token = {}
 		self._tokens_by_sess = defaultdict(set)
+		self._watchers_by_uuid = {}
+		self._watching_by_sess = {}
 	
 	def get_sessions_by_user(self, user: User) -> List[BackendSession]:
 		if user not in self._sessions_by_user:
@@ -832,9 +973,47 @@ class _SessionCollection:
 	def get_nc_by_token(self, token: str) -> Optional[BackendSession]:
 		return self._sess_by_token.get(token)
 	
+	def get_watchers(self, user: User) -> Iterable[BackendSession]:
+		return self._watchers_by_uuid.get(user.uuid) or EMPTY_SET
+	
+	def add_watch(self, user: User, ctc_head: User) -> None:
+		# `user` now has `ctc_head` on their FL
+		for sess in self.get_sessions_by_user(user):
+			self._watch(sess, ctc_head.uuid)
+	
+	def remove_watch(self, user: User, ctc_head: User) -> None:
+		# `user` no longer has `ctc_head` on their FL
+		for sess in self.get_sessions_by_user(user):
+			self._unwatch(sess, ctc_head.uuid)
+	
+	def _watch(self, sess: BackendSession, uuid: str) -> None:
+		if sess not in self._watching_by_sess: return
+		self._watching_by_sess[sess].add(uuid)
+		if uuid not in self._watchers_by_uuid:
+			self._watchers_by_uuid[uuid] = set()
+		self._watchers_by_uuid[uuid].add(sess)
+	
+	def _unwatch(self, sess: BackendSession, uuid: str) -> None:
+		watching = self._watching_by_sess.get(sess)
+		if watching is not None:
+			watching.discard(uuid)
+		watchers = self._watchers_by_uuid.get(uuid)
+		if watchers is None: return
+		watchers.discard(sess)
+		if not watchers:
+			del self._watchers_by_uuid[uuid]
+	
 	def add_session(self, sess: BackendSession) -> None:
 		if sess.user:
+			sess.user.presence_version += 1
 			self._sessions_by_user[sess.user].append(sess)
+			if sess not in self._watching_by_sess:
+				self._watching_by_sess[sess] = set()
+				detail = sess.user.detail
+				if detail is not None:
+					for ctc in detail.contacts.values():
+						if ctc.lists & Lst.FL:
+							self._watch(sess, ctc.head.uuid)
 		self._sessions.add(sess)
 	
 	def remove_session(self, sess: BackendSession) -> None:
@@ -843,17 +1022,31 @@ class _SessionCollection:
 			for token in tokens:
 				self._sess_by_token.pop(token, None)
 		self._sessions.discard(sess)
-		if sess.user in self._sessions_by_user:
-			self._sessions_by_user[sess.user].remove(sess)
+		sessions = self._sessions_by_user.get(sess.user)
+		if sessions is not None and sess in sessions:
+			sess.user.presence_version += 1
+			sessions.remove(sess)
+		for uuid in self._watching_by_sess.pop(sess, EMPTY_SET):
+			watchers = self._watchers_by_uuid.get(uuid)
+			if watchers is None: continue
+			watchers.discard(sess)
+			if not watchers:
+				del self._watchers_by_uuid[uuid]
+	
+	def reap_session(self, sess: BackendSession) -> None:
+		if sess in self._sessions or sess in self._tokens_by_sess:
+			self.remove_session(sess)
 
 class Chat:
-	__slots__ = ('ids', 'backend', 'groupchat', 'front_data', '_users_by_sess', '_stats')
+	__slots__ = ('ids', 'backend', 'groupchat', 'front_data', '_users_by_sess', '_roster_by_user', '_stats')
 	
 	ids: Dict[str, str]
 	backend: Backend
 	groupchat: Optional[GroupChat]
 	front_data: Dict[str, Any]
 	_users_by_sess: Dict['ChatSession', Tuple[User, Optional[str]]]
+	# Each user's PoPs in the chat, kept in step with `_users_by_sess` so per-user questions don't scan the roster
+	_roster_by_user: Dict[User, '_RosterEntry']
 	_stats: Any
 	
 	def __init__(self, backend: Backend, stats: Any, *, groupchat: Optional[GroupChat] = None) -> None:
@@ -863,6 +1056,7 @@ class Chat:
 		self.groupchat = groupchat
 		self.front_data = {}
 		self._users_by_sess = {}
+		self._roster_by_user = {}
 		self._stats = stats
 		
 		self.add_id('main', backend.auth_service.GenTokenStr(trim = 10))
@@ -877,77 +1071,69 @@ class Chat:
 		self.backend._chats_by_id[(scope, id)] = self
 	
 	def join(self, origin: str, bs: BackendSession, evt: event.ChatEventHandler, *, preferred_name: Optional[str] = None, pop_id: Optional[str] = None) -> 'ChatSession':
-		primary_pop = True
-		
 		if self.groupchat is not None:
 			if bs.user.uuid not in self.groupchat.memberships: raise error.NotAllowedToJoinGroupChat()
 		
-		for user_other, pop_id_other in self._users_by_sess.values():
-			if bs.user is user_other:
+		entry = self._roster_by_user.get(bs.user)
+		if entry is not None:
+			for cs_other in entry.sessions:
+				pop_id_other = self._users_by_sess[cs_other][1]
 				if pop_id_other is not None:
 					if (pop_id is not None and pop_id_other.lower() == pop_id.lower()): raise error.AuthFail()
 				else:
 					if pop_id is not None: raise error.AuthFail()
-		for other_cs in self.get_roster():
-			primary_pop = True
-			if other_cs.user is bs.user and other_cs.primary_pop:
-				primary_pop = False
+		primary_pop = (entry is None or entry.primary is None)
 		cs = ChatSession(origin, bs, self, evt, primary_pop, preferred_name = preferred_name)
 		cs.evt.cs = cs
-		self._users_by_sess[cs] = (cs.user, pop_id)
+		self.add_session(cs, pop_id)
 		cs.evt.on_open()
 		return cs
 	
 	def add_session(self, cs: 'ChatSession', pop_id: Optional[str] = None) -> None:
 		self._users_by_sess[cs] = (cs.user, pop_id)
-	
-	def get_roster(self) -> Iterable['ChatSession']:
+		entry = self._roster_by_user.get(cs.user)
+		if entry is None:
+			entry = _RosterEntry()
+			self._roster_by_user[cs.user] = entry
+		entry.sessions.append(cs)
+		if cs.primary_pop:
+			entry.primary = cs
+		if cs.joined:
+			entry.joined += 1
+	
+	def get_roster(self) -> Collection['ChatSession']:
 		return self._users_by_sess.keys()
 	
 	def get_roster_single(self) -> Iterable['ChatSession']:
-		sess_per_user = [] # type: List[ChatSession]
-		
-		for cs in self._users_by_sess.keys():
-			already_in_roster = False
-			for sess1 in sess_per_user:
-				if cs.primary_pop:
-					if sess1.user is cs.user:
-						already_in_roster = True
-					break
-			if not already_in_roster:
-				sess_per_user.append(cs)
-		
-		return sess_per_user
+		# One session per user, their primary PoP where they have one
+		return [entry.primary or entry.sessions[0] for entry in self._roster_by_user.values()]
+	
+	def get_user_sessions(self, user: User) -> Sequence['ChatSession']:
+		# `user`'s PoPs in this chat, in the order they joined
+		entry = self._roster_by_user.get(user)
+		if entry is None: return ()
+		return entry.sessions
+	
+	def is_user_joined(self, user: User) -> bool:
+		# Whether any of `user`'s PoPs has been through `send_participant_joined`
+		entry = self._roster_by_user.get(user)
+		return entry is not None and entry.joined > 0
 	
 	def send_participant_joined(self, cs: 'ChatSession') -> None:
-		tmp = []
+		if not cs.joined:
+			cs.joined = True
+			entry = self._roster_by_user.get(cs.user)
+			if entry is not None:
+				entry.joined += 1
 		
-		cs.joined = True
-		
-		for cs_self in self.get_roster():
-			if cs_self.user is cs.user and cs_self is not cs:
-				tmp.append(cs_self)
-		
-		if len(tmp) > 0:
-			first_pop = False
-		else:
-			first_pop = True
+		first_pop = self._is_only_pop(cs)
 		
 		for cs_other in self.get_roster():
 			if cs_other is cs and cs.origin is 'yahoo': continue
 			cs_other.evt.on_participant_joined(cs, first_pop)
 	
 	def send_participant_presence(self, cs: 'ChatSession', *, initial_presence: bool = False) -> None:
-		tmp = []
-		
-		for cs_self in self.get_roster():
-			if cs_self.user is cs.user and cs_self is not cs:
-				tmp.append(cs_self)
-		
-		if len(tmp) > 0:
-			first_pop = False
-		else:
-			first_pop = True
+		first_pop = self._is_only_pop(cs)
 		
 		if initial_presence:
 			for cs_other in self.get_roster():
@@ -962,21 +1148,24 @@ class Chat:
 		su = self._users_by_sess.pop(sess, None)
 		if su is None: return
 		last_pop = False
+		entry = self._roster_by_user[su[0]]
+		entry.sessions.remove(sess)
+		if sess.joined:
+			entry.joined -= 1
+		if entry.primary is sess:
+			entry.primary = None
+		if not entry.sessions:
+			del self._roster_by_user[su[0]]
 		# TODO: If it goes down to only 1 connected user,
 		# the chat and remaining session(s) should be automatically closed.
 		if not self._users_by_sess and not (keep_future or self.groupchat):
 			for scope_id in self.ids.items():
 				del self.backend._chats_by_id[scope_id]
 			return
-		sess_others = [sess_other for sess_other in self._users_by_sess.keys() if sess_other.user is su[0]]
-		if sess_others:
-			no_primary_pop = True
-			for sess_other in sess_others:
-				if sess_other.primary_pop:
-					no_primary_pop = False
-					break
-			if no_primary_pop:
-				sess_others[-1].primary_pop = True
+		if entry.sessions:
+			if entry.primary is None:
+				entry.primary = entry.sessions[-1]
+				entry.primary.primary_pop = True
 		else:
 			last_pop = True
 		# Notify others that `sess` has left
@@ -984,6 +1173,24 @@ class Chat:
 			for sess1, _ in self._users_by_sess.items():
 				if sess1 is sess: continue
 				sess1.evt.on_participant_left(sess, idle, last_pop)
+	
+	def _is_only_pop(self, cs: 'ChatSession') -> bool:
+		entry = self._roster_by_user.get(cs.user)
+		if entry is None: return True
+		return all(cs_self is cs for cs_self in entry.sessions)
+
+class _RosterEntry:
+	__slots__ = ('sessions', 'primary', 'joined')
+	
+	sessions: List['ChatSession']
+	primary: Optional['ChatSession']
+	# How many of `sessions` are `joined`
+	joined: int
+	
+	def __init__(self) -> None:
+		self.sessions = []
+		self.primary = None
+		self.joined = 0
 
 class ChatSession(Session):
 	__slots__ = ('origin', 'user', 'chat', 'bs', 'evt', 'primary_pop', 'joined', 'front_data', 'preferred_name')
@@ -1018,15 +1225,12 @@ class ChatSession(Session):
 		self.chat.on_leave(self, keep_future, idle, send_idle_leave)
 	
 	def invite(self, invitee: User, *, invite_msg: Optional[str] = None) -> None:
-		already_invited_sessions = [] # type: List[BackendSession]
+		already_invited_sessions = set() # type: Set[BackendSession]
 		
 		ctc_sessions = self.bs.backend.util_get_sessions_by_user(invitee)
-		roster = list(self.chat.get_roster())
-		for cs_other in roster:
-			if cs_other.bs in already_invited_sessions: continue
-			for ctc_sess in ctc_sessions:
-				if cs_other.bs is ctc_sess and self.origin is not 'yahoo':
-					already_invited_sessions.append(ctc_sess)
+		if self.origin != 'yahoo':
+			already_invited_sessions = { cs_other.bs for cs_other in self.chat.get_user_sessions(invitee) }
+			already_invited_sessions.intersection_update(ctc_sessions)
 		for ctc_sess in ctc_sessions:
 			if ctc_sess in already_invited_sessions: continue
 			ctc_sess.evt.on_chat_invite(self.chat, self.user, invite_msg = invite_msg or '')
@@ -1044,10 +1248,12 @@ class ChatSession(Session):
 		stats.on_message_sent(self.user, client)
 		stats.on_user_active(self.user, client)
 		
+		received = 0
 		for cs_other in self.chat._users_by_sess.keys():
 			if cs_other is self: continue
 			cs_other.evt.on_message(data)
-			stats.on_message_received(cs_other.user, client)
+			received += 1
+		stats.on_messages_received(client, received)
 	
 	def send_message_to_user(self, user_uuid: str, data: MessageData) -> None:
 		stats = self.chat._stats
@@ -1081,3 +1287,4 @@ def _gen_contact_id(detail: UserDetail) -> str:
 	return s
 
 MAX_GROUP_NAME_LENGTH = 61
+SESSION_REAP_DELAY = 10
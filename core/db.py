@@ -3,11 +3,12 @@ import json
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 import time
+import threading
 import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-from util import hash
+from util import hash, metrics
 from util.json_type import JSONType
 import settings
 
@@ -50,18 +51,22 @@ class User(WithFrontData):
 	date_created = Col(sa.DateTime, default = datetime.utcnow)
 	date_login = Col(sa.DateTime, nullable = True)
 	uuid = Col(sa.String, unique = True)
-	email = Col(sa.String)
+	email = Col(sa.String, index = True)
 	verified = Col(sa.Boolean)
 	name = Col(sa.String, nullable = True)
 	message = Col(sa.String)
 	password = Col(sa.String)
 	groups = Col(JSONType)
 	settings = Col(JSONType)
+	# See `UserDetail.list_version`
+	list_version = Col(sa.Integer, default = 0, server_default = '0', nullable = False)
+	# See `UserDetail.date_ab_removed`
+	date_ab_removed = Col(sa.DateTime, nullable = True)
 
 class UserContact(WithFrontData):
 	__tablename__ = 't_user_contact'
 	
-	user_id = Col(sa.Integer, sa.ForeignKey('t_user.id'), primary_key = True)
+	user_id = Col(sa.Integer, sa.ForeignKey('t_user.id'), primary_key = True, index = True)
 	contact_id = Col(sa.Integer, sa.ForeignKey('t_user.id'), primary_key = True)
 	user_uuid = Col(sa.String, sa.ForeignKey('t_user.uuid')) # = User(self.user_id).uuid
 	
@@ -71,6 +76,10 @@ class UserContact(WithFrontData):
 	lists = Col(sa.Integer)
 	groups = Col(JSONType)
 	is_messenger_user = Col(sa.Boolean)
+	# See `Contact.date_modified`, `Contact.date_lists_modified`, `Contact.date_roles_left`
+	date_modified = Col(sa.DateTime, nullable = True, default = datetime.utcnow)
+	date_lists_modified = Col(sa.DateTime, nullable = True, default = datetime.utcnow)
+	roles_left = Col(JSONType, nullable = True)
 	
 	# TODO: Fields from AddressBookContact
 	id = Col(sa.String) # TODO: For yahoo, like group_id; need Unique(user_id, contact_id); needs new name
@@ -138,6 +147,36 @@ def _simplify_json_data(data: Any) -> Any:
 		return [_simplify_json_data(x) for x in data]
 	return data
 
+class OIM(Base):
+	# Offline messages; just the metadata, so listing them is one indexed query
+	__tablename__ = 't_oim'
+	__table_args__ = (
+		sa.Index('ix_t_oim_recipient_uuid_sent', 'recipient_uuid', 'sent'),
+	)
+	
+	id = Col(sa.Integer, primary_key = True)
+	uuid = Col(sa.String, unique = True)
+	recipient_uuid = Col(sa.String)
+	run_id = Col(sa.String)
+	from_email = Col(sa.String)
+	from_friendly = Col(sa.String, nullable = True)
+	from_friendly_encoding = Col(sa.String, nullable = True)
+	from_friendly_charset = Col(sa.String, nullable = True)
+	from_user_id = Col(sa.String, nullable = True)
+	sent = Col(sa.DateTime)
+	origin_ip = Col(sa.String, nullable = True)
+	proxy = Col(sa.String, nullable = True)
+	headers = Col(JSONType, default = {})
+	utf8 = Col(sa.Boolean)
+	size = Col(sa.Integer)
+	is_read = Col(sa.Boolean, default = False)
+
+class OIMBody(Base):
+	__tablename__ = 't_oim_body'
+	
+	oim_id = Col(sa.Integer, sa.ForeignKey('t_oim.id'), primary_key = True)
+	message = Col(sa.Text)
+
 class Sound(Base):
 	__tablename__ = 't_sound'
 	
@@ -149,15 +188,20 @@ class Sound(Base):
 
 engine = sa.create_engine(settings.DB)
 session_factory = sessionmaker(bind = engine)
+metrics.time_queries(engine, 'main')
+
+# `UserService` also runs queries on its executor threads, so session nesting is tracked per-thread.
+_session_local = threading.local()
 
 @contextmanager
 def Session() -> Iterator[Any]:
-	if Session._depth > 0: # type: ignore
-		yield Session._global # type: ignore
+	depth = getattr(_session_local, 'depth', 0)
+	if depth > 0:
+		yield _session_local.session
 		return
 	session = session_factory()
-	Session._global = session # type: ignore
-	Session._depth += 1 # type: ignore
+	_session_local.session = session
+	_session_local.depth = depth + 1
 	try:
 		yield session
 		session.commit()
@@ -166,7 +210,5 @@ def Session() -> Iterator[Any]:
 		raise
 	finally:
 		session.close()
-		Session._global = None # type: ignore
-		Session._depth -= 1 # type: ignore
-Session._global = None # type: ignore
-Session._depth = 0 # type: ignore
+		_session_local.session = None
+		_session_local.depth = depth
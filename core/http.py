@@ -4,6 +4,7 @@ from aiohttp import web
 import jinja2
 
 from core.backend import Backend
+from util import metrics
 import settings
 
 def register(loop: asyncio.AbstractEventLoop, backend: Backend, *, devmode: bool = False) -> web.Application:
@@ -21,6 +22,10 @@ def register(loop: asyncio.AbstractEventLoop, backend: Backend, *, devmode: bool
 	
 	app = create_app(loop, backend)
 	backend.add_runner(AIOHTTPRunner(http_host, http_port, app, ssl_context = ssl_context))
+	
+	app.router.add_get('/metrics', handle_metrics)
+	backend.register_metrics()
+	
 	return app
 
 def create_app(loop: asyncio.AbstractEventLoop, backend: Backend) -> Any:
@@ -52,6 +57,9 @@ async def on_response_prepare(req: web.Request, res: web.StreamResponse) -> None
 	else:
 		print("body {}")
 
+async def handle_metrics(req: web.Request) -> web.Response:
+	return web.Response(status = 200, content_type = 'text/plain', charset = 'utf-8', text = metrics.registry.render())
+
 def render(req: web.Request, tmpl_name: str, ctxt: Optional[Dict[str, Any]] = None, status: int = 200) -> web.Response:
 	if tmpl_name.endswith('.xml'):
 		content_type = 'text/xml'
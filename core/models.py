@@ -4,7 +4,7 @@ from enum import Enum, IntEnum, IntFlag
 import time
 
 class User:
-	__slots__ = ('id', 'uuid', 'email', 'verified', 'status', 'detail', 'settings', 'date_created')
+	__slots__ = ('id', 'uuid', 'email', 'verified', 'status', 'detail', 'settings', 'date_created', 'presence_version', '__weakref__')
 	
 	id: int
 	uuid: str
@@ -14,6 +14,9 @@ class User:
 	detail: Optional['UserDetail']
 	settings: Dict[str, Any]
 	date_created: datetime
+	# Bumped whenever anything fronts render into presence notifications may have changed
+	# (status, session data, sessions coming and going); see `front.msn.misc.build_presence_notif`
+	presence_version: int
 	
 	def __init__(self, id: int, uuid: str, email: str, verified: bool, status: 'UserStatus', settings: Dict[str, Any], date_created: datetime) -> None:
 		self.id = id
@@ -25,9 +28,10 @@ class User:
 		self.detail = None
 		self.settings = settings
 		self.date_created = date_created
+		self.presence_version = 0
 
 class Contact:
-	__slots__ = ('head', '_groups', 'lists', 'status', 'is_messenger_user', 'detail')
+	__slots__ = ('head', '_groups', 'lists', 'status', 'is_messenger_user', 'detail', 'date_modified', 'date_lists_modified', 'date_roles_left')
 	
 	head: User
 	_groups: Set['ContactGroupEntry']
@@ -35,8 +39,13 @@ class Contact:
 	status: 'UserStatus'
 	is_messenger_user: bool
 	detail: 'ContactDetail'
+	# Last change to anything in the address book entry / to `lists`; for delta syncs
+	date_modified: datetime
+	date_lists_modified: datetime
+	# Last time the contact left each of `list_roles`; deltas only report those as deleted
+	date_roles_left: Dict[str, datetime]
 	
-	def __init__(self, user: User, groups: Set['ContactGroupEntry'], lists: 'Lst', status: 'UserStatus', detail: 'ContactDetail', *, is_messenger_user: Optional[bool] = None) -> None:
+	def __init__(self, user: User, groups: Set['ContactGroupEntry'], lists: 'Lst', status: 'UserStatus', detail: 'ContactDetail', *, is_messenger_user: Optional[bool] = None, date_modified: Optional[datetime] = None, date_lists_modified: Optional[datetime] = None, date_roles_left: Optional[Dict[str, datetime]] = None) -> None:
 		self.head = user
 		self._groups = groups
 		self.lists = lists
@@ -44,6 +53,23 @@ class Contact:
 		self.status = status
 		self.is_messenger_user = _default_if_none(is_messenger_user, True)
 		self.detail = detail
+		now = datetime.utcnow()
+		self.date_modified = date_modified or now
+		self.date_lists_modified = date_lists_modified or now
+		self.date_roles_left = date_roles_left or {}
+	
+	def touch(self, *, lists_before: Optional['Lst'] = None) -> None:
+		# `lists_before`: what `lists` was before a change to it
+		now = datetime.utcnow()
+		self.date_modified = now
+		if lists_before is not None:
+			self.date_lists_modified = now
+			for role in list_roles(lists_before) - list_roles(self.lists):
+				self.date_roles_left[role] = now
+	
+	def left_role_since(self, role: str, since: datetime) -> bool:
+		left = self.date_roles_left.get(role)
+		return left is not None and left >= since
 	
 	def compute_visible_status(self, to_user: User) -> None:
 		# Set Contact.status based on BLP and Contact.lists
@@ -206,16 +232,31 @@ class UserStatus:
 		return self.substatus.is_offlineish()
 
 class UserDetail:
-	__slots__ = ('_groups_by_id', '_groups_by_uuid', 'contacts')
+	__slots__ = ('_groups_by_id', '_groups_by_uuid', 'contacts', 'list_version', 'date_ab_removed')
 	
 	_groups_by_id: Dict[str, 'Group']
 	_groups_by_uuid: Dict[str, 'Group']
 	contacts: Dict[str, 'Contact']
+	# Persisted; changes whenever anything a client keeps in its cached contact list
+	# (contacts, lists, groups, names, phone numbers, list settings) changes.
+	# 0 means it has never been handed out.
+	list_version: int
+	# Persisted; last time a contact or group was dropped entirely. Delta syncs from
+	# before then can't be answered, since there's nothing left to report as deleted.
+	date_ab_removed: Optional[datetime]
 	
 	def __init__(self) -> None:
 		self._groups_by_id = {}
 		self._groups_by_uuid = {}
 		self.contacts = {}
+		self.list_version = 0
+		self.date_ab_removed = None
+	
+	def bump_list_version(self) -> int:
+		# Seeded from the clock, so versions handed out before a crash lost the
+		# latest bump can't be handed out again for a different list
+		self.list_version = max(self.list_version + 1, int(time.time()))
+		return self.list_version
 	
 	def insert_group(self, grp: 'Group') -> None:
 		self._groups_by_id[grp.id] = grp
@@ -247,18 +288,20 @@ class UserDetail:
 			del self._groups_by_uuid[grp.uuid]
 
 class Group:
-	__slots__ = ('id', 'uuid', 'name', 'is_favorite')
+	__slots__ = ('id', 'uuid', 'name', 'is_favorite', 'date_modified')
 	
 	id: str
 	uuid: str
 	name: str
 	is_favorite: bool
+	date_modified: datetime
 	
-	def __init__(self, id: str, uuid: str, name: str, is_favorite: bool) -> None:
+	def __init__(self, id: str, uuid: str, name: str, is_favorite: bool, *, date_modified: Optional[datetime] = None) -> None:
 		self.id = id
 		self.uuid = uuid
 		self.name = name
 		self.is_favorite = is_favorite
+		self.date_modified = date_modified or datetime.utcnow()
 
 class MessageType(Enum):
 	Chat = object()
@@ -274,7 +317,9 @@ class MessageData:
 	sender: User
 	type: MessageType
 	text: Optional[str]
-	front_cache: Dict[str, Any]
+	# Encodings by frontend, filled in by whichever recipient needs one first: the payload under
+	# the frontend's name (e.g. 'msnp'), whole frames under a tuple starting with it
+	front_cache: Dict[Any, Any]
 	
 	def __init__(self, *, sender: User, type: MessageType, text: Optional[str] = None) -> None:
 		self.sender = sender
@@ -293,7 +338,7 @@ class TextWithData:
 		self.yahoo_utf8 = yahoo_utf8
 
 class GroupChat:
-	__slots__ = ('chat_id', 'name', 'owner_id', 'owner_uuid', 'owner_friendly', 'membership_access', 'request_membership_option', 'memberships')
+	__slots__ = ('chat_id', 'name', 'owner_id', 'owner_uuid', 'owner_friendly', 'membership_access', 'request_membership_option', 'memberships', '__weakref__')
 	
 	chat_id: str
 	name: str
@@ -337,12 +382,12 @@ class GroupChatMembership:
 		self.invite_message = invite_message
 
 class OIM:
-	__slots__ = ('uuid', 'run_id', 'from_email', 'from_friendly', 'from_friendly_encoding', 'from_friendly_charset', 'from_user_id', 'to_email', 'sent', 'origin_ip', 'oim_proxy', 'headers', 'message', 'utf8')
+	__slots__ = ('uuid', 'run_id', 'from_email', 'from_friendly', 'from_friendly_encoding', 'from_friendly_charset', 'from_user_id', 'to_email', 'sent', 'origin_ip', 'oim_proxy', 'headers', 'message', 'utf8', 'size', 'is_read')
 	
 	uuid: str
 	run_id: str
 	from_email: str
-	from_friendly: str
+	from_friendly: Optional[str]
 	from_friendly_encoding: str
 	from_friendly_charset: str
 	from_user_id: Optional[str]
@@ -351,10 +396,14 @@ class OIM:
 	origin_ip: Optional[str]
 	oim_proxy: Optional[str]
 	headers: Dict[str, str]
-	message: str
+	# `None` when only the metadata was loaded (`UserService.get_oim_batch`)
+	message: Optional[str]
 	utf8: bool
+	# Length of `message` in UTF-8
+	size: int
+	is_read: bool
 	
-	def __init__(self, uuid: str, run_id: str, from_email: str, from_friendly: str, to_email: str, sent: datetime, message: str, utf8: bool, *, headers: Optional[Dict[str, str]] = None, from_friendly_encoding: Optional[str] = None, from_friendly_charset: Optional[str] = None, from_user_id: Optional[str] = None, origin_ip: Optional[str] = None, oim_proxy: Optional[str] = None) -> None:
+	def __init__(self, uuid: str, run_id: str, from_email: str, from_friendly: Optional[str], to_email: str, sent: datetime, message: Optional[str], utf8: bool, *, headers: Optional[Dict[str, str]] = None, from_friendly_encoding: Optional[str] = None, from_friendly_charset: Optional[str] = None, from_user_id: Optional[str] = None, origin_ip: Optional[str] = None, oim_proxy: Optional[str] = None, size: Optional[int] = None, is_read: bool = False) -> None:
 		self.uuid = uuid
 		self.run_id = run_id
 		self.from_email = from_email
@@ -369,6 +418,11 @@ class OIM:
 		self.headers = _default_if_none(headers, {})
 		self.message = message
 		self.utf8 = utf8
+		if size is None:
+			assert message is not None
+			size = len(message.encode('utf-8'))
+		self.size = size
+		self.is_read = is_read
 
 T = TypeVar('T')
 def _default_if_none(x: Optional[T], default: T) -> T:
@@ -427,6 +481,16 @@ class Lst(IntFlag):
 			setattr(cls, '_MAP', map)
 		return getattr(cls, '_MAP').get(label.lower())
 
+def list_roles(lists: Lst) -> Set[str]:
+	# Where `lists` puts a contact: 'Forward' for the address book, plus its membership roles
+	roles = set() # type: Set[str]
+	if lists & Lst.FL: roles.add('Forward')
+	if lists & Lst.AL: roles.add('Allow')
+	if lists & Lst.BL: roles.add('Block')
+	if lists & Lst.RL:
+		roles.add('Reverse' if lists & (Lst.AL | Lst.BL) else 'Pending')
+	return roles
+
 class NetworkID(IntEnum):
 	# Official MSN types
 	WINDOWS_LIVE = 0x01
@@ -1,6 +1,9 @@
-from typing import Dict, Any, Optional, Iterator
+from typing import Dict, Any, Optional, Iterator, List, Tuple, Callable, Deque
 from datetime import datetime
 from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio, base64, time, zlib
 import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
@@ -9,154 +12,289 @@ from HLL import HyperLogLog
 from core.client import Client
 from core.models import User
 from util.json_type import JSONType
+from util import metrics
 import settings
 
+class ClientStats:
+	__slots__ = ('messages_sent', 'messages_received', 'users_active')
+	
+	messages_sent: int
+	messages_received: int
+	users_active: HyperLogLog
+	
+	def __init__(self) -> None:
+		self.messages_sent = 0
+		self.messages_received = 0
+		self.users_active = HyperLogLog(HLL_PRECISION)
+
+class RecentStats:
+	__slots__ = ('start', 'logins', 'messages_sent', 'messages_received')
+	
+	start: float
+	logins: int
+	messages_sent: int
+	messages_received: int
+	
+	def __init__(self, start: float) -> None:
+		self.start = start
+		self.logins = 0
+		self.messages_sent = 0
+		self.messages_received = 0
+
 class Stats:
-	__slots__ = ('logged_in', 'by_client', '_client_id_cache')
+	# Everything is counted in memory on the event loop, keyed by `Client`; nothing
+	# touches the DB until `flush`, which registers new clients and writes all the
+	# hourly rows in one go. `recent` keeps a few per-`granularity` buckets for `/api/stats`.
+	__slots__ = ('logged_in', 'granularity', 'by_client', 'recent', '_hour', '_finished', '_client_ids', '_executor', '_time')
 	
 	logged_in: int
-	by_client: Dict[int, Dict[str, Any]]
-	_client_id_cache: Optional[Dict[Client, int]]
+	granularity: float
+	# For the current hour
+	by_client: Dict[Client, ClientStats]
+	recent: Deque[RecentStats]
+	_hour: int
+	# Hours that ended since the last flush
+	_finished: List[Tuple[int, Dict[Client, ClientStats]]]
+	# Only used by `_write`, off the event loop
+	_client_ids: Dict[Client, int]
+	_executor: ThreadPoolExecutor
+	_time: Callable[[], float]
 	
-	def __init__(self) -> None:
+	def __init__(self, *, granularity: float = 60, keep_recent: int = 60, time: Optional[Callable[[], float]] = None) -> None:
 		self.logged_in = 0
+		self.granularity = granularity
 		self.by_client = {}
-		self._client_id_cache = None
+		self._time = time or _time
+		self.recent = deque([RecentStats(self._bucket_start())], maxlen = keep_recent)
+		self._hour = self._current_hour()
+		self._finished = []
+		self._executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'stats')
 		
-		hour = _current_hour()
 		with Session() as sess:
+			self._client_ids = {
+				Client.FromJSON(row.data): row.id
+				for row in sess.query(DBClient).all()
+			}
 			current = sess.query(CurrentStats).filter(CurrentStats.key == 'current_hour').one_or_none()
 			if not current:
 				return
-			if current.value['hour'] != hour:
+			if current.value['hour'] != self._hour:
 				return
-			self.by_client = {
-				int(client_id): _stats_from_json(stats)
-				for client_id, stats in current.value['by_client'].items()
-			}
+			clients_by_id = { client_id: client for client, client_id in self._client_ids.items() }
+			for client_id, stats in current.value['by_client'].items():
+				client = clients_by_id.get(int(client_id))
+				if client is None: continue
+				self.by_client[client] = _stats_from_json(stats)
 	
 	def on_login(self) -> None:
 		self.logged_in += 1
+		self._bucket().logins += 1
 	
 	def on_logout(self) -> None:
 		self.logged_in -= 1
 	
 	def on_user_active(self, user: User, client: Client) -> None:
-		self._collect('users_active', user, client)
+		self._bucket()
+		self._get_client_stats(client).users_active.add(user.email)
 	
 	def on_message_sent(self, user: User, client: Client) -> None:
-		self._collect('messages_sent', user, client)
+		# Bucket first: it's what moves the counters on to a new hour
+		self._bucket().messages_sent += 1
+		self._get_client_stats(client).messages_sent += 1
 	
 	def on_message_received(self, user: User, client: Client) -> None:
-		self._collect('messages_received', user, client)
-	
-	def _collect(self, stat: str, user: User, client: Client) -> None:
-		assert user is not None
-		assert client is not None
-		if self.by_client is None:
-			self.by_client = {}
-		bc = self.by_client
-		client_id = self._get_client_id(client)
-		if client_id not in bc:
-			bc[client_id] = {}
-		bhc = bc[client_id]
-		if stat == 'users_active':
-			if stat not in bhc:
-				bhc[stat] = HyperLogLog(12)
-			bhc[stat].add(user.email)
-		else:
-			if stat not in bhc:
-				bhc[stat] = 0
-			bhc[stat] += 1
+		self.on_messages_received(client, 1)
+	
+	def on_messages_received(self, client: Client, count: int) -> None:
+		# A message delivered to `count` recipients
+		self._bucket().messages_received += count
+		self._get_client_stats(client).messages_received += count
+	
+	def totals(self) -> Dict[str, int]:
+		# For the current hour
+		return {
+			'messages_sent': sum(stats.messages_sent for stats in self.by_client.values()),
+			'messages_received': sum(stats.messages_received for stats in self.by_client.values()),
+		}
+	
+	def recent_rates(self) -> List[Dict[str, Any]]:
+		self._bucket()
+		return [{
+			'start': int(bucket.start), 'logins': bucket.logins,
+			'messages_sent': bucket.messages_sent, 'messages_received': bucket.messages_received,
+		} for bucket in self.recent]
 	
 	def flush(self) -> None:
-		hour = _current_hour()
-		now = datetime.utcnow()
-		
+		snapshot = self._snapshot()
+		try:
+			self._write(snapshot)
+		except:
+			self._restore(snapshot)
+			raise
+	
+	async def flush_async(self) -> None:
+		snapshot = self._snapshot()
+		try:
+			await asyncio.get_event_loop().run_in_executor(self._executor, self._write, snapshot)
+		except:
+			self._restore(snapshot)
+			raise
+	
+	def _get_client_stats(self, client: Client) -> ClientStats:
+		stats = self.by_client.get(client)
+		if stats is None:
+			stats = ClientStats()
+			self.by_client[client] = stats
+		return stats
+	
+	def _bucket(self) -> RecentStats:
+		bucket = self.recent[-1]
+		if self._time() < bucket.start + self.granularity:
+			return bucket
+		bucket = RecentStats(self._bucket_start())
+		self.recent.append(bucket)
+		self._check_hour()
+		return bucket
+	
+	def _check_hour(self) -> None:
+		hour = self._current_hour()
+		if hour == self._hour: return
+		self._finished.append((self._hour, self.by_client))
+		self.by_client = {}
+		self._hour = hour
+	
+	def _bucket_start(self) -> float:
+		return (self._time() // self.granularity) * self.granularity
+	
+	def _current_hour(self) -> int:
+		return int(self._time() // 3600)
+	
+	def _snapshot(self) -> '_Snapshot':
+		# Copies everything `_write` needs into plain data, so the write can happen off the event loop
+		self._check_hour()
+		hours = self._finished + [(self._hour, self.by_client)]
+		finished = self._finished
+		self._finished = []
+		return _Snapshot(datetime.utcnow(), self.logged_in, self._hour, [
+			(hour, [(client, _SnapshotRow(
+				stats.messages_sent, stats.messages_received, int(stats.users_active.cardinality()), _encode_hll(stats.users_active),
+			)) for client, stats in by_client.items()])
+			for hour, by_client in hours
+		], finished)
+	
+	def _restore(self, snapshot: '_Snapshot') -> None:
+		# The write failed: the finished hours go back in line for the next flush,
+		# ahead of any that ended in the meantime. The current hour never left `by_client`.
+		self._finished[:0] = snapshot.finished
+	
+	def _write(self, snapshot: '_Snapshot') -> None:
 		with Session() as sess:
-			current = sess.query(CurrentStats).filter(CurrentStats.key == 'logged_in').one_or_none()
-			if not current:
-				current = CurrentStats(key = 'logged_in')
-			current.date_updated = now
-			current.value = self.logged_in
-			sess.add(current)
-			sess.flush()
-			
-			current = sess.query(CurrentStats).filter(CurrentStats.key == 'current_hour').one_or_none()
-			if not current:
-				current = CurrentStats(key = 'current_hour', value = { 'hour': hour })
+			client_ids = self._register_clients(sess, [client for _, rows in snapshot.hours for client, _ in rows])
 			
-			cs_hour = current.value['hour']
-			current.date_updated = now
-			current.value = self._flush_to_hourly(sess, hour)
-			sess.add(current)
+			for hour, rows in snapshot.hours:
+				if not rows: continue
+				by_id = { client_ids[client]: row for client, row in rows }
+				existing = {
+					client_id for client_id, in sess.query(HourlyClientStats.client_id).filter(
+						HourlyClientStats.hour == hour, HourlyClientStats.client_id.in_(list(by_id)),
+					)
+				}
+				mappings = [{
+					'hour': hour, 'client_id': client_id,
+					'messages_sent': row.messages_sent, 'messages_received': row.messages_received, 'users_active': row.users_active,
+				} for client_id, row in by_id.items()]
+				sess.bulk_update_mappings(HourlyClientStats, [m for m in mappings if m['client_id'] in existing])
+				sess.bulk_insert_mappings(HourlyClientStats, [m for m in mappings if m['client_id'] not in existing])
 			
-			if cs_hour != hour:
-				self.by_client = {}
-	
-	def _flush_to_hourly(self, sess: Any, hour: int) -> Dict[str, Any]:
-		for client_id, stats in self.by_client.items():
-			hcs_opt = sess.query(HourlyClientStats).filter(HourlyClientStats.hour == hour, HourlyClientStats.client_id == client_id).one_or_none()
-			if hcs_opt is None:
-				hcs = HourlyClientStats(hour = hour, client_id = client_id)
-			else:
-				hcs = hcs_opt
-			hcs.messages_sent = stats.get('messages_sent') or 0
-			hcs.messages_received = stats.get('messages_received') or 0
-			if 'users_active' in stats:
-				hcs.users_active = stats['users_active'].cardinality()
-			else:
-				hcs.users_active = 0
-			sess.add(hcs)
-		return {
-			'hour': hour,
-			'by_client': {
-				client_id: _stats_to_json(stats)
-				for client_id, stats in self.by_client.items()
-			}
-		}
+			current_rows = snapshot.hours[-1][1]
+			_set_current(sess, 'logged_in', snapshot.logged_in, snapshot.now)
+			_set_current(sess, 'current_hour', {
+				'hour': snapshot.hour,
+				'by_client': {
+					client_ids[client]: _stats_to_json(row)
+					for client, row in current_rows
+				},
+			}, snapshot.now)
+		# Only once committed: ids from a rolled back flush would point at nothing
+		self._client_ids = client_ids
 	
-	def _get_client_id(self, client: Client) -> int:
-		if self._client_id_cache is None:
-			with Session() as sess:
-				self._client_id_cache = {
-					Client.FromJSON(row.data): row.id
-					for row in sess.query(DBClient).all()
-				}
-		if client not in self._client_id_cache:
-			with Session() as sess:
-				dbobj = DBClient(data = Client.ToJSON(client))
-				sess.add(dbobj)
-				sess.flush()
-				self._client_id_cache[client] = dbobj.id
-		return self._client_id_cache[client]
-
-def _stats_to_json(stats: Dict[str, Any]) -> Dict[str, Any]:
-	json = {}
-	if 'messages_sent' in stats:
-		json['messages_sent'] = stats['messages_sent']
-	if 'messages_received' in stats:
-		json['messages_received'] = stats['messages_received']
-	if 'users_active' in stats:
-		json['users_active'] = list(stats['users_active'].registers())
-	return json
-
-def _stats_from_json(json: Dict[str, Any]) -> Dict[str, Any]:
-	stats = {}
-	if 'messages_sent' in json:
-		stats['messages_sent'] = json['messages_sent']
-	if 'messages_received' in json:
-		stats['messages_received'] = json['messages_received']
+	def _register_clients(self, sess: Any, clients: List[Client]) -> Dict[Client, int]:
+		new = [DBClient(data = Client.ToJSON(client)) for client in set(clients) if client not in self._client_ids]
+		if not new: return self._client_ids
+		sess.add_all(new)
+		sess.flush()
+		client_ids = dict(self._client_ids)
+		for dbobj in new:
+			client_ids[Client.FromJSON(dbobj.data)] = dbobj.id
+		return client_ids
+
+class _SnapshotRow:
+	__slots__ = ('messages_sent', 'messages_received', 'users_active', 'users_active_hll')
+	
+	messages_sent: int
+	messages_received: int
+	users_active: int
+	users_active_hll: str
+	
+	def __init__(self, messages_sent: int, messages_received: int, users_active: int, users_active_hll: str) -> None:
+		self.messages_sent = messages_sent
+		self.messages_received = messages_received
+		self.users_active = users_active
+		self.users_active_hll = users_active_hll
+
+class _Snapshot:
+	__slots__ = ('now', 'logged_in', 'hour', 'hours', 'finished')
+	
+	now: datetime
+	logged_in: int
+	hour: int
+	# Current hour last
+	hours: List[Tuple[int, List[Tuple[Client, _SnapshotRow]]]]
+	# Taken out of `Stats._finished`, for `Stats._restore`
+	finished: List[Tuple[int, Dict[Client, ClientStats]]]
+	
+	def __init__(self, now: datetime, logged_in: int, hour: int, hours: List[Tuple[int, List[Tuple[Client, _SnapshotRow]]]], finished: List[Tuple[int, Dict[Client, ClientStats]]]) -> None:
+		self.now = now
+		self.logged_in = logged_in
+		self.hour = hour
+		self.hours = hours
+		self.finished = finished
+
+def _set_current(sess: Any, key: str, value: Any, now: datetime) -> None:
+	current = sess.query(CurrentStats).filter(CurrentStats.key == key).one_or_none()
+	if not current:
+		current = CurrentStats(key = key)
+	current.date_updated = now
+	current.value = value
+	sess.add(current)
+
+def _stats_to_json(row: _SnapshotRow) -> Dict[str, Any]:
+	return {
+		'messages_sent': row.messages_sent,
+		'messages_received': row.messages_received,
+		'users_active': row.users_active_hll,
+	}
+
+def _stats_from_json(json: Dict[str, Any]) -> ClientStats:
+	stats = ClientStats()
+	stats.messages_sent = json.get('messages_sent') or 0
+	stats.messages_received = json.get('messages_received') or 0
 	if 'users_active' in json:
-		hll = HyperLogLog(12)
-		hll.set_registers(bytearray(json['users_active']))
-		stats['users_active'] = hll
+		stats.users_active.set_registers(_decode_hll(json['users_active']))
 	return stats
 
-def _current_hour() -> int:
-	now = datetime.utcnow()
-	ts = now.timestamp()
-	return int(ts // 3600)
+def _encode_hll(hll: HyperLogLog) -> str:
+	# Mostly-empty registers compress to next to nothing
+	return base64.b64encode(zlib.compress(bytes(hll.registers()))).decode('ascii')
+
+def _decode_hll(data: Any) -> bytearray:
+	if isinstance(data, list):
+		# Written before registers were stored compressed
+		return bytearray(data)
+	return bytearray(zlib.decompress(base64.b64decode(data)))
+
+def _time() -> float:
+	return time.time()
 
 class Base(declarative_base()): # type: ignore
 	__abstract__ = True
@@ -185,6 +323,7 @@ class CurrentStats(Base):
 
 engine = sa.create_engine(settings.STATS_DB)
 session_factory = sessionmaker(bind = engine)
+metrics.time_queries(engine, 'stats')
 
 @contextmanager
 def Session() -> Iterator[Any]:
@@ -206,3 +345,5 @@ def Session() -> Iterator[Any]:
 		Session._depth -= 1 # type: ignore
 Session._global = None # type: ignore
 Session._depth = 0 # type: ignore
+
+HLL_PRECISION = 12
@@ -1,28 +1,133 @@
-from typing import Dict, Optional, List, Tuple, Set, Any, TYPE_CHECKING
-from datetime import datetime
+from typing import Dict, Optional, List, Tuple, Set, Any, Callable, TypeVar, TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta
 from urllib.parse import quote
-from dateutil import parser as iso_parser
-from pathlib import Path
-import asyncio, traceback
-import json
+import asyncio, time, traceback
+import hashlib, secrets
+import sqlalchemy as sa
 
 from util.hash import hasher, hasher_md5, hasher_md5crypt, gen_salt
+from util.cache import Cache
 from util import misc
 
 from . import error
-from .db import Session, User as DBUser, UserContact as DBUserContact, GroupChat as DBGroupChat
+from .db import Session, User as DBUser, UserContact as DBUserContact, GroupChat as DBGroupChat, OIM as DBOIM, OIMBody as DBOIMBody
 from .models import User, Contact, ContactDetail, ContactLocation, ContactGroupEntry, UserStatus, UserDetail, GroupChat, GroupChatMembership, GroupChatRole, GroupChatState, NetworkID, Lst, Group, OIM, MessageData
 
 if TYPE_CHECKING:
 	from .backend import BackendSession
 
+T = TypeVar('T')
+
 class UserService:
-	_cache_by_uuid: Dict[str, Optional[User]]
-	_groupchat_cache_by_chat_id: Dict[str, Optional[GroupChat]]
+	_cache_by_uuid: Cache[str, User]
+	_groupchat_cache_by_chat_id: Cache[str, GroupChat]
+	# uuid -> chat_ids of every group chat the user has a membership in (any role/state);
+	# built from the DB on first use and kept up to date by the backend afterwards
+	_groupchat_ids_by_uuid: Optional[Dict[str, Set[str]]]
+	_executor: ThreadPoolExecutor
+	_verify_executor: Optional[ProcessPoolExecutor]
+	_verify_semaphore: Optional[asyncio.Semaphore]
+	# (email, salted hash of password) -> (uuid, stored password hash) for recently verified logins
+	_verified_credentials: Cache[Tuple[str, bytes], Tuple[str, str]]
+	_credential_salt: bytes
+	verify_queued: int
+	verify_running: int
+	verify_count: int
+	verify_cache_hits: int
+	
+	def __init__(self, *, max_workers: int = 4) -> None:
+		# Everything else holds on to these objects and compares them by identity, so the caches keep identity
+		self._cache_by_uuid = Cache(maxsize = USER_CACHE_SIZE, ttl = CACHE_TTL, negative_ttl = NEGATIVE_CACHE_TTL, keep_identity = True)
+		self._groupchat_cache_by_chat_id = Cache(maxsize = GROUPCHAT_CACHE_SIZE, ttl = CACHE_TTL, negative_ttl = NEGATIVE_CACHE_TTL, keep_identity = True)
+		self._groupchat_ids_by_uuid = None
+		self._executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'user_service')
+		self._verify_executor = None
+		self._verify_semaphore = None
+		self._verified_credentials = Cache(maxsize = VERIFIED_CREDENTIAL_CACHE_SIZE, ttl = VERIFIED_CREDENTIAL_TTL)
+		self._credential_salt = secrets.token_bytes(16)
+		self.verify_queued = 0
+		self.verify_running = 0
+		self.verify_count = 0
+		self.verify_cache_hits = 0
+	
+	def _run(self, func: Callable[..., T], *args: Any) -> 'asyncio.Future[T]':
+		# Runs blocking DB work on the executor so it doesn't stall the event loop
+		return asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+	
+	async def login_async(self, email: str, pwd: str) -> Optional[str]:
+		tmp = await self._run(self._get_login_record, email)
+		if tmp is None: return None
+		uuid, encoded = tmp
+		
+		# Token refreshes (RST/RST2) re-send the same password over and over;
+		# skip re-deriving it as long as the stored hash hasn't changed since.
+		credential_key = (email, hashlib.sha256(self._credential_salt + pwd.encode()).digest())
+		found, verified = self._verified_credentials.lookup(credential_key)
+		if found and verified == (uuid, encoded):
+			self.verify_cache_hits += 1
+			return uuid
+		
+		if not await self._verify_password(pwd, encoded): return None
+		self._verified_credentials.set(credential_key, (uuid, encoded))
+		return uuid
 	
-	def __init__(self) -> None:
-		self._cache_by_uuid = {}
-		self._groupchat_cache_by_chat_id = {}
+	async def _verify_password(self, pwd: str, encoded: str) -> bool:
+		# PBKDF2 is pure CPU, so it runs on a process pool; the semaphore caps how many are in flight
+		if self._verify_executor is None:
+			self._verify_executor = ProcessPoolExecutor(max_workers = LOGIN_VERIFY_PROCESSES)
+		if self._verify_semaphore is None:
+			self._verify_semaphore = asyncio.Semaphore(LOGIN_VERIFY_CONCURRENCY)
+		
+		self.verify_queued += 1
+		try:
+			await self._verify_semaphore.acquire()
+		finally:
+			self.verify_queued -= 1
+		self.verify_running += 1
+		try:
+			return await asyncio.get_event_loop().run_in_executor(self._verify_executor, _verify_password, pwd, encoded)
+		finally:
+			self.verify_running -= 1
+			self.verify_count += 1
+			self._verify_semaphore.release()
+	
+	def cache_stats(self) -> Dict[str, Dict[str, int]]:
+		return {
+			'users': self._cache_by_uuid.stats(), 'groupchats': self._groupchat_cache_by_chat_id.stats(),
+			'verified_credentials': self._verified_credentials.stats(),
+		}
+	
+	def login_stats(self) -> Dict[str, int]:
+		return {
+			'queued': self.verify_queued, 'running': self.verify_running,
+			'verified': self.verify_count, 'cache_hits': self.verify_cache_hits,
+		}
+	
+	async def get_uuid_async(self, email: str) -> Optional[str]:
+		return await self._run(self.get_uuid, email)
+	
+	async def update_date_login_async(self, uuid: str) -> None:
+		await self._run(self.update_date_login, uuid)
+	
+	async def bump_list_versions_async(self, uuids: List[str]) -> None:
+		await self._run(self.bump_list_versions, uuids)
+	
+	async def get_async(self, uuid: str) -> Optional[User]:
+		found, user = self._cache_by_uuid.lookup(uuid)
+		if found: return user
+		user = await self._run(self._get_uncached, uuid)
+		return self._cache_by_uuid.setdefault(uuid, user)
+	
+	async def get_detail_async(self, uuid: str) -> Optional[UserDetail]:
+		tmp = await self._run(self._get_detail_uncached, uuid)
+		if tmp is None: return None
+		return self._merge_detail_heads(*tmp)
+	
+	async def save_batch_async(self, to_save: List[Tuple[User, UserDetail]]) -> None:
+		# Serialize on the loop (the models are only ever mutated there), write on the executor
+		rows = _serialize_batch(to_save)
+		await self._run(self._save_batch_rows, rows)
 	
 	def login(self, email: str, pwd: str) -> Optional[str]:
 		with Session() as sess:
@@ -31,6 +136,12 @@ class UserService:
 			if not hasher.verify(pwd, dbuser.password): return None
 			return dbuser.uuid
 	
+	def _get_login_record(self, email: str) -> Optional[Tuple[str, str]]:
+		with Session() as sess:
+			dbuser = sess.query(DBUser).filter(DBUser.email == email).one_or_none()
+			if dbuser is None: return None
+			return dbuser.uuid, dbuser.password
+	
 	def msn_login_md5(self, email: str, md5_hash: str) -> Optional[str]:
 		with Session() as sess:
 			dbuser = sess.query(DBUser).filter(DBUser.email == email).one_or_none()
@@ -64,6 +175,15 @@ class UserService:
 				'date_login': datetime.utcnow(),
 			})
 	
+	def bump_list_versions(self, uuids: List[str]) -> None:
+		# `UserDetail.bump_list_version` in one statement, for users whose details aren't loaded
+		if not uuids: return
+		now = int(time.time())
+		with Session() as sess:
+			sess.query(DBUser).filter(DBUser.uuid.in_(uuids)).update({
+				'list_version': sa.case([(DBUser.list_version + 1 > now, DBUser.list_version + 1)], else_ = now),
+			}, synchronize_session = False)
+	
 	def get_uuid(self, email: str) -> Optional[str]:
 		with Session() as sess:
 			dbuser = sess.query(DBUser).filter(DBUser.email == email).one_or_none()
@@ -71,30 +191,53 @@ class UserService:
 			return dbuser.uuid
 	
 	def get(self, uuid: str) -> Optional[User]:
-		if uuid not in self._cache_by_uuid:
-			self._cache_by_uuid[uuid] = self._get_uncached(uuid)
-		return self._cache_by_uuid[uuid]
+		return self._cache_by_uuid.get_or_load(uuid, self._get_uncached)
+	
+	def pin_user(self, user: User) -> None:
+		# Keeps `user` cached for as long as they have live sessions
+		self._cache_by_uuid.pin(user.uuid, user)
+	
+	def unpin_user(self, user: User) -> None:
+		self._cache_by_uuid.unpin(user.uuid)
+	
+	def invalidate_user(self, uuid: str) -> None:
+		self._cache_by_uuid.invalidate(uuid)
+	
+	def invalidate_groupchat(self, chat_id: str) -> None:
+		self._groupchat_cache_by_chat_id.invalidate(chat_id)
 	
 	def _get_uncached(self, uuid: str) -> Optional[User]:
 		with Session() as sess:
 			dbuser = sess.query(DBUser).filter(DBUser.uuid == uuid).one_or_none()
 			if dbuser is None: return None
-			status = UserStatus(dbuser.name, dbuser.message)
-			return User(dbuser.id, dbuser.uuid, dbuser.email, dbuser.verified, status, dbuser.settings, dbuser.date_created)
+			return _user_from_db(dbuser)
 	
 	def get_detail(self, uuid: str) -> Optional[UserDetail]:
+		tmp = self._get_detail_uncached(uuid)
+		if tmp is None: return None
+		return self._merge_detail_heads(*tmp)
+	
+	def _get_detail_uncached(self, uuid: str) -> Optional[Tuple[UserDetail, Dict[str, User]]]:
+		# Safe to call off the event loop: contact heads that aren't cached yet are
+		# loaded here and handed back for `_merge_detail_heads` to publish to the cache.
+		new_heads = {} # type: Dict[str, User]
 		with Session() as sess:
 			dbuser = sess.query(DBUser).filter(DBUser.uuid == uuid).one_or_none()
 			if dbuser is None: return None
 			detail = UserDetail()
+			detail.list_version = dbuser.list_version or 0
+			detail.date_ab_removed = dbuser.date_ab_removed
 			for g in dbuser.groups:
-				grp = Group(**g)
+				grp = Group(g['id'], g['uuid'], g['name'], g['is_favorite'], date_modified = _parse_date(g.get('date_modified')))
 				detail._groups_by_id[grp.id] = grp
 				detail._groups_by_uuid[grp.uuid] = grp
-			contacts = sess.query(DBUserContact).filter(DBUserContact.user_id == dbuser.id)
-			for c in contacts:
-				ctc_head = self.get(c.uuid)
-				if ctc_head is None: continue
+			# Contact heads come from the same query, so a cold cache doesn't cost a query per contact
+			contacts = sess.query(DBUserContact, DBUser).join(DBUser, DBUser.id == DBUserContact.contact_id).filter(DBUserContact.user_id == dbuser.id)
+			for c, dbuser_head in contacts:
+				ctc_head = self._cache_by_uuid.peek(c.uuid) or new_heads.get(c.uuid)
+				if ctc_head is None:
+					ctc_head = _user_from_db(dbuser_head)
+					new_heads[c.uuid] = ctc_head
 				status = UserStatus(c.name, c.message)
 				ctc_groups = { ContactGroupEntry(
 					ctc_head.uuid, group_entry['id'], group_entry['uuid'],
@@ -107,94 +250,81 @@ class UserService:
 				}
 				ctc = Contact(
 					ctc_head, ctc_groups, c.lists, status, c_detail, is_messenger_user = c.is_messenger_user,
+					date_modified = c.date_modified, date_lists_modified = c.date_lists_modified,
+					date_roles_left = _parse_dates(c.roles_left),
 				)
 				detail.contacts[ctc.head.uuid] = ctc
+		return detail, new_heads
+	
+	def _merge_detail_heads(self, detail: UserDetail, new_heads: Dict[str, User]) -> UserDetail:
+		for ctc in detail.contacts.values():
+			head = new_heads.get(ctc.head.uuid)
+			if head is None: continue
+			cached = self._cache_by_uuid.setdefault(head.uuid, head)
+			if cached is not None and cached is not head:
+				ctc.head = cached
 		return detail
 	
-	def get_oim_batch(self, user: User) -> List[OIM]:
-		tmp_oims = []
-		
-		path = _get_oim_path(user.uuid)
-		if path.exists():
-			for oim_path in path.iterdir():
-				if not oim_path.is_file(): continue
-				oim = self.get_oim_single(user, oim_path.name)
-				if oim is None: continue
-				tmp_oims.append(oim)
-		return tmp_oims
+	def get_oim_batch(self, user: User, *, with_messages: bool = False) -> List[OIM]:
+		# Metadata only unless `with_messages`; `get_oim_single` loads a message when it's asked for
+		with Session() as sess:
+			if with_messages:
+				rows = sess.query(DBOIM, DBOIMBody.message).join(DBOIMBody, DBOIMBody.oim_id == DBOIM.id)
+			else:
+				rows = sess.query(DBOIM, sa.literal(None))
+			rows = rows.filter(DBOIM.recipient_uuid == user.uuid).order_by(DBOIM.sent)
+			return [_oim_from_db(dboim, message, user.email) for dboim, message in rows]
 	
 	def get_oim_single(self, user: User, uuid: str, *, mark_read: bool = False) -> Optional[OIM]:
-		oim_path = _get_oim_path(user.uuid) / uuid
-		
-		if oim_path.is_file():
-			return None
-		
-		json_oim = json.loads(oim_path.read_text())
-		if not isinstance(json_oim, dict):
-			return None
-		
-		oim = OIM(
-			json_oim['uuid'], json_oim['run_id'], json_oim['from'], json_oim['from_friendly']['friendly_name'], user.email, iso_parser.parse(json_oim['sent']),
-			json_oim['message']['text'], json_oim['message']['utf8'],
-			headers = json_oim['headers'],
-			from_friendly_encoding = json_oim['from_friendly']['encoding'], from_friendly_charset = json_oim['from_friendly']['charset'], from_user_id = json_oim['from_user_id'],
-			origin_ip = json_oim['origin_ip'], oim_proxy = json_oim['proxy']
-		)
-		if mark_read:
-			json_oim['is_read'] = True
-			oim_path.write_text(json.dumps(json_oim))
-		
-		return oim
+		with Session() as sess:
+			row = sess.query(DBOIM, DBOIMBody.message).join(DBOIMBody, DBOIMBody.oim_id == DBOIM.id).filter(
+				DBOIM.recipient_uuid == user.uuid, DBOIM.uuid == uuid,
+			).one_or_none()
+			if row is None: return None
+			dboim, message = row
+			if mark_read and not dboim.is_read:
+				dboim.is_read = True
+			return _oim_from_db(dboim, message, user.email)
 	
 	def save_oim(self, bs: 'BackendSession', recipient_uuid: str, run_id: str, origin_ip: str, message: str, utf8: bool, *, from_friendly: Optional[str] = None, from_friendly_charset: str = 'utf-8', from_friendly_encoding: str = 'B', from_user_id: Optional[str] = None, headers: Dict[str, str] = {}, oim_proxy: Optional[str] = None) -> None:
 		assert bs is not None
 		user = bs.user
 		
-		path = _get_oim_path(recipient_uuid)
-		path.mkdir(parents = True, exist_ok = True)
-		oim_uuid = misc.gen_uuid().upper()
-		oim_path = path / oim_uuid
-		
-		if oim_path.is_file():
-			return
-		
-		oim_json = {} # type: Dict[str, Any]
-		oim_json['uuid'] = oim_uuid
-		oim_json['run_id'] = run_id
-		oim_json['from'] = user.email
-		oim_json['from_friendly'] = {
-			'friendly_name': from_friendly,
-			'encoding': (None if from_friendly is None else from_friendly_encoding),
-			'charset': (None if from_friendly is None else from_friendly_charset),
-		}
-		oim_json['from_user_id'] = from_user_id
-		oim_json['is_read'] = False
-		oim_json['sent'] = misc.date_format(datetime.utcnow())
-		oim_json['origin_ip'] = origin_ip
-		oim_json['proxy'] = oim_proxy
-		oim_json['headers'] = headers
-		oim_json['message'] = {
-			'text': message,
-			'utf8': utf8,
-		}
-		
-		oim_path.write_text(json.dumps(oim_json))
-		
 		oim = OIM(
-			oim_json['uuid'], oim_json['run_id'], oim_json['from'], oim_json['from_friendly']['friendly_name'], user.email, iso_parser.parse(oim_json['sent']),
-			oim_json['message']['text'], oim_json['message']['utf8'],
-			headers = oim_json['headers'],
-			from_friendly_encoding = oim_json['from_friendly']['encoding'], from_friendly_charset = oim_json['from_friendly']['charset'], from_user_id = oim_json['from_user_id'],
-			origin_ip = oim_json['origin_ip'], oim_proxy = oim_json['proxy']
+			misc.gen_uuid().upper(), run_id, user.email, from_friendly, user.email, datetime.utcnow().replace(microsecond = 0),
+			message, utf8,
+			headers = headers,
+			from_friendly_encoding = (None if from_friendly is None else from_friendly_encoding), from_friendly_charset = (None if from_friendly is None else from_friendly_charset), from_user_id = from_user_id,
+			origin_ip = origin_ip, oim_proxy = oim_proxy,
 		)
+		_insert_oim(recipient_uuid, oim)
 		
 		bs.me_contact_notify_oim(recipient_uuid, oim)
 	
 	def delete_oim(self, recipient_uuid: str, uuid: str) -> None:
-		oim_path = _get_oim_path(recipient_uuid) / uuid
-		if not oim_path.is_file():
-			return
-		oim_path.unlink()
+		with Session() as sess:
+			oim_id = sess.query(DBOIM.id).filter(DBOIM.recipient_uuid == recipient_uuid, DBOIM.uuid == uuid).scalar()
+			if oim_id is None: return
+			sess.query(DBOIMBody).filter(DBOIMBody.oim_id == oim_id).delete(synchronize_session = False)
+			sess.query(DBOIM).filter(DBOIM.id == oim_id).delete(synchronize_session = False)
+	
+	async def compact_oims_async(self) -> int:
+		return await self._run(self.compact_oims, datetime.utcnow())
+	
+	def compact_oims(self, now: datetime) -> int:
+		# Drops messages past `OIM_MAX_AGE`, and the oldest ones of anyone over `OIM_MAX_PER_USER`
+		with Session() as sess:
+			expired = [oim_id for oim_id, in sess.query(DBOIM.id).filter(DBOIM.sent < now - OIM_MAX_AGE)]
+			over_quota = sess.query(DBOIM.recipient_uuid).group_by(DBOIM.recipient_uuid).having(sa.func.count(DBOIM.id) > OIM_MAX_PER_USER)
+			for recipient_uuid, in over_quota.all():
+				expired.extend(oim_id for oim_id, in sess.query(DBOIM.id).filter(
+					DBOIM.recipient_uuid == recipient_uuid,
+				).order_by(DBOIM.sent.desc()).offset(OIM_MAX_PER_USER))
+			for i in range(0, len(expired), OIM_DELETE_BATCH_SIZE):
+				batch = expired[i:i + OIM_DELETE_BATCH_SIZE]
+				sess.query(DBOIMBody).filter(DBOIMBody.oim_id.in_(batch)).delete(synchronize_session = False)
+				sess.query(DBOIM).filter(DBOIM.id.in_(batch)).delete(synchronize_session = False)
+			return len(expired)
 	
 	def create_groupchat(self, user: User, name: str, owner_friendly: str, membership_access: int) -> str:
 		with Session() as sess:
@@ -209,12 +339,12 @@ class UserService:
 			
 			sess.add(dbgroupchat)
 		
+		self.invalidate_groupchat(chat_id)
+		self.add_groupchat_member(chat_id, user.uuid)
 		return chat_id
 	
 	def get_groupchat(self, chat_id: str) -> Optional[GroupChat]:
-		if chat_id not in self._groupchat_cache_by_chat_id:
-			self._groupchat_cache_by_chat_id[chat_id] = self._get_groupchat_uncached(chat_id)
-		return self._groupchat_cache_by_chat_id[chat_id]
+		return self._groupchat_cache_by_chat_id.get_or_load(chat_id, self._get_groupchat_uncached)
 	
 	def _get_groupchat_uncached(self, chat_id: str) -> Optional[GroupChat]:
 		with Session() as sess:
@@ -255,24 +385,38 @@ class UserService:
 	def get_groupchat_batch(self, user: User) -> List[GroupChat]:
 		groupchats = []
 		
-		with Session() as sess:
-			dbgroupchats = sess.query(DBGroupChat)
+		for chat_id in self.get_groupchat_ids(user):
+			groupchat = self.get_groupchat(chat_id)
+			if groupchat is None: continue
+			if user.uuid not in groupchat.memberships: continue
 			
-			for dbgroupchat in dbgroupchats:
-				if dbgroupchat.chat_id in self._groupchat_cache_by_chat_id:
-					groupchat = self._groupchat_cache_by_chat_id[dbgroupchat.chat_id]
-					if groupchat is None: continue
-					if user.uuid not in groupchat.memberships: continue
-				else:
-					if dbgroupchat.get_membership(user.uuid) is None: continue
-				
-				groupchat = self.get_groupchat(dbgroupchat.chat_id)
-				if groupchat is None: continue
-				
-				groupchats.append(groupchat)
+			groupchats.append(groupchat)
 		
 		return groupchats
 	
+	def get_groupchat_ids(self, user: User) -> Set[str]:
+		# Don't modify the result; see `add_groupchat_member`
+		return self._get_groupchat_index().get(user.uuid) or set()
+	
+	def add_groupchat_member(self, chat_id: str, uuid: str) -> None:
+		index = self._get_groupchat_index()
+		if uuid not in index:
+			index[uuid] = set()
+		index[uuid].add(chat_id)
+	
+	def _get_groupchat_index(self) -> Dict[str, Set[str]]:
+		index = self._groupchat_ids_by_uuid
+		if index is None:
+			index = {}
+			with Session() as sess:
+				for chat_id, memberships in sess.query(DBGroupChat.chat_id, DBGroupChat._memberships):
+					for uuid in (memberships or {}):
+						if uuid not in index:
+							index[uuid] = set()
+						index[uuid].add(chat_id)
+			self._groupchat_ids_by_uuid = index
+		return index
+	
 	def save_groupchat_batch(self, to_save: List[Tuple[str, GroupChat]]) -> None:
 		with Session() as sess:
 			for chat_id, groupchat in to_save:
@@ -285,78 +429,144 @@ class UserService:
 				sess.add(dbgroupchat)
 	
 	def save_batch(self, to_save: List[Tuple[User, UserDetail]]) -> None:
+		self._save_batch_rows(_serialize_batch(to_save))
+	
+	def _save_batch_rows(self, rows: List['_UserRow']) -> None:
+		# Loads every existing row for the batch up front, then only touches
+		# the columns (and contacts) that differ from what's already stored.
+		if not rows: return
 		with Session() as sess:
-			for user, detail in to_save:
-				dbusercontacts_to_add = []
-				
-				dbuser = sess.query(DBUser).filter(DBUser.uuid == user.uuid).one()
-				dbuser.name = user.status.name
-				dbuser.message = _get_persisted_status_message(user.status)
-				dbuser.groups = [{
-					'id': g.id, 'uuid': g.uuid,
-					'name': g.name, 'is_favorite': g.is_favorite,
-				} for g in detail._groups_by_id.values()]
-				dbuser.settings = user.settings
-				sess.add(dbuser)
+			dbusers = {
+				dbuser.uuid: dbuser
+				for dbuser in sess.query(DBUser).filter(DBUser.uuid.in_([user_uuid for user_uuid, _, _, _ in rows]))
+			}
+			dbusercontacts_by_user_id = {} # type: Dict[int, Dict[int, DBUserContact]]
+			for dbusercontact in sess.query(DBUserContact).filter(DBUserContact.user_id.in_([user_id for _, user_id, _, _ in rows])):
+				dbusercontacts_by_user_id.setdefault(dbusercontact.user_id, {})[dbusercontact.contact_id] = dbusercontact
+			
+			for user_uuid, user_id, user_fields, contact_rows in rows:
+				_update_changed(dbusers[user_uuid], user_fields)
 				
-				dbusercontacts = sess.query(DBUserContact).filter(DBUserContact.user_id == user.id)
-				for tmp in dbusercontacts:
-					if tmp.uuid not in detail.contacts:
-						sess.delete(tmp)
-				for c in detail.contacts.values():
-					dbusercontact = sess.query(DBUserContact).filter(DBUserContact.user_id == user.id, DBUserContact.contact_id == c.head.id).one_or_none()
-					status_message = _get_persisted_status_message(c.status)
+				dbusercontacts = dbusercontacts_by_user_id.get(user_id, {})
+				contact_ids = set()
+				for contact_row in contact_rows.values():
+					contact_ids.add(contact_row['contact_id'])
+					dbusercontact = dbusercontacts.get(contact_row['contact_id'])
 					if dbusercontact is None:
-						dbusercontact = DBUserContact(
-							user_id = user.id, contact_id = c.head.id, user_uuid = user.uuid, uuid = c.head.uuid,
-							name = c.status.name, message = status_message,
-							lists = c.lists, groups = [{
-								'id': group.id, 'uuid': group.uuid,
-							} for group in c._groups.copy()], is_messenger_user = c.is_messenger_user,
-							id = c.detail.id,
-						)
-					
-					dbusercontact.name = c.status.name
-					dbusercontact.message = status_message
-					dbusercontact.lists = c.lists
-					dbusercontact.groups = [{
-						'id': group.id, 'uuid': group.uuid,
-					} for group in c._groups.copy()]
-					dbusercontact.is_messenger_user = c.is_messenger_user
-					dbusercontact.birthdate = c.detail.birthdate
-					dbusercontact.anniversary = c.detail.anniversary
-					dbusercontact.notes = c.detail.notes
-					dbusercontact.first_name = c.detail.first_name
-					dbusercontact.middle_name = c.detail.middle_name
-					dbusercontact.last_name = c.detail.last_name
-					dbusercontact.nickname = c.detail.nickname
-					dbusercontact.primary_email_type = c.detail.primary_email_type
-					dbusercontact.personal_email = c.detail.personal_email
-					dbusercontact.work_email = c.detail.work_email
-					dbusercontact.im_email = c.detail.im_email
-					dbusercontact.other_email = c.detail.other_email
-					dbusercontact.home_phone = c.detail.home_phone
-					dbusercontact.work_phone = c.detail.work_phone
-					dbusercontact.fax_phone = c.detail.fax_phone
-					dbusercontact.pager_phone = c.detail.pager_phone
-					dbusercontact.mobile_phone = c.detail.mobile_phone
-					dbusercontact.other_phone = c.detail.other_phone
-					dbusercontact.personal_website = c.detail.personal_website
-					dbusercontact.business_website = c.detail.business_website
-					dbusercontact.locations = {
-						location.type: {
-							'name': location.name, 'street': location.street, 'city': location.city, 'state': location.state, 'country': location.country, 'zip_code': location.zip_code,
-						} for location in c.detail.locations.values()
-					}
-					
-					dbusercontacts_to_add.append(dbusercontact)
-				if dbusercontacts_to_add:
-					sess.add_all(dbusercontacts_to_add)
+						sess.add(DBUserContact(user_id = user_id, user_uuid = user_uuid, **contact_row))
+					else:
+						_update_changed(dbusercontact, contact_row)
+				for contact_id, dbusercontact in dbusercontacts.items():
+					if contact_id not in contact_ids:
+						sess.delete(dbusercontact)
+
+# (uuid, id, `t_user` fields, `t_user_contact` fields by contact uuid)
+_UserRow = Tuple[str, int, Dict[str, Any], Dict[str, Dict[str, Any]]]
+
+def _serialize_batch(to_save: List[Tuple[User, UserDetail]]) -> List[_UserRow]:
+	# Copies everything `_save_batch_rows` needs into plain data, so the write can happen off the event loop
+	rows = []
+	for user, detail in to_save:
+		user_fields = {
+			'name': user.status.name,
+			'message': _get_persisted_status_message(user.status),
+			'groups': [{
+				'id': g.id, 'uuid': g.uuid,
+				'name': g.name, 'is_favorite': g.is_favorite,
+				'date_modified': misc.date_format(g.date_modified),
+			} for g in detail._groups_by_id.values()],
+			'settings': dict(user.settings),
+			'list_version': detail.list_version,
+			'date_ab_removed': detail.date_ab_removed,
+		}
+		contact_rows = {}
+		for c in detail.contacts.values():
+			contact_rows[c.head.uuid] = {
+				'contact_id': c.head.id, 'uuid': c.head.uuid, 'id': c.detail.id,
+				'name': c.status.name, 'message': _get_persisted_status_message(c.status),
+				'lists': c.lists, 'groups': [{
+					'id': group.id, 'uuid': group.uuid,
+				} for group in c._groups.copy()], 'is_messenger_user': c.is_messenger_user,
+				'date_modified': c.date_modified, 'date_lists_modified': c.date_lists_modified,
+				'roles_left': { role: misc.date_format(d) for role, d in c.date_roles_left.items() },
+				'birthdate': c.detail.birthdate, 'anniversary': c.detail.anniversary, 'notes': c.detail.notes,
+				'first_name': c.detail.first_name, 'middle_name': c.detail.middle_name, 'last_name': c.detail.last_name, 'nickname': c.detail.nickname,
+				'primary_email_type': c.detail.primary_email_type, 'personal_email': c.detail.personal_email, 'work_email': c.detail.work_email, 'im_email': c.detail.im_email, 'other_email': c.detail.other_email,
+				'home_phone': c.detail.home_phone, 'work_phone': c.detail.work_phone, 'fax_phone': c.detail.fax_phone, 'pager_phone': c.detail.pager_phone, 'mobile_phone': c.detail.mobile_phone, 'other_phone': c.detail.other_phone,
+				'personal_website': c.detail.personal_website, 'business_website': c.detail.business_website,
+				'locations': {
+					location.type: {
+						'name': location.name, 'street': location.street, 'city': location.city, 'state': location.state, 'country': location.country, 'zip_code': location.zip_code,
+					} for location in c.detail.locations.values()
+				},
+			}
+		rows.append((user.uuid, user.id, user_fields, contact_rows))
+	return rows
+
+def _verify_password(pwd: str, encoded: str) -> bool:
+	# Runs in a `ProcessPoolExecutor` worker
+	return hasher.verify(pwd, encoded)
+
+def _user_from_db(dbuser: DBUser) -> User:
+	status = UserStatus(dbuser.name, dbuser.message)
+	return User(dbuser.id, dbuser.uuid, dbuser.email, dbuser.verified, status, dbuser.settings, dbuser.date_created)
+
+def _update_changed(dbobj: Any, fields: Dict[str, Any]) -> None:
+	for k, v in fields.items():
+		if getattr(dbobj, k) != v:
+			setattr(dbobj, k, v)
+
+def _parse_date(d: Optional[str]) -> Optional[datetime]:
+	# Inverse of `misc.date_format`
+	if not d: return None
+	return datetime.strptime(d, '%Y-%m-%dT%H:%M:%SZ')
+
+def _parse_dates(json: Optional[Dict[str, str]]) -> Dict[str, datetime]:
+	dates = {} # type: Dict[str, datetime]
+	for k, d in (json or {}).items():
+		date = _parse_date(d)
+		if date is not None:
+			dates[k] = date
+	return dates
 
 def _get_persisted_status_message(status: UserStatus) -> str:
 	if not status._persistent:
 		return ''
 	return status.message
 
-def _get_oim_path(recipient_uuid: str) -> Path:
-	return Path('storage/oim') / recipient_uuid
+def _insert_oim(recipient_uuid: str, oim: OIM) -> None:
+	assert oim.message is not None
+	with Session() as sess:
+		dboim = DBOIM(
+			uuid = oim.uuid, recipient_uuid = recipient_uuid, run_id = oim.run_id,
+			from_email = oim.from_email, from_friendly = oim.from_friendly,
+			from_friendly_encoding = (None if oim.from_friendly is None else oim.from_friendly_encoding),
+			from_friendly_charset = (None if oim.from_friendly is None else oim.from_friendly_charset),
+			from_user_id = oim.from_user_id, sent = oim.sent, origin_ip = oim.origin_ip, proxy = oim.oim_proxy,
+			headers = oim.headers, utf8 = oim.utf8, size = oim.size, is_read = oim.is_read,
+		)
+		sess.add(dboim)
+		sess.flush()
+		sess.add(DBOIMBody(oim_id = dboim.id, message = oim.message))
+
+def _oim_from_db(dboim: DBOIM, message: Optional[str], to_email: str) -> OIM:
+	return OIM(
+		dboim.uuid, dboim.run_id, dboim.from_email, dboim.from_friendly, to_email, dboim.sent,
+		message, dboim.utf8,
+		headers = dboim.headers,
+		from_friendly_encoding = dboim.from_friendly_encoding, from_friendly_charset = dboim.from_friendly_charset, from_user_id = dboim.from_user_id,
+		origin_ip = dboim.origin_ip, oim_proxy = dboim.proxy, size = dboim.size, is_read = dboim.is_read,
+	)
+
+OIM_MAX_AGE = timedelta(days = 30)
+OIM_MAX_PER_USER = 100
+OIM_DELETE_BATCH_SIZE = 500
+USER_CACHE_SIZE = 10000
+GROUPCHAT_CACHE_SIZE = 10000
+CACHE_TTL = 3600
+NEGATIVE_CACHE_TTL = 60
+# `None` means one process per CPU
+LOGIN_VERIFY_PROCESSES = None
+LOGIN_VERIFY_CONCURRENCY = 32
+VERIFIED_CREDENTIAL_CACHE_SIZE = 10000
+VERIFIED_CREDENTIAL_TTL = 300
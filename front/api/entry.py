@@ -45,22 +45,14 @@ async def handle_stats_api(req: web.Request) -> web.Response:
 		return web.Response(status = 200, body = json.dumps(result))
 	if service == 'messages':
 		# TODO: Support message count by client ID
-		
-		messages_received = 0
-		messages_sent = 0
-		
-		for stats_raw in backend._stats.by_client.values():
-			from core.stats import _stats_to_json as stats_json
-			stats = stats_json(stats_raw) # type: Dict[str, Any]
-			
-			if 'messages_received' in stats:
-				messages_received += int(stats['messages_received'])
-			if 'messages_sent' in stats:
-				messages_sent += int(stats['messages_sent'])
-		
-		result['messages_received'] = str(messages_received)
-		result['messages_sent'] = str(messages_sent)
-		
+		totals = backend._stats.totals()
+		result['messages_received'] = str(totals['messages_received'])
+		result['messages_sent'] = str(totals['messages_sent'])
+		return web.Response(status = 200, body = json.dumps(result))
+	if service == 'recent':
+		# Counts per `granularity` seconds, oldest first; served from memory
+		result['granularity'] = backend._stats.granularity
+		result['buckets'] = backend._stats.recent_rates()
 		return web.Response(status = 200, body = json.dumps(result))
 	
 	return web.Response(status = 400)
@@ -1,9 +1,10 @@
-from typing import Tuple, Optional, Iterable, List, Any, Callable, Dict
+from typing import Tuple, Optional, Iterable, List, Any, Callable, Dict, ClassVar
 import io
 import asyncio
 from enum import IntEnum
 
 from util.misc import Logger
+from util.dispatch import CommandTable
 
 from core import event
 from core.models import Contact, Substatus, User, GroupChat, GroupChatRole, TextWithData, OIM, MessageData, MessageType, Substatus, LoginOption, NetworkID
@@ -14,7 +15,7 @@ class IRCCtrl:
 	__slots__ = (
 		'logger', 'reader', 'writer', 'peername', 'close_callback', 'closed', 'transport',
 		'backend', 'bs', 'client',
-		'password', 'username', 'chat_sessions'
+		'password', 'username', 'chat_sessions', 'login_task', 'pending'
 	)
 	
 	logger: Logger
@@ -30,6 +31,12 @@ class IRCCtrl:
 	password: Optional[str]
 	username: Optional[str]
 	chat_sessions: Dict[Chat, ChatSession]
+	# `_login` while its password check runs; commands that arrive meanwhile wait in `pending`
+	login_task: Optional['asyncio.Task[None]']
+	pending: List[List[str]]
+	
+	# `_m_*` handlers by command; set below the class
+	commands: ClassVar[CommandTable]
 	
 	def __init__(self, logger: Logger, via: str, backend: Backend) -> None:
 		self.logger = logger
@@ -46,6 +53,8 @@ class IRCCtrl:
 		self.password = None
 		self.username = None
 		self.chat_sessions = {}
+		self.login_task = None
+		self.pending = []
 	
 	def _m_pass(self, pwd: str) -> None:
 		self.password = pwd
@@ -54,7 +63,14 @@ class IRCCtrl:
 		password = self.password
 		self.password = None
 		assert password is not None
-		uuid = self.backend.user_service.login(email, password)
+		# Password verification is awaited; clients pipeline `JOIN`s etc. right behind `USER`,
+		# so those are queued by `data_received` until it's done
+		self.login_task = self.backend.loop.create_task(self._login(email, password))
+		self.login_task.add_done_callback(self._on_login_done)
+	
+	async def _login(self, email: str, password: str) -> None:
+		uuid = await self.backend.user_service.login_async(email, password)
+		if self.closed: return
 		if uuid is not None:
 			bs = self.backend.login(uuid, self.client, BackendEventHandler(self), option = LoginOption.BootOthers)
 		else:
@@ -68,6 +84,22 @@ class IRCCtrl:
 		
 		self.send_numeric(RPL.Welcome, email, ':Log on successful.')
 	
+	def _on_login_done(self, task: 'asyncio.Task[None]') -> None:
+		self.login_task = None
+		if not task.cancelled():
+			ex = task.exception()
+			if isinstance(ex, Exception):
+				self.logger.error(ex)
+		if self.closed: return
+		pending = self.pending
+		self.pending = []
+		for i, m in enumerate(pending):
+			if self.login_task is not None:
+				# Another `USER`; the rest waits for that one
+				self.pending.extend(pending[i:])
+				return
+			self._dispatch(m)
+	
 	def _m_join(self, channel: str, keys: Optional[str] = None) -> None:
 		assert self.bs is not None
 		email = self.bs.user.email
@@ -135,6 +167,16 @@ class IRCCtrl:
 	def _m_cap(self, subcommand: str, capabilities: Optional[str] = None) -> None:
 		self._reply_unsupported('CAP')
 	
+	def _m_nick(self, nick: str) -> None:
+		# The nick is always the email given to `USER`
+		pass
+	
+	def _m_ping(self, token: str, server: Optional[str] = None) -> None:
+		self.send_reply('PONG', 'localhost', ':' + token)
+	
+	def _m_pong(self, token: str, server: Optional[str] = None) -> None:
+		pass
+	
 	def _reply_unsupported(self, cmd: str) -> None:
 		self.send_numeric(Err.UnknownCommand, cmd, ":Not supported")
 	
@@ -149,11 +191,18 @@ class IRCCtrl:
 	def data_received(self, transport: asyncio.BaseTransport, data: bytes) -> None:
 		self.peername = transport.get_extra_info('peername')
 		for m in self.reader.data_received(data):
-			try:
-				f = getattr(self, '_m_{}'.format(m[0].lower()))
-				f(*m[1:])
-			except Exception as ex:
-				self.logger.error(ex)
+			if self.login_task is not None:
+				self.pending.append(m)
+				continue
+			self._dispatch(m)
+	
+	def _dispatch(self, m: List[str]) -> None:
+		command = m[0].upper()
+		if self.bs is None and command not in _PRE_LOGIN_COMMANDS:
+			self.send_numeric(Err.NotRegistered, command, ':You have not registered')
+			return
+		if not self.commands.dispatch(self, command, m[1:]):
+			self.logger.info("unknown command", m[0])
 	
 	def send_numeric(self, n: int, *m: str, source: Optional[str] = None) -> None:
 		self.send_reply('{:03}'.format(n), *m, source = source)
@@ -166,6 +215,13 @@ class IRCCtrl:
 		if transport is not None:
 			transport.write(self.flush())
 	
+	def send_raw(self, data: bytes) -> None:
+		# An already-encoded line, e.g. a `PRIVMSG` going to everyone in a channel
+		self.writer.write_raw(data)
+		transport = self.transport
+		if transport is not None:
+			transport.write(self.flush())
+	
 	def flush(self) -> bytes:
 		return self.writer.flush()
 	
@@ -269,7 +325,14 @@ class ChatEventHandler(event.ChatEventHandler):
 			return
 		if data.text is None:
 			return
-		self.ctrl.send_reply('PRIVMSG', self.cs.chat.ids['irc'], ':' + data.text, source = data.sender.email)
+		# The same line for everyone in the channel; encoded by the first one
+		channel = self.cs.chat.ids['irc']
+		key = ('irc', 'PRIVMSG', channel)
+		line = data.front_cache.get(key)
+		if line is None:
+			line = encode_reply((':' + data.sender.email, 'PRIVMSG', channel, ':' + data.text))
+			data.front_cache[key] = line
+		self.ctrl.send_raw(line)
 
 class IRCReader:
 	__slots__ = ('_logger', '_data')
@@ -332,8 +395,10 @@ class IRCWriter:
 	
 	def write(self, m: Iterable[Any]) -> None:
 		self._logger.info('<<<', *m)
-		self._buf.write(' '.join(map(str, m)).encode('utf-8'))
-		self._buf.write(b'\r\n')
+		self._buf.write(encode_reply(m))
+	
+	def write_raw(self, data: bytes) -> None:
+		self._buf.write(data)
 	
 	def flush(self) -> bytes:
 		data = self._buf.getvalue()
@@ -341,9 +406,13 @@ class IRCWriter:
 			self._buf = io.BytesIO()
 		return data
 
+def encode_reply(m: Iterable[Any]) -> bytes:
+	return ' '.join(map(str, m)).encode('utf-8') + b'\r\n'
+
 class Err(IntEnum):
 	UnknownError = 400
 	UnknownCommand = 421
+	NotRegistered = 451
 	PasswdMismatch = 464
 	InviteOnlyChan = 473
 
@@ -353,3 +422,8 @@ class RPL(IntEnum):
 	ChannelModeIs = 324
 	Inviting = 341
 	WhoReply = 352
+
+# Commands handled before `_login` has set `IRCCtrl.bs`; anything else gets `Err.NotRegistered`
+_PRE_LOGIN_COMMANDS = frozenset(('PASS', 'NICK', 'USER', 'CAP', 'PING', 'PONG', 'QUIT'))
+
+IRCCtrl.commands = CommandTable(IRCCtrl, 'irc', '_m_', str.upper)
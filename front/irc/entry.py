@@ -4,6 +4,7 @@ import asyncio
 
 from core.backend import Backend
 from util.misc import Logger
+from util import metrics
 
 from .ctrl import IRCCtrl
 
@@ -13,6 +14,7 @@ def register(loop: asyncio.AbstractEventLoop, backend: Backend) -> None:
 
 class ListenerIRC(asyncio.Protocol):
 	logger: Logger
+	logger_prefix: str
 	backend: Backend
 	controller: IRCCtrl
 	transport: Optional[asyncio.WriteTransport]
@@ -20,6 +22,7 @@ class ListenerIRC(asyncio.Protocol):
 	def __init__(self, logger_prefix: str, backend: Backend, controller_factory: Callable[[Logger, str, Backend], IRCCtrl]) -> None:
 		super().__init__()
 		self.logger = Logger(logger_prefix, self)
+		self.logger_prefix = logger_prefix
 		self.backend = backend
 		self.controller = controller_factory(self.logger, 'direct', backend)
 		self.controller.close_callback = self._on_close
@@ -29,10 +32,12 @@ class ListenerIRC(asyncio.Protocol):
 		assert isinstance(transport, asyncio.WriteTransport)
 		self.transport = transport
 		self.logger.log_connect()
+		metrics.connections.inc(self.logger_prefix)
 	
 	def connection_lost(self, exc: Optional[Exception]) -> None:
 		self.controller.close()
 		self.logger.log_disconnect()
+		metrics.connections.dec(self.logger_prefix)
 		self.transport = None
 	
 	def data_received(self, data: bytes) -> None:
@@ -1,25 +1,45 @@
-from typing import Optional, Callable
+from typing import Optional, Callable, Dict, Iterable
 import asyncio
 
 from aiohttp import web
 
 from core.backend import Backend
 from util.misc import Logger
+from util import metrics
 
 from .msnp import MSNPCtrl
 
 def register(loop: asyncio.AbstractEventLoop, backend: Backend, http_app: web.Application) -> None:
 	from util.misc import ProtocolRunner
 	from . import msnp_ns, msnp_sb, http, http_gateway, http_sound
+	from .keypool import circleticket_keys
 	
+	circleticket_keys.start(loop)
 	backend.add_runner(ProtocolRunner('0.0.0.0', 1863, ListenerMSNP, args = ['NS', backend, msnp_ns.MSNPCtrlNS]))
 	backend.add_runner(ProtocolRunner('0.0.0.0', 1864, ListenerMSNP, args = ['SB', backend, msnp_sb.MSNPCtrlSB]))
 	http.register(http_app)
 	http_gateway.register(loop, http_app)
 	http_sound.register(http_app)
+	metrics.add_caches(_cache_stats)
+	metrics.registry.add_collector(_collect_metrics)
+
+def _cache_stats() -> Dict[str, Dict[str, int]]:
+	from .msnp_ns import syn_cache_stats
+	from .misc import presence_render_cache_stats
+	from .usertile import usertiles
+	
+	return {
+		'syn': syn_cache_stats(), 'presence_render': presence_render_cache_stats(), 'usertiles': usertiles.stats(),
+	}
+
+def _collect_metrics() -> Iterable[metrics.Family]:
+	from .keypool import circleticket_keys
+	
+	yield metrics.stats_family('escargot_keypool', "Pregenerated RSA keys", { 'circleticket': circleticket_keys.stats() }, 'pool')
 
 class ListenerMSNP(asyncio.Protocol):
 	logger: Logger
+	logger_prefix: str
 	backend: Backend
 	controller: MSNPCtrl
 	transport: Optional[asyncio.WriteTransport]
@@ -27,6 +47,7 @@ class ListenerMSNP(asyncio.Protocol):
 	def __init__(self, logger_prefix: str, backend: Backend, controller_factory: Callable[[Logger, str, Backend], MSNPCtrl]) -> None:
 		super().__init__()
 		self.logger = Logger(logger_prefix, self)
+		self.logger_prefix = logger_prefix
 		self.backend = backend
 		self.controller = controller_factory(self.logger, 'direct', backend)
 		self.controller.close_callback = self._on_close
@@ -36,11 +57,13 @@ class ListenerMSNP(asyncio.Protocol):
 		assert isinstance(transport, asyncio.WriteTransport)
 		self.transport = transport
 		self.logger.log_connect()
+		metrics.connections.inc(self.logger_prefix)
 		self.controller.on_connect()
 	
 	def connection_lost(self, exc: Optional[Exception]) -> None:
 		self.controller.close(hard = True)
 		self.logger.log_disconnect()
+		metrics.connections.dec(self.logger_prefix)
 		self.transport = None
 	
 	def data_received(self, data: bytes) -> None:
@@ -1,11 +1,10 @@
-from typing import Optional, Any, Dict, Tuple
-from datetime import datetime, timedelta
+from typing import Optional, Any, Dict, Tuple, List, Callable, Awaitable
+from datetime import datetime, timedelta, timezone
 from enum import IntEnum
 from email.parser import Parser
 from email.header import decode_header
 from urllib.parse import unquote
-from pathlib import Path
-import lxml
+import lxml.etree
 import re
 import asyncio
 import secrets
@@ -19,9 +18,11 @@ from aiohttp import web
 import settings
 from core import models, event, error
 from core.backend import Backend, BackendSession, MAX_GROUP_NAME_LENGTH
-from .misc import gen_mail_data, format_oim, cid_format, gen_signedticket_xml
+from .misc import gen_mail_data, format_oim, cid_format, gen_signedticket_xml, ensure_circleticket_key
 from .msnp_ns import GroupChatEventHandler
+from .usertile import usertiles
 import util.misc
+from util import metrics
 
 LOGIN_PATH = '/login'
 TMPL_DIR = 'front/msn/tmpl'
@@ -54,18 +55,19 @@ def register(app: web.Application) -> None:
 	# MSN >= 7.5
 	app.router.add_route('OPTIONS', '/NotRST.srf', handle_not_rst)
 	app.router.add_post('/NotRST.srf', handle_not_rst)
-	app.router.add_post('/RST.srf', handle_rst)
-	app.router.add_post('/RST2.srf', lambda req: handle_rst(req, rst2 = True))
+	app.router.add_post('/RST.srf', _timed_soap(handle_rst))
+	app.router.add_post('/RST2.srf', _timed_soap(lambda req: handle_rst(req, rst2 = True)))
 	
 	# MSN 8.1.0178
 	# TODO: Use SOAP library for SOAP services.
-	app.router.add_post('/abservice/SharingService.asmx', handle_abservice)
-	app.router.add_post('/abservice/abservice.asmx', handle_abservice)
-	app.router.add_post('/storageservice/SchematizedStore.asmx', handle_storageservice)
+	app.router.add_post('/abservice/SharingService.asmx', _timed_soap(handle_abservice))
+	app.router.add_post('/abservice/abservice.asmx', _timed_soap(handle_abservice))
+	app.router.add_post('/storageservice/SchematizedStore.asmx', _timed_soap(handle_storageservice))
 	app.router.add_get('/storage/usertile/{uuid}/static', handle_usertile)
 	app.router.add_get('/storage/usertile/{uuid}/small', lambda req: handle_usertile(req, small = True))
-	app.router.add_post('/rsi/rsi.asmx', handle_rsi)
-	app.router.add_post('/OimWS/oim.asmx', handle_oim)
+	app.on_response_prepare.append(_on_usertile_prepare)
+	app.router.add_post('/rsi/rsi.asmx', _timed_soap(handle_rsi))
+	app.router.add_post('/OimWS/oim.asmx', _timed_soap(handle_oim))
 	
 	# Misc
 	app.router.add_get('/etc/debug', handle_debug)
@@ -77,13 +79,18 @@ async def handle_abservice(req: web.Request) -> web.Response:
 	if bs is None:
 		raise web.HTTPForbidden()
 	action_str = _get_tag_localname(action)
-	if _find_element(action, 'deltasOnly') or _find_element(action, 'DeltasOnly'):
-		return render(req, 'msn:abservice/Fault.fullsync.xml', { 'faultactor': action_str })
 	now_str = util.misc.date_format(datetime.utcnow())
 	user = bs.user
 	detail = user.detail
+	assert detail is not None
 	cachekey = secrets.token_urlsafe(172)
 	
+	since = None # type: Optional[datetime]
+	if _find_element(action, 'deltasOnly') or _find_element(action, 'DeltasOnly'):
+		since = _get_delta_cursor(action, detail)
+		if since is None:
+			return render(req, 'msn:abservice/Fault.fullsync.xml', { 'faultactor': action_str })
+	
 	#print(_xml_to_string(action))
 	
 	try:
@@ -96,6 +103,8 @@ async def handle_abservice(req: web.Request) -> web.Response:
 				'detail': detail,
 				'Lst': models.Lst,
 				'lists': [models.Lst.AL, models.Lst.BL],
+				'contacts': _contacts_changed_since(detail, since, lists = True),
+				'since': since,
 				'now': now_str,
 			})
 		if action_str == 'AddMember':
@@ -115,7 +124,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 						if _find_element(member, 'Type') == 'Email' and _find_element(member, 'State') == 'Accepted':
 							email = _find_element(member, 'Email')
 					assert email is not None
-					contact_uuid = backend.util_get_uuid_from_email(email)
+					contact_uuid = await backend.util_get_uuid_from_email_async(email)
 					assert contact_uuid is not None
 					try:
 						bs.me_contact_add(contact_uuid, lst, name = email)
@@ -149,7 +158,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 								contact_uuid = _find_element(member, 'MembershipId').split('/', 1)[1]
 							except:
 								email = _find_element(member, 'PassportName')
-								contact_uuid = backend.util_get_uuid_from_email(email or '')
+								contact_uuid = await backend.util_get_uuid_from_email_async(email or '')
 							assert contact_uuid is not None
 					if contact_uuid not in detail.contacts:
 						return render(req, 'msn:sharing/Fault.memberdoesnotexist.xml', status = 500)
@@ -184,6 +193,9 @@ async def handle_abservice(req: web.Request) -> web.Response:
 				'Lst': models.Lst,
 				'user': user,
 				'detail': user.detail,
+				'groups': _groups_changed_since(detail, since),
+				'contacts': _contacts_changed_since(detail, since),
+				'since': since,
 				'now': now_str,
 				'ab_id': ab_id,
 			})
@@ -215,6 +227,8 @@ async def handle_abservice(req: web.Request) -> web.Response:
 			
 			groupchats = [groupchat for groupchat in backend.user_service.get_groupchat_batch(user) if not (groupchat.memberships[user.uuid].role == models.GroupChatRole.Empty or groupchat.memberships[user.uuid].state == models.GroupChatState.Empty)]
 			
+			await ensure_circleticket_key(bs)
+			
 			return render(req, 'msn:abservice/ABFindContactsPagedResponse.xml', {
 				'cachekey': cachekey,
 				'host': settings.LOGIN_HOST,
@@ -222,6 +236,9 @@ async def handle_abservice(req: web.Request) -> web.Response:
 				'Lst': models.Lst,
 				'user': user,
 				'detail': user.detail,
+				'groups': _groups_changed_since(detail, since),
+				'contacts': _contacts_changed_since(detail, since),
+				'since': since,
 				'now': now_str,
 				'groupchats': groupchats,
 				'groupchat': groupchat,
@@ -261,7 +278,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 			elif '.' not in email:
 				return render(req, 'msn:abservice/Fault.emailmissingdot.xml', status = 500)
 			
-			contact_uuid = backend.util_get_uuid_from_email(email)
+			contact_uuid = await backend.util_get_uuid_from_email_async(email)
 			if contact_uuid is None:
 				return render(req, 'msn:abservice/Fault.invaliduser.xml', {
 					'email': email,
@@ -358,15 +375,15 @@ async def handle_abservice(req: web.Request) -> web.Response:
 						return render(req, 'msn:abservice/Fault.contactdoesnotexist.xml', {
 							'action_str': 'ABContactUpdate',
 						}, status = 500)
-				properties_changed = contact.find('./{*}propertiesChanged')
+				properties_changed = _get_text(contact.find('./{*}propertiesChanged'))
 				if not properties_changed:
 					return web.HTTPInternalServerError()
-				properties_changed = str(properties_changed).strip().split(' ')
-				for contact_property in properties_changed:
+				changed_props = properties_changed.strip().split(' ')
+				for contact_property in changed_props:
 					if contact_property not in _CONTACT_PROPERTIES:
 						return web.HTTPInternalServerError()
 				
-				for contact_property in properties_changed:
+				for contact_property in changed_props:
 					if contact_property == 'Anniversary':
 						assert ctc is not None
 						property = _find_element(contact_info, 'Anniversary')
@@ -489,9 +506,10 @@ async def handle_abservice(req: web.Request) -> web.Response:
 					contact_uuid = _find_element(contact, 'contactId')
 				if contact_uuid is not user.uuid and contact_uuid is not None:
 					ctc = detail.contacts.get(contact_uuid)
-				properties_changed = str(contact.find('./{*}propertiesChanged')).strip().split(' ')
+				properties_changed = _get_text(contact.find('./{*}propertiesChanged'))
+				changed_props = properties_changed.strip().split(' ') if properties_changed else []
 				
-				for contact_property in properties_changed:
+				for contact_property in changed_props:
 					if contact_property == 'ContactFirstName':
 						assert ctc is not None
 						property = _find_element(contact_info, 'firstName')
@@ -596,9 +614,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 							email_properties_changed = str(_find_element(contact_email, 'propertiesChanged')).strip().split(' ')
 							for email_property in email_properties_changed:
 								if email_property == 'Email':
-									email = contact_email.find('./{*}email')
-									if email is not None:
-										email = str(email)
+									email = _get_text(contact_email.find('./{*}email'))
 									if _find_element(contact_email, 'contactEmailType') == 'ContactEmailPersonal':
 										ctc.detail.personal_email = email
 									if _find_element(contact_email, 'contactEmailType') == 'ContactEmailBusiness':
@@ -620,9 +636,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 							phone_properties_changed = str(_find_element(contact_phone, 'propertiesChanged')).strip().split(' ')
 							for phone_property in phone_properties_changed:
 								if phone_property == 'Number':
-									phone_number = contact_phone.find('./{*}number')
-									if phone_number is not None:
-										phone_number = str(phone_number)
+									phone_number = _get_text(contact_phone.find('./{*}number'))
 									if _find_element(contact_phone, 'contactPhoneType') == 'ContactPhonePersonal':
 										ctc.detail.home_phone = phone_number
 									if _find_element(contact_phone, 'contactPhoneType') == 'ContactPhoneBusiness':
@@ -694,6 +708,8 @@ async def handle_abservice(req: web.Request) -> web.Response:
 								# TODO: What's this used for?
 								continue
 				if updated:
+					if ctc is not None:
+						ctc.touch()
 					backend._mark_modified(user)
 			
 			return render(req, 'msn:abservice/ABContactUpdateResponse.xml', {
@@ -756,18 +772,18 @@ async def handle_abservice(req: web.Request) -> web.Response:
 			
 			groups = action.findall('.//{*}groups/{*}Group')
 			for group_elm in groups:
-				group_id = str(_find_element(group_elm, 'groupId'))
+				group_id = _find_text(group_elm, 'groupId')
 				if group_id not in detail._groups_by_uuid:
 					return web.HTTPInternalServerError()
 				group_info = group_elm.find('.//{*}groupInfo')
 				properties_changed = _find_element(group_elm, 'propertiesChanged')
 				if not properties_changed:
 					return web.HTTPInternalServerError()
-				properties_changed = str(properties_changed).strip().split(' ')
-				for i, contact_property in enumerate(properties_changed):
+				changed_props = str(properties_changed).strip().split(' ')
+				for i, contact_property in enumerate(changed_props):
 					if contact_property not in _CONTACT_PROPERTIES:
 						return web.HTTPInternalServerError()
-				for contact_property in properties_changed:
+				for contact_property in changed_props:
 					if contact_property == 'GroupName':
 						name = str(_find_element(group_info, 'name'))
 						if name is None:
@@ -790,12 +806,12 @@ async def handle_abservice(req: web.Request) -> web.Response:
 						if not isinstance(is_favorite, bool):
 							return web.HTTPInternalServerError()
 			for group_elm in groups:
-				group_id = str(_find_element(group_elm, 'groupId'))
+				group_id = _find_text(group_elm, 'groupId')
 				g = detail.get_group_by_id(group_id)
 				group_info = group_elm.find('.//{*}groupInfo')
 				properties_changed = _find_element(group_elm, 'propertiesChanged')
-				properties_changed = str(properties_changed).strip().split(' ')
-				for contact_property in properties_changed:
+				changed_props = str(properties_changed).strip().split(' ')
+				for contact_property in changed_props:
 					if contact_property == 'GroupName':
 						name = str(_find_element(group_info, 'name'))
 						bs.me_group_edit(group_id, new_name = name)
@@ -822,7 +838,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 			if ab_id != '00000000-0000-0000-0000-000000000000':
 				return web.HTTPInternalServerError()
 			
-			group_ids = [str(group_id) for group_id in action.findall('.//{*}groupFilter/{*}groupIds/{*}guid')]
+			group_ids = [_elm_text(elm) for elm in action.findall('.//{*}groupFilter/{*}groupIds/{*}guid')]
 			for group_id in group_ids:
 				if group_id not in detail._groups_by_uuid:
 					return web.HTTPInternalServerError()
@@ -847,7 +863,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 			if ab_id != '00000000-0000-0000-0000-000000000000':
 				return web.HTTPInternalServerError()
 			
-			group_ids = [str(group_id) for group_id in action.findall('.//{*}groupFilter/{*}groupIds/{*}guid')]
+			group_ids = [_elm_text(elm) for elm in action.findall('.//{*}groupFilter/{*}groupIds/{*}guid')]
 			
 			for group_id in group_ids:
 				if group_id not in detail._groups_by_uuid:
@@ -859,7 +875,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 					email = _find_element(action, 'email')
 					if email is None:
 						return web.HTTPInternalServerError()
-				contact_uuid = backend.util_get_uuid_from_email(email)
+				contact_uuid = await backend.util_get_uuid_from_email_async(email)
 				assert contact_uuid is not None
 				
 				ctc = detail.contacts.get(contact_uuid)
@@ -875,8 +891,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 					except:
 						return web.HTTPInternalServerError()
 			else:
-				contact_uuid = _find_element(action, 'contactId')
-				assert contact_uuid is not None
+				contact_uuid = _find_text(action, 'contactId')
 				
 				ctc = detail.contacts.get(contact_uuid)
 				if ctc is None or not ctc.lists & models.Lst.FL:
@@ -911,7 +926,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 			if ab_id != '00000000-0000-0000-0000-000000000000':
 				return web.HTTPInternalServerError()
 			
-			group_ids = [str(group_id) for group_id in action.findall('.//{*}groupFilter/{*}groupIds/{*}guid')]
+			group_ids = [_elm_text(elm) for elm in action.findall('.//{*}groupFilter/{*}groupIds/{*}guid')]
 			
 			for group_id in group_ids:
 				if group_id not in detail._groups_by_uuid:
@@ -943,7 +958,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 		if action_str == 'CreateCircle':
 			user = bs.user
 			
-			if _find_element(action, 'Domain') == 1 and _find_element(action, 'HostedDomain') == 'live.com' and _find_element(action, 'Type') == 2 and isinstance(_find_element(action, 'IsPresenceEnabled'), bool):
+			if _find_element(action, 'Domain') == '1' and _find_element(action, 'HostedDomain') == 'live.com' and _find_element(action, 'Type') == '2' and isinstance(_find_element(action, 'IsPresenceEnabled'), bool):
 				membership_access = int(_find_element(action, 'MembershipAccess'))
 				#request_membership_option = int(_find_element(action, 'RequestMembershipOption'))
 				
@@ -979,7 +994,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 			chat_id = ab_id[-12:]
 			contact_email = _find_element(action, 'Email')
 			
-			contact_uuid = backend.util_get_uuid_from_email(contact_email)
+			contact_uuid = await backend.util_get_uuid_from_email_async(contact_email)
 			if contact_uuid is None:
 				return web.HTTPInternalServerError()
 			head = backend._load_user_record(contact_uuid)
@@ -1055,7 +1070,7 @@ async def handle_abservice(req: web.Request) -> web.Response:
 			
 			if _find_element(action, 'connection') == True:
 				try:
-					relationship_type = models.RelationshipType(_find_element(action, 'relationshipType'))
+					relationship_type = models.RelationshipType(int(_find_element(action, 'relationshipType')))
 					relationship_role = int(_find_element(action, 'relationshipRole'))
 					wl_action = int(_find_element(action, 'action'))
 				except ValueError:
@@ -1211,6 +1226,8 @@ async def handle_abservice(req: web.Request) -> web.Response:
 		if action_str in { 'UpdateDynamicItem' }:
 			# TODO: UpdateDynamicItem
 			return _unknown_soap(req, header, action, expected = True)
+	except web.HTTPException:
+		raise
 	except Exception as ex:
 		import traceback
 		return render(req, 'msn:Fault.generic.xml', {
@@ -1263,7 +1280,7 @@ async def handle_storageservice(req: web.Request) -> web.Response:
 			'pptoken1': token,
 		})
 	if action_str == 'CreateDocument':
-		return handle_create_document(req, action, user, cid, token, timestamp)
+		return await handle_create_document(req, action, user, cid, token, timestamp)
 	if action_str == 'CreateRelationships':
 		# TODO: CreateRelationships
 		return render(req, 'msn:storageservice/CreateRelationshipsResponse.xml', {
@@ -1295,15 +1312,18 @@ async def handle_rsi(req: web.Request) -> web.Response:
 		oim_uuid = _find_element(action, 'messageId')
 		oim_markAsRead = _find_element(action, 'alsoMarkAsRead')
 		oim = backend.user_service.get_oim_single(user, oim_uuid, mark_read = oim_markAsRead is True)
+		if oim is None:
+			return render(req, 'msn:oim/Fault.validation.xml', status = 500)
 		return render(req, 'msn:oim/GetMessageResponse.xml', {
 			'oim_data': format_oim(oim),
 		})
 	if action_str == 'DeleteMessages':
-		messageIds = action.findall('.//{*}messageIds/{*}messageId')
+		messageIds = [_elm_text(elm) for elm in action.findall('.//{*}messageIds/{*}messageId')]
 		if not messageIds:
 			return render(req, 'msn:oim/Fault.validation.xml', status = 500)
+		stored = { oim.uuid for oim in backend.user_service.get_oim_batch(user) }
 		for messageId in messageIds:
-			if backend.user_service.get_oim_single(user, messageId) is None:
+			if messageId not in stored:
 				return render(req, 'msn:oim/Fault.validation.xml', status = 500)
 		for messageId in messageIds:
 			backend.user_service.delete_oim(user.uuid, messageId)
@@ -1336,7 +1356,7 @@ async def handle_oim(req: web.Request) -> web.Response:
 	email = header.find('.//{*}From').get('memberName')
 	recipient = header.find('.//{*}To').get('memberName')
 	
-	recipient_uuid = backend.util_get_uuid_from_email(recipient)
+	recipient_uuid = await backend.util_get_uuid_from_email_async(recipient)
 	
 	if email != user.email or recipient_uuid is None or not _is_on_al(recipient_uuid, backend, user, detail):
 		return render(req, 'msn:oim/Fault.unavailable.xml', {
@@ -1486,12 +1506,9 @@ def _parse_cookies(cookie_string: Optional[str]) -> Dict[str, Any]:
 	return cookie_dict
 
 async def _preprocess_soap(req: web.Request) -> Tuple[Any, Any, Optional[BackendSession], str]:
-	from lxml.objectify import fromstring as parse_xml
-	
 	mspauth = False
 	
-	body = await req.read()
-	root = parse_xml(body)
+	root = await _read_soap(req)
 	
 	token = _find_element(root, 'TicketToken')
 	if token is None:
@@ -1502,7 +1519,7 @@ async def _preprocess_soap(req: web.Request) -> Tuple[Any, Any, Optional[Backend
 			mspauth = True
 	if token is None:
 		raise web.HTTPInternalServerError()
-		
+	
 	if token[0:2] == 't=':
 		token = token[2:22]
 	elif mspauth:
@@ -1513,15 +1530,15 @@ async def _preprocess_soap(req: web.Request) -> Tuple[Any, Any, Optional[Backend
 	
 	header = _find_element(root, 'Header')
 	action = _find_element(root, 'Body/*[1]')
-	if settings.DEBUG and settings.DEBUG_MSNP: print('Action: {}'.format(_get_tag_localname(action)))
+	if action is None:
+		raise web.HTTPBadRequest()
+	req['soap_action'] = _get_tag_localname(action)
+	if settings.DEBUG and settings.DEBUG_MSNP: print('Action: {}'.format(req['soap_action']))
 	
 	return header, action, backend_sess, token
 
 async def _preprocess_soap_rsi(req: web.Request) -> Tuple[Any, Any, Optional[BackendSession], str]:
-	from lxml.objectify import fromstring as parse_xml
-	
-	body = await req.read()
-	root = parse_xml(body)
+	root = await _read_soap(req)
 	
 	token_tag = root.find('.//{*}PassportCookie/{*}*[1]')
 	if _get_tag_localname(token_tag) is not 't':
@@ -1535,15 +1552,17 @@ async def _preprocess_soap_rsi(req: web.Request) -> Tuple[Any, Any, Optional[Bac
 	
 	header = _find_element(root, 'Header')
 	action = _find_element(root, 'Body/*[1]')
-	if settings.DEBUG and settings.DEBUG_MSNP: print('Action: {}'.format(_get_tag_localname(action)))
+	if action is None:
+		raise web.HTTPBadRequest()
+	req['soap_action'] = _get_tag_localname(action)
+	if settings.DEBUG and settings.DEBUG_MSNP: print('Action: {}'.format(req['soap_action']))
 	
 	return header, action, bs, token
 
 async def _preprocess_soap_oimws(req: web.Request) -> Tuple[Any, str, str, Optional[BackendSession], str]:
-	from lxml.objectify import fromstring as parse_xml
-	
-	body = await req.read()
-	root = parse_xml(body)
+	root = await _read_soap(req)
+	# The body is the message itself, so the action only shows up in `SOAPAction`
+	req['soap_action'] = (req.headers.get('SOAPAction') or 'Store').strip('"').rsplit('/', 1)[-1]
 	
 	token = root.find('.//{*}Ticket').get('passport')
 	if token[0:2] == 't=':
@@ -1558,17 +1577,152 @@ async def _preprocess_soap_oimws(req: web.Request) -> Tuple[Any, str, str, Optio
 	
 	return header, body_msgtype, body_content, bs, token
 
+async def _read_soap(req: web.Request) -> Any:
+	# Feeds the body to a plain `lxml.etree` parser as it arrives: no objectify type guessing,
+	# no entity expansion, no network access. Oversized bodies are refused before any parsing.
+	if req.content_length is not None and req.content_length > MAX_SOAP_BODY_SIZE:
+		raise web.HTTPRequestEntityTooLarge(max_size = MAX_SOAP_BODY_SIZE, actual_size = req.content_length)
+	parser = lxml.etree.XMLParser(resolve_entities = False, no_network = True)
+	size = 0
+	parse_time = 0.0
+	try:
+		async for chunk in req.content.iter_chunked(SOAP_READ_CHUNK_SIZE):
+			size += len(chunk)
+			if size > MAX_SOAP_BODY_SIZE:
+				raise web.HTTPRequestEntityTooLarge(max_size = MAX_SOAP_BODY_SIZE, actual_size = size)
+			start = time.perf_counter()
+			parser.feed(chunk)
+			parse_time += time.perf_counter() - start
+		start = time.perf_counter()
+		root = parser.close()
+		parse_time += time.perf_counter() - start
+	except lxml.etree.XMLSyntaxError:
+		raise web.HTTPBadRequest()
+	req['soap_parse_time'] = parse_time
+	req['soap_parsed_at'] = time.perf_counter()
+	return root
+
+def _timed_soap(handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> Callable[[web.Request], Awaitable[web.StreamResponse]]:
+	# Records parse and handling time per action, for requests that got as far as naming one
+	async def timed_handler(req: web.Request) -> web.StreamResponse:
+		try:
+			return await handler(req)
+		finally:
+			action_str = req.get('soap_action')
+			if action_str is not None:
+				stats = _soap_stats.get(action_str)
+				if stats is None:
+					stats = _SOAPActionStats()
+					_soap_stats[action_str] = stats
+				handle_time = time.perf_counter() - req['soap_parsed_at']
+				stats.add(req['soap_parse_time'], handle_time)
+				metrics.soap_time.labels(action_str).observe(req['soap_parse_time'] + handle_time)
+	return timed_handler
+
+class _SOAPActionStats:
+	__slots__ = ('count', 'parse_time', 'handle_time', 'max_handle_time')
+	
+	count: int
+	parse_time: float
+	handle_time: float
+	max_handle_time: float
+	
+	def __init__(self) -> None:
+		self.count = 0
+		self.parse_time = 0.0
+		self.handle_time = 0.0
+		self.max_handle_time = 0.0
+	
+	def add(self, parse_time: float, handle_time: float) -> None:
+		self.count += 1
+		self.parse_time += parse_time
+		self.handle_time += handle_time
+		if handle_time > self.max_handle_time:
+			self.max_handle_time = handle_time
+
+def soap_action_stats() -> Dict[str, Dict[str, float]]:
+	# Totals in seconds since startup, by SOAP action
+	return {
+		action_str: {
+			'count': stats.count, 'parse_time': stats.parse_time,
+			'handle_time': stats.handle_time, 'max_handle_time': stats.max_handle_time,
+		} for action_str, stats in _soap_stats.items()
+	}
+
 def _get_tag_localname(elm: Any) -> str:
 	return lxml.etree.QName(elm.tag).localname
 
+def _get_delta_cursor(action: Any, detail: models.UserDetail) -> Optional[datetime]:
+	# The `lastChange` a `deltasOnly` request is relative to, or `None` if it needs a full sync
+	last_change = _find_element(action, 'lastChange') or _find_element(action, 'LastChanged')
+	if not last_change: return None
+	try:
+		since = iso_parser.parse(str(last_change))
+	except (ValueError, OverflowError):
+		return None
+	if since.tzinfo is not None:
+		since = since.astimezone(timezone.utc).replace(tzinfo = None)
+	if detail.date_ab_removed is not None and since <= detail.date_ab_removed:
+		return None
+	return since
+
+def _contacts_changed_since(detail: models.UserDetail, since: Optional[datetime], *, lists: bool = False) -> List[models.Contact]:
+	# `lastChange` only has second precision, so anything in the same second is sent again
+	if since is None:
+		return list(detail.contacts.values())
+	if lists:
+		return [ctc for ctc in detail.contacts.values() if ctc.date_lists_modified >= since]
+	return [ctc for ctc in detail.contacts.values() if ctc.date_modified >= since]
+
+def _groups_changed_since(detail: models.UserDetail, since: Optional[datetime]) -> List[models.Group]:
+	if since is None:
+		return list(detail._groups_by_uuid.values())
+	return [group for group in detail._groups_by_uuid.values() if group.date_modified >= since]
+
 def _find_element(xml: Any, query: str) -> Any:
-	thing = xml.find('.//{*}' + query.replace('/', '/{*}'))
-	if isinstance(thing, lxml.objectify.StringElement):
-		thing = str(thing)
-	elif isinstance(thing, lxml.objectify.BoolElement):
-		thing = bool(thing)
+	# First element below `xml` matching `query` (local names; any namespace).
+	# Elements with children are returned as-is; leaves as their text, with `true`/`false` as `bool`.
+	thing = _find_elm(xml, query)
+	if thing is None or len(thing):
+		return thing
+	return _leaf_value(thing)
+
+def _find_text(xml: Any, query: str) -> str:
+	# Text of an element the request can't do without, e.g. an id; a 400 if it's missing
+	elm = _find_elm(xml, query)
+	if elm is None:
+		raise web.HTTPBadRequest()
+	return _elm_text(elm)
+
+def _find_elm(xml: Any, query: str) -> Any:
+	if '/' in query:
+		path = _ELEMENT_PATHS.get(query)
+		if path is None:
+			path = './/{*}' + query.replace('/', '/{*}')
+			_ELEMENT_PATHS[query] = path
+		thing = xml.find(path)
+	else:
+		# Walking the tree beats both `find('.//')` and XPath for a single name
+		thing = None
+		for elm in xml.iter('{*}' + query):
+			if elm is not xml:
+				thing = elm
+				break
 	return thing
 
+def _get_text(elm: Any) -> Optional[str]:
+	if elm is None: return None
+	return _elm_text(elm)
+
+def _elm_text(elm: Any) -> str:
+	return elm.text or ''
+
+def _leaf_value(elm: Any) -> Any:
+	text = elm.text or ''
+	if text == 'true': return True
+	if text == 'false': return False
+	return text
+
 async def handle_textad(req: web.Request) -> web.Response:
 	with open(ETC_DIR + '/textads.json') as f:
 		textads = json.loads(f.read())
@@ -1656,7 +1810,7 @@ async def handle_login(req: web.Request) -> web.Response:
 		token = None
 	else:
 		email, pwd = tmp
-		token = _login(req, email, pwd)
+		token = await _login(req, email, pwd)
 	if token is None:
 		raise web.HTTPUnauthorized(headers = {
 			'WWW-Authenticate': '{}da-status=failed'.format(PP),
@@ -1677,7 +1831,7 @@ async def handle_not_rst(req: web.Request) -> web.Response:
 	
 	email = req.headers.get('X-User')
 	pwd = req.headers.get('X-Password')
-	token = _login(req, email, pwd, lifetime = 86400)
+	token = await _login(req, email, pwd, lifetime = 86400)
 	headers = {
 		'Access-Control-Allow-Origin': '*',
 		'Access-Control-Allow-Methods': 'POST',
@@ -1688,22 +1842,20 @@ async def handle_not_rst(req: web.Request) -> web.Response:
 	return web.HTTPOk(headers = headers)
 
 async def handle_rst(req: web.Request, rst2: bool = False) -> web.Response:
-	from lxml.objectify import fromstring as parse_xml
-	
-	body = await req.read()
-	root = parse_xml(body)
+	root = await _read_soap(req)
+	req['soap_action'] = ('RST2' if rst2 else 'RST')
 	
 	email = _find_element(root, 'Username')
 	pwd = str(_find_element(root, 'Password'))
-
+	
 	if email is None or pwd is None:
 		raise web.HTTPBadRequest()
 	
 	backend: Backend = req.app['backend']
 	
-	token = _login(req, email, pwd, binary_secret = True, lifetime = 86400)
+	token = await _login(req, email, pwd, binary_secret = True, lifetime = 86400)
 	
-	uuid = backend.util_get_uuid_from_email(email)
+	uuid = await backend.util_get_uuid_from_email_async(email)
 	
 	if token is not None and uuid is not None:
 		day_before_expiry = datetime.utcfromtimestamp((backend.auth_service.get_token_expiry('nb/login', token) or 0) - 86400)
@@ -1722,7 +1874,7 @@ async def handle_rst(req: web.Request, rst2: bool = False) -> web.Response:
 			host = '127.0.0.1'
 		
 		# get list of requested domains
-		domains = root.findall('.//{*}Address')
+		domains = [_elm_text(elm) for elm in root.iter('{*}Address')]
 		domains.remove('http://Passport.NET/tb') # ignore Passport token request
 		
 		tpl = backend.auth_service.get_token('nb/login', token) # type: Optional[Tuple[str, Optional[str]]]
@@ -1773,9 +1925,6 @@ async def handle_rst(req: web.Request, rst2: bool = False) -> web.Response:
 		'timez': util.misc.date_format(datetime.utcnow()),
 	}, status = 403)
 
-def _get_storage_path(uuid: str) -> Path:
-	return Path('storage/dp') / uuid[0:1] / uuid[0:2]
-
 async def join_creator_to_groupchat(backend: Backend, user: models.User, chat_id: str) -> None:
 	for sess in backend.util_get_sessions_by_user(user):
 		await asyncio.sleep(0.2)
@@ -1783,9 +1932,7 @@ async def join_creator_to_groupchat(backend: Backend, user: models.User, chat_id
 		await asyncio.sleep(0.2)
 		sess.evt.on_groupchat_created(chat_id)
 
-def handle_create_document(req: web.Request, action: Any, user: models.User, cid: str, token: str, timestamp: int) -> web.Response:
-	from PIL import Image
-	
+async def handle_create_document(req: web.Request, action: Any, user: models.User, cid: str, token: str, timestamp: int) -> web.Response:
 	# get image data
 	name = _find_element(action, 'Name')
 	streamtype = _find_element(action, 'DocumentStreamType')
@@ -1793,21 +1940,7 @@ def handle_create_document(req: web.Request, action: Any, user: models.User, cid
 	if streamtype == 'UserTileStatic':
 		mime = _find_element(action, 'MimeType')
 		data = _find_element(action, 'Data')
-		data = base64.b64decode(data)
-		
-		# store display picture as file
-		path = _get_storage_path(user.uuid)
-		path.mkdir(parents = True, exist_ok = True)
-		
-		image_path = path / '{uuid}.{mime}'.format(uuid = user.uuid, mime = mime)
-		
-		image_path.write_bytes(data)
-		
-		image = Image.open(image_path)
-		thumb = image.resize((21, 21))
-		
-		thumb_path = path / '{uuid}_thumb.{mime}'.format(uuid = user.uuid, mime = mime)
-		thumb.save(str(thumb_path))
+		await usertiles.save(user.uuid, mime, data)
 	
 	return render(req, 'msn:storageservice/CreateDocumentResponse.xml', {
 		'user': user,
@@ -1816,17 +1949,30 @@ def handle_create_document(req: web.Request, action: Any, user: models.User, cid
 		'timestamp': timestamp,
 	})
 
-async def handle_usertile(req: web.Request, small: bool = False) -> web.Response:
-	uuid = req.match_info['uuid']
-	storage_path = _get_storage_path(uuid)
-	files = list(storage_path.iterdir())
-	
-	if not files:
+async def handle_usertile(req: web.Request, small: bool = False) -> web.StreamResponse:
+	tile = await usertiles.get(req.match_info['uuid'])
+	if tile is None:
+		raise web.HTTPNotFound()
+	etag = (tile.thumb_etag if small else tile.etag)
+	if etag is None:
 		raise web.HTTPNotFound()
 	
-	ext = files[0].suffix
-	image_path = storage_path / '{}{}{}'.format(uuid, '_thumb' if small else '', ext)
-	return web.HTTPOk(content_type = 'image/{}'.format(ext), body = image_path.read_bytes())
+	headers = {
+		'Cache-Control': 'public, max-age={}'.format(USERTILE_MAX_AGE),
+		'Content-Type': tile.content_type,
+		'ETag': '"{}"'.format(etag),
+	}
+	if any(tag.value in (etag, '*') for tag in req.if_none_match or ()):
+		return web.Response(status = 304, headers = headers)
+	req['usertile_etag'] = headers.pop('ETag')
+	return web.FileResponse(tile.get_path(small = small), headers = headers)
+
+async def _on_usertile_prepare(req: web.Request, res: web.StreamResponse) -> None:
+	# `FileResponse` sets an ETag from the file's mtime and size just before sending;
+	# usertiles use their content hash, which survives re-uploads of the same image
+	etag = req.get('usertile_etag')
+	if etag is not None:
+		res.headers['ETag'] = etag
 
 async def handle_debug(req: web.Request) -> web.Response:
 	return render(req, 'msn:debug.html')
@@ -1853,11 +1999,12 @@ def _extract_pp_credentials(auth_str: str) -> Optional[Tuple[str, str]]:
 	pwd = auth['pwd']
 	return email, pwd
 
-def _login(req: web.Request, email: str, pwd: str, binary_secret: bool = False, lifetime: int = 30) -> Optional[str]:
+async def _login(req: web.Request, email: str, pwd: str, binary_secret: bool = False, lifetime: int = 30) -> Optional[str]:
 	backend: Backend = req.app['backend']
 	bsecret = None
-	uuid = backend.user_service.login(email, pwd)
+	uuid = await backend.user_service.login_async(email, pwd)
 	if uuid is None: return None
+	await backend.preload_user(uuid)
 	return backend.auth_service.create_token('nb/login', (uuid, base64.b64encode(secrets.token_bytes(24)).decode('ascii') if binary_secret else None), lifetime = lifetime)
 
 def _bool_to_str(b: bool) -> str:
@@ -1870,6 +2017,14 @@ def _contact_is_favorite(user_detail: models.UserDetail, ctc: models.Contact) ->
 		if groups[group.id].is_favorite: return True
 	return False
 
+MAX_SOAP_BODY_SIZE = 1024 * 1024
+SOAP_READ_CHUNK_SIZE = 64 * 1024
+USERTILE_MAX_AGE = 300
+
+_soap_stats = {} # type: Dict[str, _SOAPActionStats]
+# `_find_element` queries with several steps, as ElementPath expressions
+_ELEMENT_PATHS = {} # type: Dict[str, str]
+
 _CONTACT_PROPERTIES = (
 	'Comment', 'DisplayName', 'ContactType', 'ContactFirstName', 'ContactLastName', 'MiddleName', 'Anniversary', 'ContactBirthDate', 'ContactEmail', 'ContactLocation', 'ContactWebSite', 'ContactPrimaryEmailType', 'ContactPhone', 'GroupName',
 	'IsMessengerEnabled', 'IsMessengerUser', 'IsFavorite', 'HasSpace',
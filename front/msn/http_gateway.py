@@ -1,39 +1,38 @@
-from typing import Dict, Optional
+from typing import Dict, Iterable, Optional
 import time
 import asyncio
 from aiohttp import web
 
 from util.misc import Logger, gen_uuid
+from util.timer import Timer, TimerWheel
+from util import metrics
 from front.msn.msnp import MSNPCtrl
 
 def register(loop: asyncio.AbstractEventLoop, app: web.Application) -> None:
 	gateway_sessions = {} # type: Dict[str, GatewaySession]
 	app['gateway_sessions'] = gateway_sessions
+	metrics.registry.add_collector(lambda: _collect_metrics(gateway_sessions))
 	app.router.add_route('OPTIONS', '/gateway/gateway.dll', handle_http_gateway_options)
 	app.router.add_post('/gateway/gateway.dll', handle_http_gateway)
-	
-	loop.create_task(_clean_gateway_sessions(gateway_sessions))
 
-async def _clean_gateway_sessions(gateway_sessions: Dict[str, 'GatewaySession']) -> None:
-	while True:
-		await asyncio.sleep(10)
-		now = time.time()
-		closed = []
-		for session_id, gwsess in gateway_sessions.items():
-			if gwsess.time_last_connect + gwsess.timeout <= now:
-				gwsess.controller.close()
-				closed.append(session_id)
-		for session_id in closed:
-			del gateway_sessions[session_id]
+def _collect_metrics(gateway_sessions: Dict[str, 'GatewaySession']) -> Iterable[metrics.Family]:
+	yield metrics.gauge_family('escargot_gateway_sessions', "Open HTTP gateway sessions", { (): len(gateway_sessions) })
+
+def _expire_gateway_session(gateway_sessions: Dict[str, 'GatewaySession'], session_id: str) -> None:
+	gwsess = gateway_sessions.pop(session_id, None)
+	if gwsess is None: return
+	gwsess.expiry = None
+	gwsess.controller.close()
 
 class GatewaySession:
-	__slots__ = ('logger', 'hostname', 'controller', 'timeout', 'time_last_connect')
+	__slots__ = ('logger', 'hostname', 'controller', 'timeout', 'time_last_connect', 'expiry')
 	
 	logger: Logger
 	hostname: str
 	controller: MSNPCtrl
 	timeout: float
 	time_last_connect: float
+	expiry: Optional[Timer]
 	
 	def __init__(self, logger: Logger, hostname: str, controller: MSNPCtrl, now: float) -> None:
 		self.logger = logger
@@ -41,8 +40,17 @@ class GatewaySession:
 		self.controller = controller
 		self.timeout = 60
 		self.time_last_connect = now
+		self.expiry = None
+	
+	def refresh(self, timers: TimerWheel, gateway_sessions: Dict[str, 'GatewaySession'], session_id: str, now: float) -> None:
+		# Expires `timeout` seconds after the last request
+		self.time_last_connect = now
+		if self.expiry is not None:
+			self.expiry.cancel()
+		self.expiry = timers.call_later(self.timeout, _expire_gateway_session, gateway_sessions, session_id)
 	
 	def _on_close(self) -> None:
+		# No more requests; it's dropped from `gateway_sessions` when `expiry` fires
 		self.time_last_connect = 0
 
 async def handle_http_gateway_options(req: web.Request) -> web.Response:
@@ -81,8 +89,9 @@ async def handle_http_gateway(req: web.Request) -> web.Response:
 		controller.close_callback = tmp._on_close
 		gateway_sessions[session_id] = tmp
 	gwsess = gateway_sessions.get(session_id)
-	if gwsess is None:
+	if gwsess is None or gwsess.time_last_connect == 0:
 		raise web.HTTPBadRequest()
+	gwsess.refresh(backend.timers, gateway_sessions, session_id, now)
 	
 	assert req.transport is not None
 	gwsess.logger.log_connect()
@@ -0,0 +1,161 @@
+from typing import List, Dict, Optional, Any
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import asyncio, traceback
+
+class RSAKeyPool:
+	# Keeps a stock of pre-generated RSA keys, produced in a separate process,
+	# so handing one out never costs an RSA key generation on the event loop.
+	__slots__ = (
+		'key_size', 'target', 'max_workers', 'generated', 'hits', 'misses', 'waits',
+		'_loop', '_executor', '_keys', '_inflight', '_waiters',
+	)
+	
+	key_size: int
+	target: int
+	max_workers: int
+	generated: int
+	# `take_nowait` found a key / found the pool empty
+	hits: int
+	misses: int
+	# `take` had to wait for a key to be generated
+	waits: int
+	_loop: Optional[asyncio.AbstractEventLoop]
+	_executor: Optional[ProcessPoolExecutor]
+	_keys: List[Any]
+	_inflight: int
+	_waiters: List['asyncio.Future[Any]']
+	
+	def __init__(self, *, key_size: int = 2048, target: int = 32, max_workers: int = 1) -> None:
+		self.key_size = key_size
+		self.target = target
+		self.max_workers = max_workers
+		self.generated = 0
+		self.hits = 0
+		self.misses = 0
+		self.waits = 0
+		self._loop = None
+		self._executor = None
+		self._keys = []
+		self._inflight = 0
+		self._waiters = []
+	
+	def start(self, loop: asyncio.AbstractEventLoop) -> None:
+		self._loop = loop
+		self._executor = ProcessPoolExecutor(max_workers = self.max_workers)
+		self._refill()
+	
+	def take_nowait(self) -> Optional[Any]:
+		if not self._keys:
+			self.misses += 1
+			self._refill()
+			return None
+		self.hits += 1
+		key = self._keys.pop()
+		self._refill()
+		return key
+	
+	async def take(self) -> Any:
+		if self._keys:
+			self.hits += 1
+			key = self._keys.pop()
+			self._refill()
+			return key
+		self.waits += 1
+		if self._loop is None:
+			# Not started (e.g. scripts); fall back to generating in-process
+			return _load_key(_generate_key(self.key_size))
+		waiter = self._loop.create_future() # type: asyncio.Future[Any]
+		self._waiters.append(waiter)
+		self._refill()
+		return await waiter
+	
+	def stats(self) -> Dict[str, int]:
+		return {
+			'depth': len(self._keys), 'inflight': self._inflight, 'generated': self.generated,
+			'hits': self.hits, 'misses': self.misses, 'waits': self.waits,
+		}
+	
+	def _refill(self) -> None:
+		loop = self._loop
+		if loop is None: return
+		while len(self._keys) + self._inflight < self.target + len(self._waiters):
+			try:
+				fut = loop.run_in_executor(self._executor, _generate_key, self.key_size)
+			except BrokenProcessPool:
+				traceback.print_exc()
+				self._restart_executor(self._executor)
+				continue
+			self._inflight += 1
+			fut.add_done_callback(partial(self._on_generated, self._executor))
+	
+	def _on_generated(self, executor: Optional[ProcessPoolExecutor], fut: 'asyncio.Future[bytes]') -> None:
+		self._inflight -= 1
+		try:
+			key = _load_key(fut.result())
+		except Exception as ex:
+			traceback.print_exc()
+			if isinstance(ex, BrokenProcessPool):
+				self._restart_executor(executor)
+			# Whoever was waiting on this key gets one made on a thread instead of hanging.
+			# Not refilling here, so a broken worker can't turn into a busy loop;
+			# the next `take` will try again.
+			waiter = self._pop_waiter()
+			if waiter is not None:
+				assert self._loop is not None
+				fallback = self._loop.run_in_executor(None, _generate_key, self.key_size)
+				fallback.add_done_callback(partial(self._on_fallback_generated, waiter))
+			return
+		self.generated += 1
+		waiter = self._pop_waiter()
+		if waiter is not None:
+			waiter.set_result(key)
+			return
+		self._keys.append(key)
+	
+	def _on_fallback_generated(self, waiter: 'asyncio.Future[Any]', fut: 'asyncio.Future[bytes]') -> None:
+		try:
+			key = _load_key(fut.result())
+		except Exception as ex:
+			if not waiter.done():
+				waiter.set_exception(ex)
+			return
+		self.generated += 1
+		if waiter.done():
+			self._keys.append(key)
+		else:
+			waiter.set_result(key)
+	
+	def _restart_executor(self, executor: Optional[ProcessPoolExecutor]) -> None:
+		# A worker died, and its executor won't run anything else
+		if executor is not self._executor: return
+		if executor is not None:
+			executor.shutdown(wait = False)
+		self._executor = ProcessPoolExecutor(max_workers = self.max_workers)
+	
+	def _pop_waiter(self) -> Optional['asyncio.Future[Any]']:
+		# The oldest waiter that hasn't given up (e.g. its request was cancelled)
+		while self._waiters:
+			waiter = self._waiters.pop(0)
+			if not waiter.done():
+				return waiter
+		return None
+
+def _generate_key(key_size: int) -> bytes:
+	# Runs in the worker process; keys aren't picklable, so they travel as DER
+	from cryptography.hazmat.backends import default_backend
+	from cryptography.hazmat.primitives import serialization
+	from cryptography.hazmat.primitives.asymmetric import rsa
+	
+	key = rsa.generate_private_key(public_exponent = 65537, key_size = key_size, backend = default_backend())
+	return key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+def _load_key(der: bytes) -> Any:
+	from cryptography.hazmat.backends import default_backend
+	from cryptography.hazmat.primitives import serialization
+	
+	return serialization.load_der_private_key(der, password = None, backend = default_backend())
+
+# Keys for signing MSNP circle tickets (`msn_circleticket_sig`)
+circleticket_keys = RSAKeyPool()
@@ -12,11 +12,14 @@ import struct
 from enum import Enum, IntEnum
 
 from util.misc import first_in_iterable, last_in_iterable, date_format, DefaultDict
+from util.cache import Cache
 from typing import Optional
 
 from core import error, event
 from core.backend import Backend, BackendSession, ChatSession
-from core.models import User, Contact, GroupChat, Lst, MessageData, OIM, Substatus, NetworkID
+from core.models import User, UserStatus, Contact, GroupChat, Lst, MessageData, OIM, Substatus, NetworkID
+
+from .keypool import circleticket_keys
 
 def build_presence_notif(trid: Optional[str], ctc_head: User, user_me: User, dialect: int, backend: Backend, iln_sent: bool, *, self_presence: bool = False, bs_other: Optional['BackendSession'] = None, groupchat: Optional['GroupChat'] = None) -> Iterable[Tuple[Any, ...]]:
 	detail = user_me.detail
@@ -132,10 +135,33 @@ def build_presence_notif(trid: Optional[str], ctc_head: User, user_me: User, dia
 	
 	assert ctc_sess is not None
 	
-	msn_status = MSNStatus.FromSubstatus(status.substatus)
-	
 	if trid and dialect < 18: frst = ('ILN', trid) # type: Tuple[Any, ...]
 	else: frst = ('NLN',)
+	
+	if groupchat is None and head is not user_me:
+		# Nothing below depends on the watcher here, so everyone watching `head` on
+		# the same dialect shares one rendering until `head.presence_version` changes
+		key = (head.uuid, head.presence_version, dialect, status.substatus, status.name, status.message, status.media)
+		found, rendered = _presence_render_cache.lookup(key)
+		if not found:
+			rendered = _render_presence(head, status, user_me, dialect, backend, ctc_sess, groupchat)
+			_presence_render_cache.set(key, rendered)
+	else:
+		rendered = _render_presence(head, status, user_me, dialect, backend, ctc_sess, groupchat)
+	assert rendered is not None
+	
+	nln, ubx = rendered
+	yield (*frst, *nln)
+	if ubx is not None:
+		yield ubx
+
+def presence_render_cache_stats() -> Dict[str, int]:
+	return _presence_render_cache.stats()
+
+def _render_presence(head: User, status: UserStatus, user_me: User, dialect: int, backend: Backend, ctc_sess: 'BackendSession', groupchat: Optional['GroupChat']) -> Tuple[Tuple[Any, ...], Optional[Tuple[Any, ...]]]:
+	# Returns the `NLN`/`ILN` arguments following the command (and trid), and the `UBX` command if any
+	msn_status = MSNStatus.FromSubstatus(status.substatus)
+	
 	rst = []
 	
 	if 8 <= dialect <= 15:
@@ -146,24 +172,25 @@ def build_presence_notif(trid: Optional[str], ctc_head: User, user_me: User, dia
 		rst.append(encode_msnobj(ctc_sess.front_data.get('msn_msnobj') or '<msnobj/>'))
 	
 	if dialect >= 18:
-		yield (*frst, msn_status.name, encode_email_networkid(head.email, None, groupchat = groupchat), status.name, *rst)
+		nln = (msn_status.name, encode_email_networkid(head.email, None, groupchat = groupchat), status.name, *rst) # type: Tuple[Any, ...]
 	else:
-		yield (*frst, msn_status.name, head.email, (int(NetworkID.WINDOWS_LIVE) if 14 <= dialect <= 17 else None), status.name, *rst)
+		nln = (msn_status.name, head.email, (int(NetworkID.WINDOWS_LIVE) if 14 <= dialect <= 17 else None), status.name, *rst)
 	
 	if dialect < 11:
-		return
+		return nln, None
 	
 	if dialect >= 18 and (groupchat is not None and head.uuid == user_me.uuid):
-		return
+		return nln, None
 	
 	ubx_payload = '<Data><PSM>{}</PSM><CurrentMedia>{}</CurrentMedia>{}</Data>'.format(
 		(encode_xml_he(status.message, dialect) if dialect >= 13 else encode_xml_ne(status.message)) or '', (encode_xml_he(status.media, dialect) if dialect >= 13 else encode_xml_ne(status.media)) or '', extend_ubx_payload(dialect, backend, user_me, ctc_sess)
 	).encode('utf-8')
 	
 	if dialect >= 18:
-		yield ('UBX', encode_email_networkid(head.email, None, groupchat = groupchat), ubx_payload)
+		ubx = ('UBX', encode_email_networkid(head.email, None, groupchat = groupchat), ubx_payload) # type: Tuple[Any, ...]
 	else:
-		yield ('UBX', head.email, (int(NetworkID.WINDOWS_LIVE) if 14 <= dialect <= 17 else None), ubx_payload)
+		ubx = ('UBX', head.email, (int(NetworkID.WINDOWS_LIVE) if 14 <= dialect <= 17 else None), ubx_payload)
+	return nln, ubx
 
 def encode_email_networkid(email: str, networkid: Optional[NetworkID], *, groupchat: Optional['GroupChat'] = None) -> str:
 	result = '{}:{}'.format(int(networkid or NetworkID.WINDOWS_LIVE), email)
@@ -266,6 +293,10 @@ def _list_private_endpoint_data(ctc_sess: 'BackendSession') -> str:
 	
 	return ped_data
 
+async def ensure_circleticket_key(bs: BackendSession) -> None:
+	if bs.front_data.get('msn_circleticket_sig') is None:
+		bs.front_data['msn_circleticket_sig'] = await circleticket_keys.take()
+
 def gen_signedticket_xml(bs: BackendSession, backend: Backend) -> str:
 	from cryptography.hazmat.primitives import hashes
 	from cryptography.hazmat.primitives.asymmetric import padding
@@ -332,7 +363,7 @@ def gen_mail_data(user: User, backend: Backend, *, oim: Optional[OIM] = None, ju
 		md_m_pl += M_MAIL_DATA_PAYLOAD.format(
 			rt = (RT_M_MAIL_DATA_PAYLOAD.format(
 				senttime = date_format(oim.sent)
-			) if not just_sent else ''), oimsz = len(format_oim(oim)),
+			) if not just_sent else ''), oimsz = _format_oim_size(oim),
 			frommember = oim.from_email, guid = oim.uuid, fid = ('00000000-0000-0000-0000-000000000009' if not just_sent else '.!!OIM'),
 			fromfriendly = (_encode_friendly(oim.from_friendly, oim.from_friendly_charset, oim.from_friendly_encoding, space = True if just_sent else False) if oim.from_friendly is not None else ''),
 			su = ('<SU> </SU>' if just_sent else ''),
@@ -345,6 +376,14 @@ def gen_mail_data(user: User, backend: Backend, *, oim: Optional[OIM] = None, ju
 	)
 
 def format_oim(oim: OIM) -> str:
+	assert oim.message is not None
+	return _format_oim_head(oim) + '\r\n\r\n' + base64.b64encode(oim.message.encode('utf-8')).decode('utf-8')
+
+def _format_oim_size(oim: OIM) -> int:
+	# `len(format_oim(oim))`, without needing the message loaded
+	return len(_format_oim_head(oim)) + 4 + 4 * ((oim.size + 2) // 3)
+
+def _format_oim_head(oim: OIM) -> str:
 	if not oim.headers:
 		oim_headers = OIM_HEADER_BASE.format(run_id = '{' + oim.run_id + '}').replace('\n', '\r\n')
 	else:
@@ -368,8 +407,6 @@ def format_oim(oim: OIM) -> str:
 		pst2 = sent_email.strftime('%d %b %Y %H:%M:%S -0800'),
 	).replace('\n', '\r\n')
 	
-	oim_msg += '\r\n\r\n' + base64.b64encode(oim.message.encode('utf-8')).decode('utf-8')
-	
 	return oim_msg
 
 def _datetime_to_filetime(dt_time: datetime) -> str:
@@ -600,3 +637,6 @@ class Err:
 		if isinstance(exc, error.NotAllowedWhileHDN):
 			return cls.NotAllowedWhileHDN
 		raise ValueError("Exception not convertible to MSNP error") from exc
+
+PRESENCE_RENDER_CACHE_SIZE = 20000
+_presence_render_cache = Cache(maxsize = PRESENCE_RENDER_CACHE_SIZE) # type: Cache[Tuple[Any, ...], Tuple[Tuple[Any, ...], Optional[Tuple[Any, ...]]]]
@@ -1,13 +1,13 @@
-import io
 from abc import ABCMeta, abstractmethod
 import asyncio
-from typing import List, Tuple, Any, Optional, Callable, Iterable, Sequence
+from typing import Dict, List, Tuple, Any, Optional, Callable, Iterable, Sequence, ClassVar
 from urllib.parse import unquote
 
 from util.misc import Logger
+from util.dispatch import CommandTable
 
 class MSNPCtrl(metaclass = ABCMeta):
-	__slots__ = ('logger', 'reader', 'writer', 'peername', 'closed', 'close_callback', 'transport')
+	__slots__ = ('logger', 'reader', 'writer', 'peername', 'closed', 'close_callback', 'transport', '_flush_scheduled')
 	
 	logger: Logger
 	reader: 'MSNPReader'
@@ -16,6 +16,16 @@ class MSNPCtrl(metaclass = ABCMeta):
 	close_callback: Optional[Callable[[], None]]
 	closed: bool
 	transport: Optional[asyncio.WriteTransport]
+	_flush_scheduled: bool
+	
+	# Label for this controller's commands in `metrics`
+	frontend_name = 'msnp'
+	# `_m_*` handlers by command, built for each subclass
+	commands: ClassVar[CommandTable]
+	
+	def __init_subclass__(cls, **kwargs: Any) -> None:
+		super().__init_subclass__(**kwargs) # type: ignore
+		cls.commands = CommandTable(cls, cls.frontend_name, '_m_', str.upper)
 	
 	def __init__(self, logger: Logger) -> None:
 		self.logger = logger
@@ -25,28 +35,49 @@ class MSNPCtrl(metaclass = ABCMeta):
 		self.close_callback = None
 		self.closed = False
 		self.transport = None
+		self._flush_scheduled = False
 	
 	@abstractmethod
 	def on_connect(self) -> None: pass
 	
 	def data_received(self, transport: asyncio.BaseTransport, data: bytes) -> None:
 		self.peername = transport.get_extra_info('peername')
-		for m in self.reader.data_received(data):
-			try:
-				f = getattr(self, '_m_{}'.format(m[0].lower()))
-				f(*m[1:])
-			except Exception as ex:
-				self.logger.error(ex)
+		commands = self.commands
+		try:
+			for m in self.reader.data_received(data):
+				if not commands.dispatch(self, m[0].upper(), m[1:]):
+					self.logger.info("unknown command", m[0])
+		except MSNPFrameError as ex:
+			self.logger.error(ex)
+			self.close(hard = True)
 	
 	def send_reply(self, *m: Any) -> None:
 		self.writer.write(m)
-		transport = self.transport
-		if transport is not None:
-			transport.write(self.flush())
+		self._schedule_flush()
+	
+	def send_raw(self, data: bytes) -> None:
+		# Already-encoded commands, e.g. a shared `SYN` reply
+		self.writer.write_raw(data)
+		self._schedule_flush()
 	
 	def flush(self) -> bytes:
 		return self.writer.flush()
 	
+	def _schedule_flush(self) -> None:
+		# With no transport (while `ListenerMSNP.data_received` runs, or for gateway sessions)
+		# the owner flushes; otherwise everything sent in this loop turn goes out in one write.
+		if self.transport is not None and not self._flush_scheduled:
+			self._flush_scheduled = True
+			asyncio.get_event_loop().call_soon(self._flush_to_transport)
+	
+	def _flush_to_transport(self) -> None:
+		self._flush_scheduled = False
+		transport = self.transport
+		if transport is None: return
+		data = self.flush()
+		if data:
+			transport.write(data)
+	
 	def _m_out(self) -> None:
 		self.close()
 	
@@ -58,6 +89,8 @@ class MSNPCtrl(metaclass = ABCMeta):
 				self.send_reply('OUT', 'SSD')
 			else:
 				self.send_reply('OUT')
+		# Anything pending has to go out before `close_callback` closes the transport
+		self._flush_to_transport()
 		if self.close_callback:
 			self.close_callback()
 		self._on_close()
@@ -66,99 +99,148 @@ class MSNPCtrl(metaclass = ABCMeta):
 	def _on_close(self) -> None: pass
 
 class MSNPWriter:
-	__slots__ = ('_logger', '_buf')
+	__slots__ = ('_logger', '_chunks')
 	
 	_logger: Logger
-	_buf: io.BytesIO
+	_chunks: List[bytes]
 	
 	def __init__(self, logger: Logger) -> None:
 		self._logger = logger
-		self._buf = io.BytesIO()
+		self._chunks = []
 	
 	def write(self, m: Iterable[Any]) -> None:
-		m = list(m)
-		data = None
-		if isinstance(m[-1], bytes):
-			data = m[-1]
-			m[-1] = len(data)
-		mt = tuple(str(x).replace(' ', '%20') for x in m if x is not None)
+		mt, data = _prepare_command(m)
 		_truncated_log(self._logger, '<<<', mt)
-		w = self._buf.write
-		w(' '.join(mt).encode('utf-8'))
-		w(b'\r\n')
+		self._chunks.append(_encode_line(mt))
 		if data is not None:
-			w(data)
-			print(data)
+			self._chunks.append(data)
+	
+	def write_raw(self, data: bytes) -> None:
+		self._chunks.append(data)
 	
 	def flush(self) -> bytes:
-		data = self._buf.getvalue()
-		if data:
-			self._buf = io.BytesIO()
+		if not self._chunks: return b''
+		data = b''.join(self._chunks)
+		self._chunks = []
 		return data
 
+def encode_command(m: Iterable[Any]) -> bytes:
+	# A command as `MSNPWriter.write` sends it, for replies that go out unchanged to many connections (see `MSNPCtrl.send_raw`)
+	mt, data = _prepare_command(m)
+	line = _encode_line(mt)
+	if data is None:
+		return line
+	return line + data
+
+def _prepare_command(m: Iterable[Any]) -> Tuple[Tuple[str, ...], Optional[bytes]]:
+	# A trailing `bytes` payload is sent after the line, with its length as the last argument
+	m = list(m)
+	data = None
+	if isinstance(m[-1], bytes):
+		data = m[-1]
+		m[-1] = len(data)
+	return tuple(_encode_arg(x) for x in m if x is not None), data
+
+def _encode_line(mt: Tuple[str, ...]) -> bytes:
+	prefix = _COMMAND_PREFIXES.get(mt[0])
+	if prefix is None:
+		prefix = mt[0].encode('utf-8')
+		_COMMAND_PREFIXES[mt[0]] = prefix
+	line = prefix
+	if len(mt) > 1:
+		line += b' ' + ' '.join(mt[1:]).encode('utf-8')
+	return line + b'\r\n'
+
+def _encode_arg(x: Any) -> str:
+	if type(x) is not str:
+		x = str(x)
+	if ' ' in x:
+		x = x.replace(' ', '%20')
+	return x
+
 class MSNPReader:
-	__slots__ = ('logger', '_data', '_i')
+	# Buffers incoming data in one `bytearray` with a read offset; consumed bytes are only
+	# dropped once they make up most of the buffer, so a payload arriving in many small
+	# segments is copied a constant number of times rather than once per segment.
+	__slots__ = ('logger', 'max_frame_size', '_buf', '_pos', '_pending')
 	
 	logger: Logger
-	_data: bytes
-	_i: int
+	max_frame_size: int
+	_buf: bytearray
+	_pos: int
+	# (command, payload start, payload length) of a payload command still waiting on its body
+	_pending: Optional[Tuple[List[str], int, int]]
 	
-	def __init__(self, logger: Logger) -> None:
+	def __init__(self, logger: Logger, *, max_frame_size: Optional[int] = None) -> None:
 		self.logger = logger
-		self._data = b''
-		self._i = 0
+		self.max_frame_size = (MAX_FRAME_SIZE if max_frame_size is None else max_frame_size)
+		self._buf = bytearray()
+		self._pos = 0
+		self._pending = None
 	
 	def data_received(self, data: bytes) -> Iterable[List[Any]]:
-		if self._data:
-			self._data += data
-		else:
-			self._data = data
-		while self._data:
-			m = self._read_msnp()
-			if m is None: break
-			yield m
+		self._buf += data
+		try:
+			while True:
+				m = self._read_msnp()
+				if m is None: break
+				yield m
+		finally:
+			self._compact()
 	
 	def _read_msnp(self) -> Optional[List[Any]]:
-		try:
-			m, body, e = _msnp_try_decode(self._data, self._i)
-		except AssertionError:
+		buf = self._buf
+		pending = self._pending
+		if pending is None:
+			while True:
+				i = self._pos
+				e = buf.find(b'\n', i)
+				if e < 0:
+					if len(buf) - i > self.max_frame_size:
+						raise MSNPFrameError("command line longer than {} bytes".format(self.max_frame_size))
+					return None
+				e += 1
+				m = buf[i:e].decode('utf-8').split()
+				self._pos = e
+				# Stray blank lines are skipped rather than stalling the connection
+				if m: break
+			body_len = 0
+			if m[0] in _PAYLOAD_COMMANDS:
+				body_len = int(m.pop())
+				if body_len < 0 or e - i + body_len > self.max_frame_size:
+					raise MSNPFrameError("{} payload of {} bytes exceeds limit".format(m[0], body_len))
+			pending = (m, e, body_len)
+		
+		m, b, n = pending
+		if b + n > len(buf):
+			self._pending = pending
 			return None
-		except Exception:
-			print("ERR _read_msnp", self._i, self._data)
-			raise
+		self._pending = None
 		
-		self._data = self._data[e:]
-		self._i = 0
 		_truncated_log(self.logger, '>>>', m)
-		m = [unquote(x) for x in m]
-		if body:
-			m.append(body)
-			print(body)
-		return m
-	
-	def _read_raw(self, n: int) -> bytes:
-		i = self._i
-		e = i + n
-		assert e <= len(self._data)
-		self._i += n
-		return self._data[i:e]
+		args = [unquote(x) for x in m] # type: List[Any]
+		if n:
+			args.append(bytes(memoryview(buf)[b:b + n]))
+		self._pos = b + n
+		return args
+	
+	def _compact(self) -> None:
+		pos = self._pos
+		if pos == 0: return
+		buf = self._buf
+		if pos >= len(buf):
+			buf.clear()
+		elif pos >= COMPACT_MIN_BYTES and pos * 2 >= len(buf):
+			del buf[:pos]
+		else:
+			return
+		self._pos = 0
+		pending = self._pending
+		if pending is not None:
+			self._pending = (pending[0], pending[1] - pos, pending[2])
 
-def _msnp_try_decode(d: bytes, i: int) -> Tuple[List[Any], Optional[bytes], int]:
-	# Try to parse an MSNP message from buffer `d` starting at index `i`
-	# Returns (parsed message, end index)
-	e = d.find(b'\n', i)
-	assert e >= 0
-	e += 1
-	m_str = d[i:e].decode('utf-8').strip()
-	assert len(m_str) > 1
-	m = m_str.split()
-	body = None
-	if m[0] in _PAYLOAD_COMMANDS:
-		n = int(m.pop())
-		assert e+n <= len(d)
-		body = d[e:e+n]
-		e += n
-	return m, body, e
+class MSNPFrameError(Exception):
+	pass
 
 _PAYLOAD_COMMANDS = {
 	'UUX', 'MSG', 'QRY', 'NOT', 'ADL', 'FQY', 'RML', 'UUN', 'UUM', 'PUT', 'DEL', 'SDG',
@@ -171,3 +253,10 @@ def _truncated_log(logger: Logger, pre: str, m: Sequence[Any]) -> None:
 		logger.info(pre, *m[:-1], '<truncated>')
 	else:
 		logger.info(pre, *m)
+
+# Encoded command names, shared by all writers
+_COMMAND_PREFIXES = {} # type: Dict[Any, bytes]
+# Longest command line plus payload accepted from a client
+MAX_FRAME_SIZE = 1024 * 1024
+# Consumed bytes kept at the front of the read buffer before it gets compacted
+COMPACT_MIN_BYTES = 64 * 1024
@@ -1,4 +1,4 @@
-from typing import Tuple, Dict, Any, Optional, List
+from typing import Tuple, Dict, Any, Optional, List, Iterable
 from datetime import datetime
 from lxml.etree import fromstring as parse_xml, XMLSyntaxError
 import base64
@@ -13,6 +13,8 @@ import binascii
 import struct
 
 from util.misc import Logger, gen_uuid, first_in_iterable, arbitrary_decode, date_format, MultiDict
+from util.cache import Cache
+from util.timer import Timer
 import settings
 
 from core import event
@@ -20,7 +22,8 @@ from core.backend import Backend, BackendSession, Chat, ChatSession
 from core.models import Substatus, Lst, NetworkID, User, OIM, GroupChat, GroupChatRole, Contact, TextWithData, MessageData, MessageType, LoginOption
 from core.client import Client
 
-from .msnp import MSNPCtrl
+from .msnp import MSNPCtrl, MSNPWriter
+from .keypool import circleticket_keys
 from .misc import build_presence_notif, cid_format, encode_msnobj, encode_payload, decode_capabilities_capabilitiesex, decode_email_networkid, encode_email_networkid, decode_email_pop, gen_mail_data, gen_chal_response, gen_signedticket_xml, generate_rps_key, encrypt_with_key_and_iv_tripledes_cbc, Err, MSNStatus
 
 MSNP_DIALECTS = ['MSNP{}'.format(d) for d in (
@@ -32,7 +35,7 @@ MSNP_DIALECTS = ['MSNP{}'.format(d) for d in (
 )]
 
 class MSNPCtrlNS(MSNPCtrl):
-	__slots__ = ('backend', 'dialect', 'usr_email', 'bs', 'client', 'syn_ser', 'gcf_sent', 'syn_sent', 'iln_sent', 'challenge', 'rps_challenge', 'initial_adl_sent', 'circle_adl_sent')
+	__slots__ = ('backend', 'dialect', 'usr_email', 'bs', 'client', 'syn_ser', 'gcf_sent', 'syn_sent', 'iln_sent', 'challenge', 'rps_challenge', 'initial_adl_sent', 'circle_adl_sent', 'time_last_activity', 'idle_timer')
 	
 	backend: Backend
 	dialect: int
@@ -47,6 +50,10 @@ class MSNPCtrlNS(MSNPCtrl):
 	rps_challenge: Optional[bytes]
 	initial_adl_sent: bool
 	circle_adl_sent: bool
+	time_last_activity: float
+	idle_timer: Optional[Timer]
+	
+	frontend_name = 'msnp-ns'
 	
 	def __init__(self, logger: Logger, via: str, backend: Backend) -> None:
 		super().__init__(logger)
@@ -63,13 +70,31 @@ class MSNPCtrlNS(MSNPCtrl):
 		self.rps_challenge = None
 		self.initial_adl_sent = False
 		self.circle_adl_sent = False
+		self.time_last_activity = backend.loop.time()
+		self.idle_timer = None
 	
 	def _on_close(self) -> None:
+		if self.idle_timer is not None:
+			self.idle_timer.cancel()
+			self.idle_timer = None
 		if self.bs:
 			self.bs.close()
 	
 	def on_connect(self) -> None:
-		pass
+		self.idle_timer = self.backend.timers.call_later(IDLE_TIMEOUT, self._on_idle_timeout)
+	
+	def data_received(self, transport: asyncio.BaseTransport, data: bytes) -> None:
+		self.time_last_activity = self.backend.loop.time()
+		super().data_received(transport, data)
+	
+	def _on_idle_timeout(self) -> None:
+		# Re-armed for whatever's left instead of being pushed back on every command
+		self.idle_timer = None
+		idle = self.backend.loop.time() - self.time_last_activity
+		if idle < IDLE_TIMEOUT:
+			self.idle_timer = self.backend.timers.call_later(IDLE_TIMEOUT - idle, self._on_idle_timeout)
+			return
+		self.close(hard = True)
 	
 	# State = Auth
 	
@@ -274,7 +299,7 @@ class MSNPCtrlNS(MSNPCtrl):
 							# Only check the # of args since people could connect from either patched `msidcrl40.dll` or vanilla `msidcrl40.dll`
 							if 2 <= len(args) <= 3:
 								machineguid = (args[2] if len(args) >= 3 else args[1])
-						
+							
 							if machineguid is not None and not re.match(r'^\{?[A-Fa-f0-9]{8,8}-([A-Fa-f0-9]{4,4}-){3,3}[A-Fa-f0-9]{12,12}\}?', machineguid):
 								self.send_reply(Err.AuthFail, trid)
 								self.close(hard = True)
@@ -311,9 +336,6 @@ class MSNPCtrlNS(MSNPCtrl):
 		self.close(hard = True)
 	
 	def _util_usr_final(self, trid: str, token: str, machineguid: Optional[str]) -> None:
-		from cryptography.hazmat.backends import default_backend
-		from cryptography.hazmat.primitives.asymmetric import rsa
-		
 		bs = self.bs
 		
 		if bs is None:
@@ -323,10 +345,14 @@ class MSNPCtrlNS(MSNPCtrl):
 		
 		self.backend.util_set_sess_token(bs, token)
 		
-		bs.front_data['msn_circleticket_sig'] = rsa.generate_private_key(public_exponent = 65537, key_size = 2048, backend = default_backend())
-		
 		dialect = self.dialect
 		
+		if dialect >= 18:
+			# Only take one if it's ready; otherwise `ensure_circleticket_key` waits for one when the ticket is first needed
+			circleticket_sig = circleticket_keys.take_nowait()
+			if circleticket_sig is not None:
+				bs.front_data['msn_circleticket_sig'] = circleticket_sig
+		
 		user = bs.user
 		
 		if dialect < 10:
@@ -407,91 +433,130 @@ class MSNPCtrlNS(MSNPCtrl):
 		assert bs is not None
 		
 		user = bs.user
-		settings = user.settings
 		detail = user.detail
 		assert detail is not None
 		
-		contacts = detail.contacts
+		if dialect >= 13:
+			self.send_reply(Err.CommandDisabled, trid)
+			return
+		
+		if detail.list_version == 0:
+			# Never handed out, so a client can't have this list cached yet
+			bs.backend._mark_modified(user, list_changed = True)
+		version = detail.list_version
 		
 		if dialect < 10:
 			self.syn_ser = int(extra[0])
-			ser = self._ser()
+			if self.syn_ser == version:
+				# Client's cached list is current
+				self.send_reply('SYN', trid, version)
+				self.syn_sent = True
+				return
+		else:
+			timestamp = _list_version_timestamp(version)
+			if extra[:2] == (timestamp, timestamp):
+				self.send_reply('SYN', trid, timestamp, timestamp)
+				self.syn_sent = True
+				return
+		
+		key = (user.uuid, version, _syn_dialect_band(dialect))
+		found, parts = _syn_cache.lookup(key)
+		if not found:
+			writer = MSNPWriter(self.logger)
+			for m in self._syn_full(_SYN_TRID_MARKER, version):
+				writer.write(m)
+			parts = writer.flush().split(_SYN_TRID_MARKER.encode('utf-8'))
+			_syn_cache.set(key, parts)
+		assert parts is not None
+		self.send_raw(trid.encode('utf-8').join(parts))
+		self.syn_sent = True
+	
+	def _syn_full(self, trid: str, version: int) -> Iterable[Tuple[Any, ...]]:
+		# Full list transfer for `SYN`; only depends on the list (see `UserDetail.list_version`)
+		# and the dialect band, so the encoded result is shared between connections.
+		bs = self.bs
+		dialect = self.dialect
+		assert bs is not None
+		user = bs.user
+		settings = user.settings
+		detail = user.detail
+		assert detail is not None
+		contacts = detail.contacts
+		
+		if dialect < 10:
+			ser = version
 			if dialect < 7:
-				self.send_reply('SYN', trid, ser)
+				yield ('SYN', trid, ser)
 				for lst in (Lst.FL, Lst.AL, Lst.BL, Lst.RL):
 					cs = [c for c in contacts.values() if c.lists & lst]
 					if cs:
 						for i, c in enumerate(cs):
-							self.send_reply('LST', trid, lst.name, ser, len(cs), i + 1, c.head.email, c.status.name or c.head.email)
+							yield ('LST', trid, lst.name, ser, len(cs), i + 1, c.head.email, c.status.name or c.head.email)
 					else:
-						self.send_reply('LST', trid, lst.name, ser, 0, 0)
-				self.send_reply('GTC', trid, ser, settings.get('GTC', 'A'))
-				self.send_reply('BLP', trid, ser, settings.get('BLP', 'AL'))
+						yield ('LST', trid, lst.name, ser, 0, 0)
+				yield ('GTC', trid, ser, settings.get('GTC', 'A'))
+				yield ('BLP', trid, ser, settings.get('BLP', 'AL'))
 			elif dialect == 7:
-				self.send_reply('SYN', trid, ser)
+				yield ('SYN', trid, ser)
 				num_groups = len(detail._groups_by_id.values()) + 1
-				self.send_reply('LSG', trid, ser, 1, num_groups, '0', "Other Contacts", 0)
+				yield ('LSG', trid, ser, 1, num_groups, '0', "Other Contacts", 0)
 				for i, g in enumerate(detail._groups_by_id.values()):
-					self.send_reply('LSG', trid, ser, i + 2, num_groups, g.id, g.name, 0)
+					yield ('LSG', trid, ser, i + 2, num_groups, g.id, g.name, 0)
 				for lst in (Lst.FL, Lst.AL, Lst.BL, Lst.RL):
 					cs = [c for c in contacts.values() if c.lists & lst]
 					if cs:
 						for i, c in enumerate(cs):
 							gs = ((','.join([group.id for group in c._groups.copy()]) or '0') if lst == Lst.FL else None)
-							self.send_reply('LST', trid, lst.name, ser, i + 1, len(cs), c.head.email, c.status.name or c.head.email, gs)
+							yield ('LST', trid, lst.name, ser, i + 1, len(cs), c.head.email, c.status.name or c.head.email, gs)
 							for bpr_setting in ('PHH','PHM','PHW','MOB'):
 								bpr_value = c.head.settings.get(bpr_setting)
 								if bpr_value:
-									self.send_reply('BPR', bpr_setting, bpr_value)
+									yield ('BPR', bpr_setting, bpr_value)
 					else:
-						self.send_reply('LST', trid, lst.name, ser, 0, 0)
-				self.send_reply('GTC', trid, ser, settings.get('GTC', 'A'))
-				self.send_reply('BLP', trid, ser, settings.get('BLP', 'AL'))
+						yield ('LST', trid, lst.name, ser, 0, 0)
+				yield ('GTC', trid, ser, settings.get('GTC', 'A'))
+				yield ('BLP', trid, ser, settings.get('BLP', 'AL'))
 			else:
 				num_groups = len(detail._groups_by_id.values()) + 1
-				self.send_reply('SYN', trid, ser, len(contacts), num_groups)
-				self.send_reply('GTC', settings.get('GTC', 'A'))
-				self.send_reply('BLP', settings.get('BLP', 'AL'))
+				yield ('SYN', trid, ser, len(contacts), num_groups)
+				yield ('GTC', settings.get('GTC', 'A'))
+				yield ('BLP', settings.get('BLP', 'AL'))
 				for prp_setting in ('PHH','PHW','PHM','MOB','MBE'):
 					prp_value = settings.get(prp_setting)
 					if prp_value:
-						self.send_reply('PRP', prp_setting, prp_value)
-				self.send_reply('PRP', 'MFN', user.status.name)
-				self.send_reply('LSG', '0', "Other Contacts", 0)
+						yield ('PRP', prp_setting, prp_value)
+				yield ('PRP', 'MFN', user.status.name)
+				yield ('LSG', '0', "Other Contacts", 0)
 				for g in detail._groups_by_id.values():
-					self.send_reply('LSG', g.id, g.name, 0)
+					yield ('LSG', g.id, g.name, 0)
 				for c in contacts.values():
-					self.send_reply('LST', c.head.email, c.status.name or c.head.email, int(c.lists), ','.join([group.id for group in c._groups.copy()]) or '0')
+					yield ('LST', c.head.email, c.status.name or c.head.email, int(c.lists), ','.join([group.id for group in c._groups.copy()]) or '0')
 					for bpr_setting in ('PHH','PHM','PHW','MOB'):
 						bpr_value = c.head.settings.get(bpr_setting)
 						if bpr_value:
-							self.send_reply('BPR', bpr_setting, bpr_value)
-			self.syn_sent = True
-		elif 10 <= self.dialect <= 12:
-			self.send_reply('SYN', trid, TIMESTAMP, TIMESTAMP, len(contacts), len(detail._groups_by_id.values()))
-			self.send_reply('GTC', settings.get('GTC', 'A'))
-			self.send_reply('BLP', settings.get('BLP', 'AL'))
+							yield ('BPR', bpr_setting, bpr_value)
+		else:
+			timestamp = _list_version_timestamp(version)
+			yield ('SYN', trid, timestamp, timestamp, len(contacts), len(detail._groups_by_id.values()))
+			yield ('GTC', settings.get('GTC', 'A'))
+			yield ('BLP', settings.get('BLP', 'AL'))
 			for prp_setting in ('PHH','PHW','PHM','MOB','MBE'):
 				prp_value = settings.get(prp_setting)
 				if prp_value:
-					self.send_reply('PRP', prp_setting, prp_value)
-			self.send_reply('PRP', 'MFN', user.status.name)
+					yield ('PRP', prp_setting, prp_value)
+			yield ('PRP', 'MFN', user.status.name)
 			
 			for g in detail._groups_by_id.values():
-				self.send_reply('LSG', g.name, (g.id if self.dialect == 10 else g.uuid))
+				yield ('LSG', g.name, (g.id if dialect == 10 else g.uuid))
 			for c in contacts.values():
 				#if self.backend.util_msn_is_circle_user(c.head.uuid):
-				self.send_reply('LST', 'N={}'.format(c.head.email), 'F={}'.format(c.status.name or c.head.email), 'C={}'.format(c.head.uuid),
-					int(c.lists), (None if dialect < 12 else '1'), ','.join([(group.id if self.dialect == 10 else group.uuid) for group in c._groups.copy()])
+				yield ('LST', 'N={}'.format(c.head.email), 'F={}'.format(c.status.name or c.head.email), 'C={}'.format(c.head.uuid),
+					int(c.lists), (None if dialect < 12 else '1'), ','.join([(group.id if dialect == 10 else group.uuid) for group in c._groups.copy()])
 				)
 				for bpr_setting in ('PHH','PHM','PHW','MOB'):
 					bpr_value = c.head.settings.get(bpr_setting)
 					if bpr_value:
-						self.send_reply('BPR', bpr_setting, bpr_value)
-			self.syn_sent = True
-		else:
-			self.send_reply(Err.CommandDisabled, trid)
-			return
+						yield ('BPR', bpr_setting, bpr_value)
 	
 	def _m_gcf(self, trid: str, filename: str) -> None:
 		if self.dialect < 11:
@@ -701,7 +766,7 @@ class MSNPCtrlNS(MSNPCtrl):
 						self.circle_adl_sent = True
 					
 					if circle_mode:
-						if backend.user_service.get_groupchat(chat_id or '') is None:
+						if chat_id not in backend.user_service.get_groupchat_ids(user):
 							self.send_reply(Err.InvalidCircleMembership, trid)
 							return
 			
@@ -1601,21 +1666,23 @@ class MSNPCtrlNS(MSNPCtrl):
 		backend = self.backend
 		
 		self.challenge = str(secrets.randbelow(89999999999999999999) + 10000000000000000000)
-		backend.loop.create_task(self._check_qry_sent(trid))
+		backend.timers.call_later(QRY_TIMEOUT, self._check_qry_sent, trid)
 		self.send_reply('CHL', 0, self.challenge)
 	
-	async def _check_qry_sent(self, trid: str) -> None:
-		await asyncio.sleep(50)
-		
-		if self.challenge:
+	def _check_qry_sent(self, trid: str) -> None:
+		if self.challenge and not self.closed:
 			self.send_reply(Err.ChallengeResponseFailed, trid)
 			self.close(hard = True)
 	
 	def _ser(self) -> Optional[int]:
+		# The backend has already bumped the list version for whatever this reply is about
 		if self.dialect >= 10:
 			return None
-		self.syn_ser += 1
-		return self.syn_ser
+		bs = self.bs
+		assert bs is not None
+		detail = bs.user.detail
+		assert detail is not None
+		return detail.list_version
 
 class BackendEventHandler(event.BackendEventHandler):
 	__slots__ = ('ctrl',)
@@ -1868,7 +1935,7 @@ class GroupChatEventHandler(event.ChatEventHandler):
 		users = ''
 		
 		for cs1 in chat.get_roster_single():
-			if not cs1.joined or (cs1.user.status.is_offlineish() and cs1.user not in (user,cs_other.user)): continue
+			if not chat.is_user_joined(cs1.user) or (cs1.user.status.is_offlineish() and cs1.user not in (user,cs_other.user)): continue
 			users += CIRCLE_USER.format(email = cs1.user.email)
 		
 		roster = CIRCLE_ROSTER.format(users = users)
@@ -1899,6 +1966,19 @@ def _split_email_put(email: str) -> Tuple[str, NetworkID, Optional[str]]:
 			epid = email_epid[1][6:-1]
 	return (email, networkid, epid)
 
+def syn_cache_stats() -> Dict[str, int]:
+	return _syn_cache.stats()
+
+def _list_version_timestamp(version: int) -> str:
+	# MSNP10+ carries the list version as a timestamp; it's seeded from the clock anyway
+	return datetime.utcfromtimestamp(version).strftime('%Y-%m-%dT%H:%M:%S.0-00:00')
+
+def _syn_dialect_band(dialect: int) -> int:
+	# Dialects that produce byte-identical full `SYN` replies
+	if dialect < 7: return 6
+	if dialect < 10: return (7 if dialect == 7 else 8)
+	return dialect
+
 def _encode_email_epid(email: str, pop_id: Optional[str]) -> str:
 	result = email
 	
@@ -2072,7 +2152,14 @@ CIRCLE_ROSTER = '<roster><id>IM</id>{users}</roster>'
 CIRCLE_USER = '<user><id>1:{email}</id></user>'
 
 CIRCLE_PRESENCE = '<circle><props><presence dtype="xml"><Data><UTL></UTL><MFN>{friendly}</MFN><PSM>{psm}</PSM><CurrentMedia>{cm}</CurrentMedia></Data></presence></props>{roster}</circle>'
-TIMESTAMP = '2000-01-01T00:00:00.0-00:00'
+
+# Clients `PNG` about once a minute (see `_m_png`), so this only catches dead connections
+IDLE_TIMEOUT = 300
+QRY_TIMEOUT = 50
+# Full `SYN` replies, encoded once per (user, list version, dialect band); the trid is spliced in per request
+SYN_CACHE_SIZE = 2000
+_SYN_TRID_MARKER = '\x00TRID\x00'
+_syn_cache = Cache(maxsize = SYN_CACHE_SIZE) # type: Cache[Tuple[str, int, int], List[bytes]]
 
 _QRY_ID_CODES = {
 	# MSNP6 - 9
@@ -1,4 +1,4 @@
-from typing import Tuple, Any, Optional, List, Set, TYPE_CHECKING
+from typing import Tuple, Any, Optional, List, Set
 import time
 import re
 import secrets
@@ -6,45 +6,43 @@ import asyncio
 from email.parser import Parser
 
 from util.misc import Logger, first_in_iterable
+from util.timer import Timer
 from core.models import User, MessageData, MessageType
 from core.backend import Backend, BackendSession, ChatSession, Chat
 from core import event, error
 from .misc import Err, encode_capabilities_capabilitiesex, decode_email_pop, encode_email_pop, MAX_CAPABILITIES_BASIC
-from .msnp import MSNPCtrl
-
-if TYPE_CHECKING:
-	VoidTaskType = asyncio.Task[None]
-else:
-	VoidTaskType = Any
+from .msnp import MSNPCtrl, encode_command
 
 class MSNPCtrlSB(MSNPCtrl):
-	__slots__ = ('backend', 'dialect', 'loop', 'counter_task', 'auth_sent', 'bs', 'cs')
+	__slots__ = ('backend', 'dialect', 'loop', 'auth_timer', 'auth_sent', 'bs', 'cs')
 	
 	backend: Backend
 	dialect: int
 	loop: asyncio.AbstractEventLoop
-	counter_task: Optional[VoidTaskType]
+	auth_timer: Optional[Timer]
 	auth_sent: bool
 	bs: Optional[BackendSession]
 	cs: Optional[ChatSession]
 	
+	frontend_name = 'msnp-sb'
+	
 	def __init__(self, logger: Logger, via: str, backend: Backend) -> None:
 		super().__init__(logger)
 		self.backend = backend
 		self.dialect = 0
 		self.loop = backend.loop
-		self.counter_task = None
+		self.auth_timer = None
 		self.auth_sent = False
 		self.bs = None
 		self.cs = None
 	
 	def on_connect(self) -> None:
-		self.counter_task = self.loop.create_task(self._conn_auth_limit_counter())
+		self.auth_timer = self.backend.timers.call_later(AUTH_TIMEOUT, self._on_auth_timeout)
 	
 	def _on_close(self) -> None:
-		if self.counter_task is not None:
-			self.counter_task.cancel()
-			self.counter_task = None
+		if self.auth_timer is not None:
+			self.auth_timer.cancel()
+			self.auth_timer = None
 		if self.cs:
 			self.cs.close()
 	
@@ -84,9 +82,9 @@ class MSNPCtrlSB(MSNPCtrl):
 		self.dialect = dialect
 		self.bs = bs
 		self.cs = cs
-		if self.counter_task is not None and not self.counter_task.cancelled():
-			self.counter_task.cancel()
-			self.counter_task = None
+		if self.auth_timer is not None:
+			self.auth_timer.cancel()
+			self.auth_timer = None
 		self.send_reply('USR', trid, 'OK', arg, cs.user.status.name or cs.user.email)
 	
 	def _m_ans(self, trid: Optional[str], arg: Optional[str], token: Optional[str], sessid: Optional[int], *args: Any) -> None:
@@ -131,9 +129,9 @@ class MSNPCtrlSB(MSNPCtrl):
 		self.dialect = dialect
 		self.bs = bs
 		self.cs = cs
-		if self.counter_task and not self.counter_task.cancelled():
-			self.counter_task.cancel()
-			self.counter_task = None
+		if self.auth_timer is not None:
+			self.auth_timer.cancel()
+			self.auth_timer = None
 		
 		chat.send_participant_joined(cs)
 		
@@ -145,9 +143,9 @@ class MSNPCtrlSB(MSNPCtrl):
 			seen_cses = set() # type: Set[ChatSession]
 			for other_cs_primary in roster_chatsessions:
 				if other_cs_primary in seen_cses: continue
-				for other_cs in chat.get_roster():
+				for other_cs in chat.get_user_sessions(other_cs_primary.user):
 					if other_cs in seen_cses: continue
-					if other_cs.user.email == other_cs_primary.user.email and not other_cs.primary_pop:
+					if not other_cs.primary_pop:
 						seen_cses.add(other_cs)
 						tmp.append(other_cs)
 						l += 1
@@ -229,8 +227,7 @@ class MSNPCtrlSB(MSNPCtrl):
 			# WLM 2009 sends a `CAL` with the invitee being the owner when a SB session is first initiated. If there are no other
 			# PoPs of the owner, send a `JOI` for now to fool the client.
 			# TODO: Set flag to mark if PoPs of owner are already invited
-			chat_roster_single = list(chat.get_roster_single())
-			if isinstance(ex, error.ContactAlreadyOnList) and invitee_email == bs.user.email and len(chat_roster_single) == 1 and chat_roster_single[0] is cs and self.dialect >= 16:
+			if isinstance(ex, error.ContactAlreadyOnList) and invitee_email == bs.user.email and len(chat.get_roster()) == 1 and self.dialect >= 16:
 				self.send_reply('CAL', trid, 'RINGING', chat.ids['main'])
 				cs.evt.on_participant_joined(cs, True)
 				return
@@ -262,16 +259,10 @@ class MSNPCtrlSB(MSNPCtrl):
 		elif ack != 'N': # AD
 			self.send_reply('ACK', trid)
 	
-	async def _conn_auth_limit_counter(self) -> None:
-		counter = 0
-		
-		while counter < 1:
-			await asyncio.sleep(60)
-			counter += 1
-		
-		if counter == 1:
-			if not self.auth_sent:
-				self.close(hard = True)
+	def _on_auth_timeout(self) -> None:
+		self.auth_timer = None
+		if not self.auth_sent:
+			self.close(hard = True)
 
 class ChatEventHandler(event.ChatEventHandler):
 	__slots__ = ('ctrl',)
@@ -333,8 +324,15 @@ class ChatEventHandler(event.ChatEventHandler):
 		pass
 	
 	def on_message(self, data: MessageData) -> None:
-		if data.type is not MessageType.TypingDone:
-			self.ctrl.send_reply('MSG', data.sender.email, data.sender.status.name, messagedata_to_msnp(data))
+		if data.type is MessageType.TypingDone: return
+		# The same for every SB connection in the chat, whatever the dialect; encoded by the first one
+		sender = data.sender
+		key = ('msnp', 'MSG', sender.email, sender.status.name)
+		frame = data.front_cache.get(key)
+		if frame is None:
+			frame = encode_command(('MSG', sender.email, sender.status.name, messagedata_to_msnp(data)))
+			data.front_cache[key] = frame
+		self.ctrl.send_raw(frame)
 	
 	def on_close(self, keep_future: bool, idle: bool) -> None:
 		self.ctrl.close(hard = idle)
@@ -402,3 +400,6 @@ def messagedata_to_msnp(data: MessageData) -> bytes:
 			raise ValueError("unknown message type", data.type)
 		data.front_cache['msnp'] = s.encode('utf-8')
 	return data.front_cache['msnp']
+
+# Connections that haven't sent `USR`/`ANS` by then are dropped
+AUTH_TIMEOUT = 60
@@ -0,0 +1,138 @@
+from typing import Dict, Optional, Iterable, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import asyncio, base64, hashlib, io, json, os
+
+from util.cache import Cache
+
+class Usertile:
+	__slots__ = ('uuid', 'ext', 'etag', 'thumb_etag')
+	
+	uuid: str
+	ext: str
+	# Content hashes of the image and its thumbnail
+	etag: str
+	thumb_etag: Optional[str]
+	
+	def __init__(self, uuid: str, ext: str, etag: str, thumb_etag: Optional[str]) -> None:
+		self.uuid = uuid
+		self.ext = ext
+		self.etag = etag
+		self.thumb_etag = thumb_etag
+	
+	@property
+	def content_type(self) -> str:
+		return 'image/{}'.format('jpeg' if self.ext == 'jpg' else self.ext)
+	
+	def get_path(self, *, small: bool = False) -> Path:
+		return _get_storage_path(self.uuid) / '{}{}.{}'.format(self.uuid, '_thumb' if small else '', self.ext)
+
+class UsertileStore:
+	# Display pictures uploaded through the storage service (`CreateDocument`).
+	# Decoding and thumbnailing run on a thread pool; each tile's extension and
+	# content hashes live in a small `<uuid>.json` next to it, cached here, so
+	# serving one never has to list its directory.
+	__slots__ = ('_executor', '_tiles')
+	
+	_executor: ThreadPoolExecutor
+	_tiles: Cache[str, Usertile]
+	
+	def __init__(self, *, max_workers: int = 2) -> None:
+		self._executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'usertile')
+		self._tiles = Cache(maxsize = USERTILE_CACHE_SIZE, negative_ttl = USERTILE_NEGATIVE_TTL)
+	
+	async def save(self, uuid: str, mime: Optional[str], data: str) -> Usertile:
+		tile = await asyncio.get_event_loop().run_in_executor(self._executor, _ingest, uuid, mime, data)
+		self._tiles.set(uuid, tile)
+		return tile
+	
+	async def get(self, uuid: str) -> Optional[Usertile]:
+		found, tile = self._tiles.lookup(uuid)
+		if found: return tile
+		tile = await asyncio.get_event_loop().run_in_executor(self._executor, _load, uuid)
+		self._tiles.set(uuid, tile)
+		return tile
+	
+	def stats(self) -> Dict[str, int]:
+		return self._tiles.stats()
+
+def _ingest(uuid: str, mime: Optional[str], data_b64: str) -> Usertile:
+	from PIL import Image
+	
+	data = base64.b64decode(data_b64)
+	image = Image.open(io.BytesIO(data))
+	ext = _mime_to_ext(mime) or (image.format or '').lower()
+	if not ext:
+		raise ValueError("unknown image type")
+	thumb = image.resize(THUMB_SIZE)
+	thumb_data = io.BytesIO()
+	thumb.save(thumb_data, format = image.format)
+	
+	path = _get_storage_path(uuid)
+	path.mkdir(parents = True, exist_ok = True)
+	for old in _find_images(uuid):
+		if old.suffix[1:] != ext:
+			old.unlink()
+	tile = Usertile(uuid, ext, _hash(data), _hash(thumb_data.getvalue()))
+	_write_atomic(tile.get_path(), data)
+	_write_atomic(tile.get_path(small = True), thumb_data.getvalue())
+	_write_meta(tile)
+	return tile
+
+def _load(uuid: str) -> Optional[Usertile]:
+	if not uuid or not all(c.isalnum() or c == '-' for c in uuid):
+		return None
+	try:
+		meta = json.loads(_get_meta_path(uuid).read_text())
+	except FileNotFoundError:
+		pass
+	else:
+		return Usertile(uuid, meta['ext'], meta['etag'], meta['thumb_etag'])
+	
+	# Uploaded before the metadata files existed; hash it once and write one
+	for image_path in _find_images(uuid):
+		if image_path.stem != uuid: continue
+		tile = Usertile(uuid, image_path.suffix[1:], _hash(image_path.read_bytes()), None)
+		thumb_path = tile.get_path(small = True)
+		if thumb_path.is_file():
+			tile.thumb_etag = _hash(thumb_path.read_bytes())
+		_write_meta(tile)
+		return tile
+	return None
+
+def _find_images(uuid: str) -> Iterable[Path]:
+	path = _get_storage_path(uuid)
+	if not path.is_dir(): return ()
+	return (p for p in path.glob('{}*.*'.format(uuid)) if p.suffix != '.json' and p.stem in (uuid, uuid + '_thumb'))
+
+def _write_meta(tile: Usertile) -> None:
+	_write_atomic(_get_meta_path(tile.uuid), json.dumps({
+		'ext': tile.ext, 'etag': tile.etag, 'thumb_etag': tile.thumb_etag,
+	}).encode('utf-8'))
+
+def _write_atomic(path: Path, data: bytes) -> None:
+	tmp_path = path.with_name(path.name + '.tmp')
+	tmp_path.write_bytes(data)
+	os.replace(str(tmp_path), str(path))
+
+def _mime_to_ext(mime: Optional[str]) -> Optional[str]:
+	# Clients send either `png` or `image/png`; it ends up in a file name, so nothing else gets through
+	if not mime: return None
+	ext = mime.rsplit('/', 1)[-1].lower()
+	if not ext.isalnum(): return None
+	return ext
+
+def _hash(data: bytes) -> str:
+	return hashlib.sha256(data).hexdigest()[:32]
+
+def _get_meta_path(uuid: str) -> Path:
+	return _get_storage_path(uuid) / '{}.json'.format(uuid)
+
+def _get_storage_path(uuid: str) -> Path:
+	return Path('storage/dp') / uuid[0:1] / uuid[0:2]
+
+THUMB_SIZE = (21, 21) # type: Tuple[int, int]
+USERTILE_CACHE_SIZE = 10000
+USERTILE_NEGATIVE_TTL = 60
+
+usertiles = UsertileStore()
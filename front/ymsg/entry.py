@@ -5,6 +5,7 @@ import struct
 from aiohttp import web
 from core.backend import Backend
 from util.misc import Logger
+from util import metrics
 
 from .ymsg_ctrl import YMSGCtrlBase
 
@@ -29,6 +30,7 @@ def register(loop: asyncio.AbstractEventLoop, backend: Backend, http_app: web.Ap
 
 class ListenerYMSG(asyncio.Protocol):
 	logger: Logger
+	logger_prefix: str
 	backend: Backend
 	controller: YMSGCtrlBase
 	transport: Optional[asyncio.WriteTransport]
@@ -36,6 +38,7 @@ class ListenerYMSG(asyncio.Protocol):
 	def __init__(self, logger_prefix: str, backend: Backend, controller_factory: Callable[[Logger, str, Backend], YMSGCtrlBase]) -> None:
 		super().__init__()
 		self.logger = Logger(logger_prefix, self)
+		self.logger_prefix = logger_prefix
 		self.backend = backend
 		self.controller = controller_factory(self.logger, 'direct', backend)
 		self.controller.close_callback = self._on_close
@@ -45,10 +48,12 @@ class ListenerYMSG(asyncio.Protocol):
 		assert isinstance(transport, asyncio.WriteTransport)
 		self.transport = transport
 		self.logger.log_connect()
+		metrics.connections.inc(self.logger_prefix)
 	
 	def connection_lost(self, exc: Optional[Exception]) -> None:
 		self.controller.close()
 		self.logger.log_disconnect()
+		metrics.connections.dec(self.logger_prefix)
 		self.transport = None
 	
 	def data_received(self, data: bytes) -> None:
@@ -6,17 +6,29 @@ from urllib.parse import unquote, unquote_plus, quote
 from pathlib import Path
 import datetime
 import shutil
+import struct
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 from core.backend import Backend, BackendSession
 from core.models import Contact
 import util.misc
+from util.timer import Timer
 from .ymsg_ctrl import _try_decode_ymsg
 from .misc import YMSGService, yahoo_id_to_uuid, yahoo_id
 import time
 
 YAHOO_TMPL_DIR = 'front/ymsg/tmpl'
-_tasks_by_uuid_store = {} # type: Dict[str, asyncio.Task[None]]
+_expiry_by_file_id = {} # type: Dict[str, Timer]
+_ft_executor = ThreadPoolExecutor(max_workers = 4, thread_name_prefix = 'yfs')
+
+# Key `29` of an HTTP file transfer packet; the file follows it
+FT_STREAM_FIELD = b'29\xC0\x80'
+MAX_FT_HEADER_SIZE = 64 * 1024
+MAX_FT_FILE_SIZE = 2 * (1000 ** 3)
+FT_CHUNK_SIZE = 256 * 1024
+# Uploaded files not downloaded within a day are deleted
+FT_FILE_LIFETIME = 86400
 
 def register(app: web.Application) -> None:
 	util.misc.add_to_jinja_env(app, 'ymsg', YAHOO_TMPL_DIR)
@@ -220,18 +232,11 @@ async def handle_rd_yahoo(req: web.Request) -> web.Response:
 #	return resp
 
 async def handle_ft_http(req: web.Request) -> web.Response:
-	body = await req.read()
-	
-	# Look for incomplete key-value field `29`
-	stream_loc = body.find(b'29\xC0\x80')
-	stream = body[(stream_loc + 4):]
-	
-	# Parse the rest of the YMSG packet
-	raw_ymsg_data = body[:stream_loc]
+	# The body is a YMSG packet whose last field, `29`, is left open and followed
+	# by the file itself; only the packet is held in memory, the file goes straight to disk.
+	raw_ymsg_data, stream_head = await _read_ft_header(req)
 	
 	# Now change the length field as fit to get the YMSG parser to gobble it up
-	import struct
-	
 	raw_ymsg_part_pre = raw_ymsg_data[0:8]
 	raw_ymsg_part_post = raw_ymsg_data[10:]
 	
@@ -269,60 +274,120 @@ async def handle_ft_http(req: web.Request) -> web.Response:
 	message = util.misc.arbitrary_decode(ymsg_data.get(b'14') or b'')
 	
 	file_path_raw = ymsg_data.get(b'27') # type: Optional[bytes]
-	file_len = util.misc.arbitrary_decode(ymsg_data.get(b'28') or b'0')
+	file_len_str = util.misc.arbitrary_decode(ymsg_data.get(b'28') or b'0')
 	
-	if file_path_raw is None or str(len(stream)) != file_len or len(stream) > (2 * (1000 ** 3)):
+	try:
+		file_len = int(file_len_str)
+	except ValueError:
+		raise web.HTTPInternalServerError
+	if file_path_raw is None or file_len < 0 or file_len > MAX_FT_FILE_SIZE or len(stream_head) > file_len:
 		raise web.HTTPInternalServerError
 	
 	file_path = util.misc.arbitrary_decode(file_path_raw)
 	
 	try:
-		filename = Path(file_path).name
+		filename = Path(unquote_plus(Path(file_path).name)).name
 	except:
 		raise web.HTTPInternalServerError
+	if not filename:
+		raise web.HTTPInternalServerError
 	
 	path = _get_tmp_file_storage_path()
-	path.mkdir(exist_ok = True)
+	path.mkdir(parents = True, exist_ok = True)
 	
-	file_tmp_path = path / unquote_plus(filename)
-	file_tmp_path.write_bytes(stream)
+	file_tmp_path = path / filename
+	complete = False
+	try:
+		complete = await _receive_ft_file(req, file_tmp_path, stream_head, file_len)
+	finally:
+		if not complete:
+			shutil.rmtree(str(path), ignore_errors = True)
+	if not complete:
+		raise web.HTTPInternalServerError
 	
 	upload_time = time.time()
 	
-	expiry_task = req.app.loop.create_task(_store_tmp_file_until_expiry(path))
-	_tasks_by_uuid_store[file_tmp_path.name[12:]] = expiry_task
+	file_id = file_tmp_path.name[12:]
+	_expiry_by_file_id[file_id] = backend.timers.call_later(FT_FILE_LIFETIME, _expire_tmp_file, file_id, path)
 	
 	for bs_other in bs.backend._sc.iter_sessions():
 		if bs_other.user.uuid == recipient_uuid:
-			bs_other.evt.ymsg_on_sent_ft_http(yahoo_id_sender, '/tmp/file/{}'.format(file_tmp_path.name[12:]), upload_time, message)
+			bs_other.evt.ymsg_on_sent_ft_http(yahoo_id_sender, '/tmp/file/{}'.format(file_id), upload_time, message)
 	
 	# TODO: Sending HTTP FT acknowledgement crahes Yahoo! Messenger, and ultimately freezes the computer. Ignore for now.
 	#bs.evt.ymsg_on_upload_file_ft(yahoo_id_recipient, message)
 	
 	raise web.HTTPOk
 
-async def _store_tmp_file_until_expiry(file_storage_path: Path) -> None:
-	await asyncio.sleep(86400)
-	# When a day passes, delete the file (unless it has already been deleted by the downloader handler; it will cancel the according task then)
+async def _read_ft_header(req: web.Request) -> Tuple[bytes, bytes]:
+	# Returns the YMSG packet up to the incomplete key-value field `29`, and whatever of the file came with it
+	buf = b''
+	while True:
+		chunk = await req.content.readany()
+		if not chunk:
+			raise web.HTTPInternalServerError
+		# The separator can straddle two chunks
+		search_from = max(0, len(buf) - len(FT_STREAM_FIELD) + 1)
+		buf += chunk
+		stream_loc = buf.find(FT_STREAM_FIELD, search_from)
+		if stream_loc >= 0:
+			return buf[:stream_loc], buf[(stream_loc + len(FT_STREAM_FIELD)):]
+		if len(buf) > MAX_FT_HEADER_SIZE:
+			raise web.HTTPRequestEntityTooLarge(MAX_FT_HEADER_SIZE, len(buf))
+
+async def _receive_ft_file(req: web.Request, file_path: Path, stream_head: bytes, file_len: int) -> bool:
+	# Writes happen on `_ft_executor`, one chunk at a time, so memory use doesn't depend on the file size
+	loop = asyncio.get_event_loop()
+	f = await loop.run_in_executor(_ft_executor, file_path.open, 'wb')
+	try:
+		received = len(stream_head)
+		if stream_head:
+			await loop.run_in_executor(_ft_executor, f.write, stream_head)
+		async for chunk in req.content.iter_chunked(FT_CHUNK_SIZE):
+			received += len(chunk)
+			if received > file_len:
+				return False
+			await loop.run_in_executor(_ft_executor, f.write, chunk)
+	finally:
+		await loop.run_in_executor(_ft_executor, f.close)
+	return received == file_len
+
+def _expire_tmp_file(file_id: str, file_storage_path: Path) -> None:
+	# Unless the download handler has already deleted it (and cancelled this)
+	_expiry_by_file_id.pop(file_id, None)
 	shutil.rmtree(str(file_storage_path), ignore_errors = True)
 
-async def handle_yahoo_filedl(req: web.Request) -> web.Response:
+async def handle_yahoo_filedl(req: web.Request) -> web.StreamResponse:
 	file_id = req.match_info['file_id']
 	
 	if req.method != 'GET':
 		raise web.HTTPMethodNotAllowed
 	
+	filename = unquote_plus(req.match_info['filename'])
+	if not all(c.isalnum() or c == '-' for c in file_id) or Path(filename).name != filename:
+		raise web.HTTPNotFound
 	file_storage_path = _get_tmp_file_storage_path(id = file_id)
-	filename = req.match_info['filename']
-	file_path = file_storage_path / unquote_plus(filename)
-	try:
-		file_stream = file_path.read_bytes()
-	except FileNotFoundError:
+	file_path = file_storage_path / filename
+	if not file_path.is_file():
 		raise web.HTTPNotFound
-	_tasks_by_uuid_store[file_id].cancel()
-	del _tasks_by_uuid_store[file_id]
-	shutil.rmtree(file_storage_path, ignore_errors = True)
-	return web.HTTPOk(body = file_stream)
+	
+	return _FTDownloadResponse(file_id, file_path, chunk_size = FT_CHUNK_SIZE)
+
+class _FTDownloadResponse(web.FileResponse):
+	# Deletes the file once it's been sent in full. Partial (`Range`) downloads
+	# leave it around so the rest can be fetched; it expires as usual then.
+	def __init__(self, file_id: str, path: Path, **kwargs: Any) -> None:
+		super().__init__(path, **kwargs)
+		self._file_id = file_id
+	
+	async def prepare(self, request: web.BaseRequest) -> Any:
+		writer = await super().prepare(request)
+		if self.status == 200:
+			expiry = _expiry_by_file_id.pop(self._file_id, None)
+			if expiry is not None:
+				expiry.cancel()
+			shutil.rmtree(str(_get_tmp_file_storage_path(id = self._file_id)), ignore_errors = True)
+		return writer
 
 def _get_tmp_file_storage_path(id: Optional[str] = None) -> Path:
 	if not id:
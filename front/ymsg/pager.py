@@ -16,7 +16,7 @@ from core.client import Client
 from core.user import UserService
 from core.auth import AuthService
 
-from .ymsg_ctrl import YMSGCtrlBase
+from .ymsg_ctrl import YMSGCtrlBase, YMSGFrame
 from .misc import YMSGService, YMSGStatus, yahoo_id_to_uuid, is_blocking
 from . import misc, Y64
 
@@ -950,9 +950,10 @@ class YMSGCtrlPager(YMSGCtrlBase):
 		self.send_reply(YMSGService.LogOn, YMSGStatus.Available, self.sess_id, logon_payload)
 	
 	def _get_oims(self, user: User) -> None:
-		oims = self.backend.user_service.get_oim_batch(user)
+		oims = self.backend.user_service.get_oim_batch(user, with_messages = True)
 		
 		for oim in oims:
+			assert oim.message is not None
 			oim_msg_dict = MultiDict([
 				(b'31', b'6'),
 				(b'32', b'6'),
@@ -1357,59 +1358,27 @@ class ChatEventHandler(event.ChatEventHandler):
 		]))
 	
 	def on_message(self, data: MessageData) -> None:
-		bs = self.bs
-		assert bs is not None
-		
-		sender = data.sender
-		yahoo_data = messagedata_to_ymsg(data)
-		
-		if data.type in (MessageType.Chat,MessageType.Nudge):
-			if self.cs.chat.front_data.get('ymsg_twoway_only'):
-				message_to_dict = MultiDict([
-					(b'5', yahoo_data.get(b'5') or arbitrary_encode(self.ctrl.yahoo_id or '')),
-					(b'4', yahoo_data.get(b'1') or misc.yahoo_id(sender.email).encode('utf-8')),
-					(b'14', yahoo_data.get(b'14') or arbitrary_encode(data.text or '')),
-				]) # type: MultiDict[bytes, bytes]
-				
-				if yahoo_data.get(b'63') is not None:
-					message_to_dict.add(b'63', yahoo_data.get(b'63') or b'')
-				
-				if yahoo_data.get(b'64') is not None:
-					message_to_dict.add(b'64', yahoo_data.get(b'64') or b'')
-				
-				if yahoo_data.get(b'97') is not None:
-					message_to_dict.add(b'97', yahoo_data.get(b'97') or b'')
-				
-				self.ctrl.send_reply(YMSGService.Message, YMSGStatus.BRB, self.ctrl.sess_id, message_to_dict)
-			else:
-				if data.type is not MessageType.Nudge:
-					conf_message_dict = MultiDict([
-						(b'1', arbitrary_encode(self.ctrl.yahoo_id or '')),
-						(b'57', arbitrary_encode(self.cs.chat.ids['ymsg/conf'])),
-						(b'3', yahoo_data.get(b'1') or misc.yahoo_id(sender.email).encode('utf-8')),
-						(b'14', yahoo_data.get(b'14') or arbitrary_encode(data.text or '')),
-					])
-					
-					if yahoo_data.get(b'97') is not None:
-						conf_message_dict.add(b'97', yahoo_data.get(b'97') or b'')
-					
-					self.ctrl.send_reply(YMSGService.ConfMsg, YMSGStatus.BRB, self.ctrl.sess_id, conf_message_dict)
-		elif data.type in (MessageType.Typing,MessageType.TypingDone) and self.cs.chat.front_data.get('ymsg_twoway_only'):
-			self.ctrl.send_reply(YMSGService.Notify, YMSGStatus.BRB, self.ctrl.sess_id, MultiDict([
-				(b'5', yahoo_data.get(b'5') or arbitrary_encode(self.ctrl.yahoo_id or '')),
-				(b'4', yahoo_data.get(b'1') or misc.yahoo_id(sender.email).encode('utf-8')),
-				(b'49', b'TYPING'),
-				(b'14', yahoo_data.get(b'14') or arbitrary_encode(data.text or ' ')),
-				(b'13', yahoo_data.get(b'13') or (b'0' if data.type is MessageType.TypingDone else b'1'))
+		chat = self.cs.chat
+		twoway = bool(chat.front_data.get('ymsg_twoway_only'))
+		conf_id = chat.ids.get('ymsg/conf')
+		# Everything but the recipient's own fields is the same for the whole chat, so it's encoded once
+		key = ('ymsg', twoway, conf_id)
+		if key in data.front_cache:
+			frame = data.front_cache[key]
+		else:
+			frame = _message_frame(data, twoway, conf_id)
+			data.front_cache[key] = frame
+		if frame is None: return
+		
+		ctrl = self.ctrl
+		if frame.service is YMSGService.ConfMsg:
+			ctrl.send_frame(frame, ctrl.sess_id, MultiDict([
+				(b'1', arbitrary_encode(ctrl.yahoo_id or '')),
+			]))
+		else:
+			ctrl.send_frame(frame, ctrl.sess_id, MultiDict([
+				(b'5', messagedata_to_ymsg(data).get(b'5') or arbitrary_encode(ctrl.yahoo_id or '')),
 			]))
-		elif data.type is MessageType.Webcam:
-			kvs = MultiDict([
-				(b'5', yahoo_data.get(b'5') or arbitrary_encode(self.ctrl.yahoo_id or '')),
-				(b'4', yahoo_data.get(b'1') or misc.yahoo_id(sender.email).encode('utf-8')),
-				(b'49', b'WEBCAMINVITE'),
-				(b'14', yahoo_data.get(b'14') or arbitrary_encode(data.text or ' ')),
-			]) # type: MultiDict[bytes, bytes]
-			self.ctrl.send_reply(YMSGService.Notify, YMSGStatus.BRB, self.ctrl.sess_id, kvs)
 	
 	def _send_when_user_joins(self, user_uuid: str, data: MessageData) -> None:
 		# Send to everyone currently in chat
@@ -1460,6 +1429,46 @@ def messagedata_from_ymsg(sender: User, data: MultiDict[bytes, bytes], *, notify
 	message.front_cache['ymsg'] = data
 	return message
 
+def _message_frame(data: MessageData, twoway: bool, conf_id: Optional[str]) -> Optional[YMSGFrame]:
+	# `ChatEventHandler.on_message`'s packet, minus the recipient's Yahoo ID that goes first
+	yahoo_data = messagedata_to_ymsg(data)
+	sender_id = yahoo_data.get(b'1') or misc.yahoo_id(data.sender.email).encode('utf-8')
+	
+	if data.type in (MessageType.Chat,MessageType.Nudge):
+		if twoway:
+			kvs = MultiDict([
+				(b'4', sender_id),
+				(b'14', yahoo_data.get(b'14') or arbitrary_encode(data.text or '')),
+			]) # type: MultiDict[bytes, bytes]
+			for k in (b'63', b'64', b'97'):
+				if yahoo_data.get(k) is not None:
+					kvs.add(k, yahoo_data.get(k) or b'')
+			return YMSGFrame(YMSGService.Message, YMSGStatus.BRB, kvs)
+		if data.type is MessageType.Nudge or conf_id is None:
+			return None
+		kvs = MultiDict([
+			(b'57', arbitrary_encode(conf_id)),
+			(b'3', sender_id),
+			(b'14', yahoo_data.get(b'14') or arbitrary_encode(data.text or '')),
+		])
+		if yahoo_data.get(b'97') is not None:
+			kvs.add(b'97', yahoo_data.get(b'97') or b'')
+		return YMSGFrame(YMSGService.ConfMsg, YMSGStatus.BRB, kvs)
+	if data.type in (MessageType.Typing,MessageType.TypingDone) and twoway:
+		return YMSGFrame(YMSGService.Notify, YMSGStatus.BRB, MultiDict([
+			(b'4', sender_id),
+			(b'49', b'TYPING'),
+			(b'14', yahoo_data.get(b'14') or arbitrary_encode(data.text or ' ')),
+			(b'13', yahoo_data.get(b'13') or (b'0' if data.type is MessageType.TypingDone else b'1')),
+		]))
+	if data.type is MessageType.Webcam:
+		return YMSGFrame(YMSGService.Notify, YMSGStatus.BRB, MultiDict([
+			(b'4', sender_id),
+			(b'49', b'WEBCAMINVITE'),
+			(b'14', yahoo_data.get(b'14') or arbitrary_encode(data.text or ' ')),
+		]))
+	return None
+
 def messagedata_to_ymsg(data: MessageData) -> MultiDict[bytes, bytes]:
 	if 'ymsg' not in data.front_cache:
 		data.front_cache['ymsg'] = MultiDict([
@@ -1,13 +1,13 @@
 import io
 from abc import ABCMeta, abstractmethod
 import asyncio
-from typing import Dict, List, Tuple, Any, Optional, Callable, Iterable
-import binascii
+from typing import Dict, List, Tuple, Any, Optional, Callable, Iterable, ClassVar
 import struct
 import settings
 import time
 
 from util.misc import Logger, MultiDict
+from util.dispatch import CommandTable
 
 from .misc import YMSGStatus, YMSGService
 
@@ -24,6 +24,15 @@ class YMSGCtrlBase(metaclass = ABCMeta):
 	closed: bool
 	transport: Optional[asyncio.WriteTransport]
 	
+	# Label for this controller's commands in `metrics`
+	frontend_name = 'ymsg'
+	# `_y_<service in hex>` handlers by service number, built for each subclass
+	commands: ClassVar[CommandTable]
+	
+	def __init_subclass__(cls, **kwargs: Any) -> None:
+		super().__init_subclass__(**kwargs) # type: ignore
+		cls.commands = CommandTable(cls, cls.frontend_name, '_y_', _service_from_hex)
+	
 	def __init__(self, logger: Logger) -> None:
 		self.logger = logger
 		self.decoder = YMSGDecoder(logger)
@@ -31,18 +40,21 @@ class YMSGCtrlBase(metaclass = ABCMeta):
 		self.peername = ('0.0.0.0', 5050)
 		self.closed = False
 		self.close_callback = None
+		self.transport = None
 	
 	def data_received(self, transport: asyncio.BaseTransport, data: bytes) -> None:
 		self.peername = transport.get_extra_info('peername')
-		for y in self.decoder.data_received(data):
-			try:
+		commands = self.commands
+		try:
+			for y in self.decoder.data_received(data):
 				# check version and vendorId
 				if y[1] > 16 or y[2] not in (0, 100):
 					return
-				f = getattr(self, '_y_{}'.format(binascii.hexlify(struct.pack('!H', y[0])).decode()))
-				f(*y[1:])
-			except Exception as ex:
-				self.logger.error(ex)
+				if not commands.dispatch(self, y[0], y[1:]):
+					self.logger.info("unknown service", y[0])
+		except YMSGFrameError as ex:
+			self.logger.error(ex)
+			self.close()
 	
 	def send_reply(self, service: YMSGService, status: YMSGStatus, session_id: int, kvs: Optional[KVS] = None) -> None:
 		self.encoder.encode(service, status, session_id, kvs)
@@ -50,6 +62,12 @@ class YMSGCtrlBase(metaclass = ABCMeta):
 		if transport is not None:
 			transport.write(self.flush())
 	
+	def send_frame(self, frame: 'YMSGFrame', session_id: int, kvs: KVS) -> None:
+		self.encoder.encode_frame(frame, session_id, kvs)
+		transport = self.transport
+		if transport is not None:
+			transport.write(self.flush())
+	
 	def flush(self) -> bytes:
 		return self.encoder.flush()
 	
@@ -80,13 +98,7 @@ class YMSGEncoder:
 		# version number and vendor id are replaced with 0x00000000
 		w(b'\x00\x00\x00\x00')
 		
-		payload_list = []
-		if kvs is not None:
-			k = None # type: Optional[bytes]
-			v = None # type: Optional[bytes]
-			for k, v in kvs.items():
-				payload_list.extend([k, SEP, v, SEP])
-		payload = b''.join(payload_list)
+		payload = _encode_kvs(kvs)
 		# Have to call `int` on these because they might be an IntEnum, which
 		# get `repr`'d to `EnumName.ValueName`. Grr.
 		w(struct.pack('!HHII', len(payload), int(service), int(status), session_id))
@@ -96,6 +108,17 @@ class YMSGEncoder:
 		if kvs:
 			_truncated_kvs(self._logger, service, kvs)
 	
+	def encode_frame(self, frame: 'YMSGFrame', session_id: int, kvs: KVS) -> None:
+		head = _encode_kvs(kvs)
+		w = self._buf.write
+		w(PRE)
+		w(b'\x00\x00\x00\x00')
+		w(struct.pack('!HHII', len(head) + len(frame.payload), frame.service_id, frame.status_id, session_id))
+		w(head)
+		w(frame.payload)
+		
+		self._logger.info('<<<', frame.service, frame.status, session_id)
+	
 	def flush(self) -> bytes:
 		data = self._buf.getvalue()
 		if data:
@@ -103,71 +126,123 @@ class YMSGEncoder:
 			self._buf = io.BytesIO()
 		return data
 
+class YMSGFrame:
+	# A packet encoded once and sent to many connections; each one's session id and
+	# leading fields (e.g. their own Yahoo ID) are spliced in by `YMSGEncoder.encode_frame`.
+	__slots__ = ('service', 'status', 'service_id', 'status_id', 'payload')
+	
+	service: YMSGService
+	status: YMSGStatus
+	service_id: int
+	status_id: int
+	payload: bytes
+	
+	def __init__(self, service: YMSGService, status: YMSGStatus, kvs: KVS) -> None:
+		self.service = service
+		self.status = status
+		self.service_id = int(service)
+		self.status_id = int(status)
+		self.payload = _encode_kvs(kvs)
+
 DecodedYMSG = Tuple[YMSGService, int, int, YMSGStatus, int, KVS]
 
 class YMSGDecoder:
-	__slots__ = ('logger', '_data', '_i')
+	# Same buffering as `MSNPReader`: one `bytearray` with a read offset, compacted lazily.
+	__slots__ = ('logger', '_buf', '_pos')
 	
 	logger: Logger
-	_data: bytes
-	_i: int
+	_buf: bytearray
+	_pos: int
 	
 	def __init__(self, logger: Logger) -> None:
 		self.logger = logger
-		self._data = b''
-		self._i = 0
+		self._buf = bytearray()
+		self._pos = 0
 	
 	def data_received(self, data: bytes) -> Iterable[DecodedYMSG]:
-		if self._data:
-			self._data += data
-		else:
-			self._data = data
-		while self._data:
-			y = self._ymsg_read()
-			if y is None: break
-			yield y
+		self._buf += data
+		try:
+			while True:
+				y = self._ymsg_read()
+				if y is None: break
+				yield y
+		finally:
+			self._compact()
 	
 	def _ymsg_read(self) -> Optional[DecodedYMSG]:
-		try:
-			y, e = _try_decode_ymsg(self._data, self._i)
-		except AssertionError:
-			return None
-		except Exception:
-			print("ERR _ymsg_read", self._data)
-			raise
-		
-		self._data = self._data[e:]
-		self._i = 0
-		self.logger.info('>>>',  'YMSG{}'.format(str(y[1])), y[0], y[3], y[4])
+		r = _decode_ymsg(self._buf, self._pos)
+		if r is None: return None
+		y, self._pos = r
+		self.logger.info('>>>', 'YMSG{}'.format(y[1]), y[0], y[3], y[4])
 		_truncated_kvs(self.logger, y[0], y[5])
 		return y
+	
+	def _compact(self) -> None:
+		pos = self._pos
+		if pos == 0: return
+		buf = self._buf
+		if pos >= len(buf):
+			buf.clear()
+		elif pos >= COMPACT_MIN_BYTES and pos * 2 >= len(buf):
+			del buf[:pos]
+		else:
+			return
+		self._pos = 0
 
-def _try_decode_ymsg(d: bytes, i: int) -> Tuple[DecodedYMSG, int]:
-	kvs = MultiDict() # type: KVS
+class YMSGFrameError(Exception):
+	pass
+
+def _decode_ymsg(d: Any, i: int) -> Optional[Tuple[DecodedYMSG, int]]:
+	# Decodes the packet at offset `i` of a bytes-like buffer without slicing the buffer.
+	# Returns (packet, end offset), or None if the packet isn't complete yet.
+	if len(d) - i < HEADER_SIZE: return None
+	(pre, version, vendor_id, n, service, status, session_id) = _HEADER.unpack_from(d, i) # type: Tuple[bytes, int, int, int, int, int, int]
+	if pre != PRE:
+		raise YMSGFrameError("bad packet header")
+	if version in _LITTLE_ENDIAN_VERSIONS:
+		version >>= 8
+	if version not in YMSG_DIALECTS:
+		raise YMSGFrameError("unsupported version {}".format(version))
+	b = i + HEADER_SIZE
+	e = b + n
+	if e > len(d): return None
 	
-	e = 20
-	assert len(d[i:]) >= e
-	assert d[i:i+4] == PRE
-	header = d[i+4:i+e]
-	if header[:2] in (b'\x08\x00',b'\x09\x00',b'\x0a\x00'):
-		version = struct.unpack('<H', header[:2])[0] # type: int
-	else:
-		version = struct.unpack('!H', header[:2])[0]
-	(vendor_id, n, service, status, session_id) = struct.unpack('!HHHII', header[2:]) # type: Tuple[int, int, int, int, int]
-	assert version in YMSG_DIALECTS
-	assert e+n <= len(d[i:])
-	payload = d[e:e+n]
-	if payload:
-		assert payload[-2:] == SEP
-		parts = payload.split(SEP)
+	try:
+		service_enum = _SERVICE_BY_VALUE[service]
+		status_enum = YMSGStatus(status)
+	except (KeyError, ValueError):
+		raise YMSGFrameError("unknown service/status {}/{}".format(service, status))
+	
+	kvs = MultiDict() # type: KVS
+	if n:
+		# One copy out of the buffer; `split` then yields the keys and values as `bytes`
+		with memoryview(d) as view:
+			parts = bytes(view[b:e]).split(SEP)
+		if parts[-1] or len(parts) % 2 == 0:
+			raise YMSGFrameError("malformed payload")
 		del parts[-1]
-		assert len(parts) % 2 == 0
-		for j in range(1, len(parts), 2):
-			kvs.add(parts[j-1], parts[j])
-		e += n
-	return ((YMSGService(service), version, vendor_id, YMSGStatus(status), session_id, kvs), e)
+		kvs = MultiDict(zip(parts[0::2], parts[1::2]))
+	return ((service_enum, version, vendor_id, status_enum, session_id, kvs), e)
+
+def _try_decode_ymsg(d: bytes, i: int) -> Tuple[DecodedYMSG, int]:
+	r = _decode_ymsg(d, i)
+	assert r is not None
+	return r
+
+def _encode_kvs(kvs: Optional[KVS]) -> bytes:
+	if not kvs: return b''
+	payload_list = []
+	for k, v in kvs.items():
+		payload_list.extend([k, SEP, v, SEP])
+	return b''.join(payload_list)
+
+def _service_from_hex(name: str) -> int:
+	# `_y_004c` handles service 0x4C
+	return int(name, 16)
 
 def _truncated_kvs(logger: Logger, service: YMSGService, kvs: KVS) -> None:
+	if not (settings.DEBUG and settings.DEBUG_YMSG): return
+	
 	restricted_keys = set()
 	
 	if service in (YMSGService.AuthResp,YMSGService.List):
@@ -179,12 +254,19 @@ def _truncated_kvs(logger: Logger, service: YMSGService, kvs: KVS) -> None:
 	if service in (YMSGService.P2PFileXfer,YMSGService.FileTransfer):
 		restricted_keys.add(b'20')
 	
-	if settings.DEBUG and settings.DEBUG_YMSG:
-		for k, v in kvs.items():
-			 print('{} -> {}'.format(k, v if k not in restricted_keys else '<truncated>'))
+	for k, v in kvs.items():
+		print('{} -> {}'.format(k, v if k not in restricted_keys else '<truncated>'))
 
 PRE = b'YMSG'
 SEP = b'\xC0\x80'
+# PRE, version, vendor id, payload length, service, status, session id
+_HEADER = struct.Struct('!4sHHHHII')
+HEADER_SIZE = _HEADER.size
+# Clients of these versions send the version number little-endian
+_LITTLE_ENDIAN_VERSIONS = { 0x0800, 0x0900, 0x0a00 }
+_SERVICE_BY_VALUE = { int(service): service for service in YMSGService }
+# Consumed bytes kept at the front of the read buffer before it gets compacted
+COMPACT_MIN_BYTES = 64 * 1024
 
 YMSG_DIALECTS = [
 	# Actually supported
@@ -0,0 +1,10 @@
+from sqlaltery import ops
+
+OPS = [
+	ops.DataOperation('''
+		CREATE INDEX IF NOT EXISTS ix_t_user_contact_user_id ON t_user_contact (user_id)
+	'''),
+	ops.DataOperation('''
+		CREATE INDEX IF NOT EXISTS ix_t_user_email ON t_user (email)
+	'''),
+]
@@ -0,0 +1,6 @@
+from sqlaltery import ops
+import sqlalchemy as sa
+
+OPS = [
+	ops.AddColumn('t_user', sa.Column('list_version', sa.Integer(), nullable=False, server_default='0')),
+]
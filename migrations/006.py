@@ -0,0 +1,15 @@
+from sqlaltery import ops
+import sqlalchemy as sa
+
+OPS = [
+	ops.AddColumn('t_user', sa.Column('date_ab_removed', sa.DateTime(), nullable=True)),
+	ops.AddColumn('t_user_contact', sa.Column('date_modified', sa.DateTime(), nullable=True)),
+	ops.AddColumn('t_user_contact', sa.Column('date_lists_modified', sa.DateTime(), nullable=True)),
+	# Nothing was tracked before this, so any client's delta cursor from before now needs a full sync
+	ops.DataOperation('''
+		UPDATE t_user SET date_ab_removed = CURRENT_TIMESTAMP
+	'''),
+	ops.DataOperation('''
+		UPDATE t_user_contact SET date_modified = CURRENT_TIMESTAMP, date_lists_modified = CURRENT_TIMESTAMP
+	'''),
+]
@@ -0,0 +1,32 @@
+from sqlaltery import ops
+import sqlalchemy as sa
+
+from util.json_type import JSONType
+
+OPS = [
+	ops.AddTable('t_oim', (
+		sa.Column('id', sa.Integer(), nullable=False, primary_key=True),
+		sa.Column('uuid', sa.String(), nullable=False, unique=True),
+		sa.Column('recipient_uuid', sa.String(), nullable=False),
+		sa.Column('run_id', sa.String(), nullable=False),
+		sa.Column('from_email', sa.String(), nullable=False),
+		sa.Column('from_friendly', sa.String()),
+		sa.Column('from_friendly_encoding', sa.String()),
+		sa.Column('from_friendly_charset', sa.String()),
+		sa.Column('from_user_id', sa.String()),
+		sa.Column('sent', sa.DateTime(), nullable=False),
+		sa.Column('origin_ip', sa.String()),
+		sa.Column('proxy', sa.String()),
+		sa.Column('headers', JSONType(), nullable=False),
+		sa.Column('utf8', sa.Boolean(), nullable=False),
+		sa.Column('size', sa.Integer(), nullable=False),
+		sa.Column('is_read', sa.Boolean(), nullable=False),
+	)),
+	ops.AddTable('t_oim_body', (
+		sa.Column('oim_id', sa.Integer(), nullable=False, primary_key=True),
+		sa.Column('message', sa.Text(), nullable=False),
+	)),
+	ops.DataOperation('''
+		CREATE INDEX IF NOT EXISTS ix_t_oim_recipient_uuid_sent ON t_oim (recipient_uuid, sent)
+	'''),
+]
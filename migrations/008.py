@@ -0,0 +1,12 @@
+from sqlaltery import ops
+import sqlalchemy as sa
+
+from util.json_type import JSONType
+
+OPS = [
+	ops.AddColumn('t_user_contact', sa.Column('roles_left', JSONType(), nullable=True)),
+	# Roles left before this weren't tracked, so cursors from before now need a full sync
+	ops.DataOperation('''
+		UPDATE t_user SET date_ab_removed = CURRENT_TIMESTAMP
+	'''),
+]
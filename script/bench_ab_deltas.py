@@ -0,0 +1,82 @@
+from typing import Dict, Any
+from datetime import datetime, timedelta
+from uuid import uuid4
+import time
+
+import jinja2
+from aiohttp import web
+
+import util.misc
+from core.models import User, UserDetail, UserStatus, Contact, ContactDetail, Group, Lst
+from front.msn import http
+from front.msn.misc import cid_format
+
+# Bytes and render time of the address book responses a WLM client fetches at
+# login, as a full sync and as a `deltasOnly` sync with a few changes since.
+# Run with `python -m script.bench_ab_deltas`.
+
+CONTACTS = 1000
+GROUPS = 10
+CHANGED = 5
+ROUNDS = 20
+
+def main() -> None:
+	app = web.Application()
+	app['jinja_env'] = jinja2.Environment(
+		loader = jinja2.PrefixLoader({}, delimiter = ':'),
+		autoescape = jinja2.select_autoescape(default = True),
+	)
+	util.misc.add_to_jinja_env(app, 'msn', http.TMPL_DIR, globals = {
+		'date_format': util.misc.date_format,
+		'cid_format': cid_format,
+		'bool_to_str': http._bool_to_str,
+		'contact_is_favorite': http._contact_is_favorite,
+		'datetime': datetime,
+	})
+	
+	user = _make_user(0)
+	detail = UserDetail()
+	user.detail = detail
+	long_ago = datetime.utcnow() - timedelta(days = 1)
+	for i in range(GROUPS):
+		detail.insert_group(Group(str(i + 1), str(uuid4()), 'Group {}'.format(i), False, date_modified = long_ago))
+	groups = list(detail._groups_by_id.values())
+	for i in range(CONTACTS):
+		head = _make_user(i + 1)
+		ctc = Contact(
+			head, set(), Lst.FL | Lst.AL | Lst.RL, UserStatus(head.status.name), ContactDetail(str(i + 2)),
+			date_modified = long_ago, date_lists_modified = long_ago,
+		)
+		ctc.add_group_to_entry(groups[i % GROUPS])
+		detail.contacts[head.uuid] = ctc
+	
+	since = datetime.utcnow() - timedelta(seconds = 1)
+	for ctc in list(detail.contacts.values())[:CHANGED]:
+		ctc.touch(lists_before = ctc.lists)
+	
+	now = util.misc.date_format(datetime.utcnow())
+	for tmpl_name, lists in (
+		('msn:abservice/ABFindAllResponse.xml', False),
+		('msn:sharing/FindMembershipResponse.xml', True),
+	):
+		tmpl = app['jinja_env'].get_template(tmpl_name)
+		for label, cursor in (('full', None), ('deltas', since)):
+			ctxt = {
+				'cachekey': 'x', 'host': 'localhost', 'session_id': 'x', 'Lst': Lst,
+				'user': user, 'detail': detail, 'now': now, 'ab_id': '00000000-0000-0000-0000-000000000000',
+				'lists': [Lst.AL, Lst.BL],
+				'groups': http._groups_changed_since(detail, cursor),
+				'contacts': http._contacts_changed_since(detail, cursor, lists = lists),
+				'since': cursor,
+			} # type: Dict[str, Any]
+			start = time.perf_counter()
+			for _ in range(ROUNDS):
+				content = tmpl.render(**ctxt)
+			elapsed = (time.perf_counter() - start) / ROUNDS
+			print("{:40} {:7} {:9} bytes {:8.2f}ms".format(tmpl_name, label, len(content.encode('utf-8')), elapsed * 1000))
+
+def _make_user(i: int) -> User:
+	return User(i + 1, str(uuid4()), 'bench{}@example.com'.format(i), True, UserStatus('Bench {}'.format(i)), {}, datetime.utcnow())
+
+if __name__ == '__main__':
+	main()
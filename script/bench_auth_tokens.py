@@ -0,0 +1,54 @@
+from typing import List
+import time
+
+from core.auth import AuthService
+
+# Times `AuthService` create/get/pop and a full sweep with 10^5 and 10^6 live tokens.
+# Run with `python -m script.bench_auth_tokens`.
+
+LIVE_TOKENS = [10 ** 5, 10 ** 6]
+OPS = 10000
+PURPOSES = ['nb/login', 'sb/xfr', 'sb/cal', 'ymsg/cookie']
+
+def main() -> None:
+	for live in LIVE_TOKENS:
+		clock = _Clock()
+		auth_service = AuthService(time = clock)
+		tokens = [] # type: List[str]
+		for i in range(live):
+			tokens.append(auth_service.create_token(PURPOSES[i % len(PURPOSES)], i, lifetime = 30 + i % 60))
+		
+		start = time.perf_counter()
+		created = [auth_service.create_token('sb/xfr', i) for i in range(OPS)]
+		_report(live, 'create', start)
+		
+		start = time.perf_counter()
+		for i in range(OPS):
+			token = tokens[i * 7919 % live]
+			auth_service.get_token(PURPOSES[i * 7919 % live % len(PURPOSES)], token)
+		_report(live, 'get', start)
+		
+		start = time.perf_counter()
+		for token in created:
+			auth_service.pop_token('sb/xfr', token)
+		_report(live, 'pop', start)
+		
+		clock.t += 60
+		start = time.perf_counter()
+		removed = auth_service.sweep()
+		print("{:>8} live  {:6}  {:8.2f}ms total ({} expired)".format(live, 'sweep', (time.perf_counter() - start) * 1000, removed))
+		print("{:>8} live  counts {}".format(live, auth_service.counts_by_purpose()))
+
+def _report(live: int, name: str, start: float) -> None:
+	elapsed = time.perf_counter() - start
+	print("{:>8} live  {:6}  {:8.3f}us/op".format(live, name, elapsed / OPS * 1e6))
+
+class _Clock:
+	def __init__(self) -> None:
+		self.t = 0.0
+	
+	def __call__(self) -> float:
+		return self.t
+
+if __name__ == '__main__':
+	main()
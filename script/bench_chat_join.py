@@ -0,0 +1,122 @@
+from typing import Any, Dict, List, Optional, cast
+from datetime import datetime
+import time
+
+from util.misc import Logger
+from core import error
+from core.auth import AuthService
+from core.backend import Backend, BackendSession, Chat, ChatSession
+from core.models import User, UserStatus
+from front.irc.ctrl import IRCCtrl, ChatEventHandler
+
+# Time to fill one IRC channel with 2000 users the way `IRCCtrl._m_join` does
+# it (`join`, `send_participant_joined` with everyone's `JOIN`, then the `NAMES`
+# reply from `get_roster_single`), with the roster scans `Chat` used to do and
+# with its per-user roster index; then again with event handlers that do
+# nothing, to leave out the `JOIN` lines every member is sent either way.
+# Run with `python -m script.bench_chat_join`.
+
+USERS = 2000
+# Joins at the end of the fill, where the chat is nearly full
+TAIL = 200
+
+def main() -> None:
+	users = [
+		User(i, '00000000-0000-0000-0000-{:012}'.format(i), 'user{}@example.com'.format(i), True, UserStatus('user{}'.format(i)), {}, datetime.utcnow())
+		for i in range(USERS)
+	]
+	for handlers, make_evt in (('irc', _irc_evt), ('no-op', _NullHandler)):
+		for name, chat_type in (('roster scans', _OldChat), ('roster index', Chat)):
+			chat = chat_type(cast(Backend, _Backend()), None)
+			chat.add_id('irc', '#bench')
+			evts = [] # type: List[Any]
+			start = time.process_time()
+			tail_start = start
+			for i, user in enumerate(users):
+				if i == USERS - TAIL:
+					tail_start = time.process_time()
+				evt = make_evt(user) # type: Any
+				evts.append(evt)
+				cs = chat.join('irc', cast(BackendSession, _BackendSession(user)), evt)
+				chat.send_participant_joined(cs)
+				' '.join(cs.user.email for cs in chat.get_roster_single())
+				if i % 100 == 0:
+					for evt in evts: evt.ctrl.flush()
+			end = time.process_time()
+			assert len(list(chat.get_roster_single())) == USERS
+			print("{:6} {:13} {:8.1f}ms to fill  {:6.1f}us per join at {} members".format(
+				handlers, name, (end - start) * 1000, (end - tail_start) / TAIL * 1e6, USERS,
+			))
+
+def _irc_evt(user: User) -> Any:
+	return ChatEventHandler(IRCCtrl(Logger('IR', user), 'direct', None)) # type: ignore
+
+class _OldChat(Chat):
+	# `join`, `get_roster_single` and `send_participant_joined` from before the roster index
+	__slots__ = ()
+	
+	def join(self, origin: str, bs: Any, evt: Any, *, preferred_name: Optional[str] = None, pop_id: Optional[str] = None) -> ChatSession:
+		primary_pop = True
+		for user_other, pop_id_other in self._users_by_sess.values():
+			if bs.user is user_other:
+				if pop_id_other is not None:
+					if (pop_id is not None and pop_id_other.lower() == pop_id.lower()): raise error.AuthFail()
+				else:
+					if pop_id is not None: raise error.AuthFail()
+		for other_cs in self.get_roster():
+			primary_pop = True
+			if other_cs.user is bs.user and other_cs.primary_pop:
+				primary_pop = False
+		cs = ChatSession(origin, bs, self, evt, primary_pop, preferred_name = preferred_name)
+		cs.evt.cs = cs
+		self._users_by_sess[cs] = (cs.user, pop_id)
+		cs.evt.on_open()
+		return cs
+	
+	def get_roster_single(self) -> List[ChatSession]:
+		sess_per_user = [] # type: List[ChatSession]
+		for cs in self._users_by_sess.keys():
+			already_in_roster = False
+			for sess1 in sess_per_user:
+				if cs.primary_pop:
+					if sess1.user is cs.user:
+						already_in_roster = True
+					break
+			if not already_in_roster:
+				sess_per_user.append(cs)
+		return sess_per_user
+	
+	def send_participant_joined(self, cs: ChatSession) -> None:
+		cs.joined = True
+		tmp = [cs_self for cs_self in self.get_roster() if cs_self.user is cs.user and cs_self is not cs]
+		first_pop = not tmp
+		for cs_other in self.get_roster():
+			cs_other.evt.on_participant_joined(cs, first_pop)
+
+class _NullHandler:
+	# Leaves only the roster bookkeeping and the fan-out loop
+	def __init__(self, user: User) -> None:
+		self.ctrl = self
+	
+	def on_open(self) -> None:
+		pass
+	
+	def on_participant_joined(self, cs_other: ChatSession, first_pop: bool) -> None:
+		pass
+	
+	def flush(self) -> None:
+		pass
+
+class _Backend:
+	# Just what `Chat` needs from `Backend`
+	auth_service = AuthService
+	
+	def __init__(self) -> None:
+		self._chats_by_id = {} # type: Dict[Any, Chat]
+
+class _BackendSession:
+	def __init__(self, user: User) -> None:
+		self.user = user
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,121 @@
+from typing import Any, Union
+import asyncio, time
+
+from util import dispatch, metrics
+from util.misc import Logger
+from front.msn.entry import ListenerMSNP
+from front.msn.msnp import MSNPCtrl
+
+# Commands/s through `ListenerMSNP.data_received` for a mix of small `PNG`,
+# `CHG` and `UUX` commands: the old per-command `getattr` lookup, bare and with
+# hand-written timing, against the class-level `CommandTable`, bare and with
+# the default metrics hook. The handlers do nothing, so this is all framing and dispatch.
+# Run with `python -m script.bench_dispatch`.
+
+ROUNDS = 50000
+UUX_PAYLOAD = b'<Data><PSM>hello</PSM><CurrentMedia></CurrentMedia></Data>'
+ROUND = b''.join([
+	b'PNG\r\n',
+	b'CHG 1 NLN 2788999228:48\r\n',
+	'UUX 2 {}\r\n'.format(len(UUX_PAYLOAD)).encode('ascii') + UUX_PAYLOAD,
+])
+# Arriving the way a busy connection delivers them
+CHUNK_SIZE = 4096
+
+def main() -> None:
+	data = ROUND * ROUNDS
+	commands = ROUNDS * 3
+	chunks = [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+	
+	metrics_hook = dispatch._after_hooks[0]
+	for name, factory, with_hooks in (
+		('getattr', _GetattrCtrl, False),
+		('getattr + timing', _TimedGetattrCtrl, False),
+		('table', _Ctrl, False),
+		('table + metrics', _Ctrl, True),
+	):
+		if with_hooks:
+			dispatch.add_hook(metrics_hook)
+		else:
+			dispatch.remove_hook(metrics_hook)
+		listener = ListenerMSNP('BN', None, factory) # type: ignore
+		listener.connection_made(_Transport())
+		start = time.perf_counter()
+		for chunk in chunks:
+			listener.data_received(chunk)
+		elapsed = time.perf_counter() - start
+		assert listener.controller.handled == commands # type: ignore
+		print("{:16} {:9.0f} commands/s  {:5.2f}us per command".format(name, commands / elapsed, elapsed / commands * 1e6))
+
+class _Ctrl(MSNPCtrl):
+	__slots__ = ('handled',)
+	
+	handled: int
+	
+	frontend_name = 'bench'
+	
+	def __init__(self, logger: Logger, via: str, backend: Any) -> None:
+		super().__init__(logger)
+		self.handled = 0
+	
+	def on_connect(self) -> None:
+		pass
+	
+	def _on_close(self) -> None:
+		pass
+	
+	def _m_png(self) -> None:
+		self.handled += 1
+	
+	def _m_chg(self, trid: str, sts_name: str, capabilities: str) -> None:
+		self.handled += 1
+	
+	def _m_uux(self, trid: str, data: bytes) -> None:
+		self.handled += 1
+
+class _GetattrCtrl(_Ctrl):
+	__slots__ = ()
+	
+	def data_received(self, transport: Any, data: bytes) -> None:
+		# The dispatch loop before `CommandTable`
+		self.peername = transport.get_extra_info('peername')
+		for m in self.reader.data_received(data):
+			try:
+				f = getattr(self, '_m_{}'.format(m[0].lower()))
+				f(*m[1:])
+			except Exception as ex:
+				self.logger.error(ex)
+
+class _TimedGetattrCtrl(_Ctrl):
+	__slots__ = ()
+	
+	def data_received(self, transport: Any, data: bytes) -> None:
+		# The same, timing each command into `metrics` by hand
+		self.peername = transport.get_extra_info('peername')
+		for m in self.reader.data_received(data):
+			cmd = m[0].lower()
+			try:
+				f = getattr(self, '_m_{}'.format(cmd))
+			except AttributeError as ex:
+				self.logger.error(ex)
+				continue
+			start = time.perf_counter()
+			try:
+				f(*m[1:])
+			except Exception as ex:
+				metrics.command_errors.inc(self.frontend_name, cmd)
+				self.logger.error(ex)
+			metrics.command_time.labels(self.frontend_name, cmd).observe(time.perf_counter() - start)
+
+class _Transport(asyncio.WriteTransport):
+	def get_extra_info(self, name: str, default: Any = None) -> Any:
+		return ('127.0.0.1', 1863)
+	
+	def write(self, data: Union[bytes, bytearray, memoryview]) -> None:
+		pass
+	
+	def close(self) -> None:
+		pass
+
+if __name__ == '__main__':
+	main()
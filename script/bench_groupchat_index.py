@@ -0,0 +1,64 @@
+from typing import List
+import time
+
+from core import db
+from core.models import User, GroupChat, GroupChatRole, GroupChatState
+from core.user import UserService
+
+from script.benchutil import temp_db, populate_users, StatementCounter
+
+# Cost of finding a user's group chats, as done for every presence change, with
+# 10k circles in the database: the old full-table scan versus the membership index.
+# Run with `python -m script.bench_groupchat_index`.
+
+CIRCLES = 10000
+MEMBERS_PER_CIRCLE = 5
+USERS = 2000
+LOOKUPS = 200
+
+def main() -> None:
+	with temp_db() as engine:
+		uuids = populate_users(USERS, 0)
+		with db.Session() as sess:
+			for i in range(CIRCLES):
+				dbgroupchat = db.GroupChat(
+					chat_id = '{:012x}'.format(i), name = 'Circle {}'.format(i),
+					owner_id = 1, owner_uuid = uuids[0], owner_friendly = 'Bench', membership_access = 0, request_membership_option = 0,
+				)
+				for j in range(MEMBERS_PER_CIRCLE):
+					dbgroupchat.add_membership(uuids[(i * 7 + j * 131) % USERS], int(GroupChatRole.Member), int(GroupChatState.Accepted))
+				sess.add(dbgroupchat)
+		
+		user_service = UserService()
+		users = [user_service.get(uuid) for uuid in uuids[:LOOKUPS]]
+		counter = StatementCounter(engine)
+		
+		for name, lookup in [('full scan (old)', _old_get_groupchat_batch), ('membership index', UserService.get_groupchat_batch)]:
+			# First pass also builds the index/fills the caches; report the steady state
+			for user in users[:1]:
+				assert user is not None
+				lookup(user_service, user)
+			counter.reset()
+			start = time.perf_counter()
+			found = 0
+			for user in users:
+				assert user is not None
+				found += len(lookup(user_service, user))
+			elapsed = time.perf_counter() - start
+			print("{:18} {:9.3f}ms per presence change  {:5.1f} statements  {:4.1f} circles per user".format(
+				name, elapsed / len(users) * 1000, counter.reset() / len(users), found / len(users),
+			))
+
+def _old_get_groupchat_batch(user_service: UserService, user: User) -> List[GroupChat]:
+	# `UserService.get_groupchat_batch` before the membership index
+	groupchats = []
+	with db.Session() as sess:
+		for dbgroupchat in sess.query(db.GroupChat):
+			if dbgroupchat.get_membership(user.uuid) is None: continue
+			groupchat = user_service.get_groupchat(dbgroupchat.chat_id)
+			if groupchat is None: continue
+			groupchats.append(groupchat)
+	return groupchats
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,33 @@
+import time
+
+from core.user import UserService
+
+from script.benchutil import temp_db, populate_users, StatementCounter
+
+# Simulates a login burst right after a restart: every user's record and
+# contact list is loaded into a cold `UserService`, counting DB round trips.
+# Run with `python -m script.bench_login_burst`.
+
+USERS = 2000
+CONTACTS_PER_USER = 50
+
+def main() -> None:
+	with temp_db() as engine:
+		uuids = populate_users(USERS, CONTACTS_PER_USER)
+		user_service = UserService()
+		counter = StatementCounter(engine)
+		
+		start = time.perf_counter()
+		for uuid in uuids:
+			user = user_service.get(uuid)
+			detail = user_service.get_detail(uuid)
+			assert user is not None and detail is not None
+		elapsed = time.perf_counter() - start
+		statements = counter.reset()
+		
+		print("{} logins, {} contacts each".format(USERS, CONTACTS_PER_USER))
+		print("statements {:8}  ({:.2f} per login)".format(statements, statements / USERS))
+		print("wall time  {:8.3f}s ({:.2f}ms per login)".format(elapsed, elapsed / USERS * 1000))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,79 @@
+from typing import Any
+import asyncio, time
+
+import sqlalchemy as sa
+
+from util import metrics
+from util.misc import Logger
+from front.msn.msnp import MSNPCtrl
+
+# What the `/metrics` instrumentation costs: MSNP command dispatch with and
+# without the per-command histogram, a SQLite statement with and without the
+# query timing hooks, and rendering a scrape with every frontend's commands in it.
+# Run with `python -m script.bench_metrics`.
+
+COMMANDS = 200000
+QUERIES = 20000
+
+def main() -> None:
+	data = b'PNG\r\n' * COMMANDS
+	for name, ctrl in (('uninstrumented', _UninstrumentedCtrl()), ('instrumented', _Ctrl())):
+		start = time.perf_counter()
+		ctrl.data_received(_Transport(), data)
+		elapsed = time.perf_counter() - start
+		print("{:16} {:6.2f}us per command".format(name, elapsed / COMMANDS * 1e6))
+	
+	for name, timed in (('untimed', False), ('timed', True)):
+		engine = sa.create_engine('sqlite://')
+		if timed:
+			metrics.time_queries(engine, 'bench')
+		with engine.connect() as conn:
+			start = time.perf_counter()
+			for _ in range(QUERIES):
+				conn.execute('SELECT 1').fetchall()
+			elapsed = time.perf_counter() - start
+		print("{:16} {:6.2f}us per query".format(name, elapsed / QUERIES * 1e6))
+	
+	for frontend in ('msnp-ns', 'msnp-sb', 'ymsg', 'irc'):
+		for i in range(50):
+			metrics.command_time.labels(frontend, 'cmd{}'.format(i)).observe(0.001)
+	start = time.perf_counter()
+	text = metrics.registry.render()
+	print("{:16} {:6.2f}ms per scrape ({} bytes)".format('render', (time.perf_counter() - start) * 1000, len(text)))
+
+class _Ctrl(MSNPCtrl):
+	__slots__ = ()
+	
+	frontend_name = 'bench'
+	
+	def __init__(self) -> None:
+		super().__init__(Logger('BN', self))
+	
+	def on_connect(self) -> None:
+		pass
+	
+	def _on_close(self) -> None:
+		pass
+	
+	def _m_png(self) -> None:
+		pass
+
+class _UninstrumentedCtrl(_Ctrl):
+	__slots__ = ()
+	
+	def data_received(self, transport: Any, data: bytes) -> None:
+		# The dispatch loop before it was timed
+		self.peername = transport.get_extra_info('peername')
+		for m in self.reader.data_received(data):
+			try:
+				f = getattr(self, '_m_{}'.format(m[0].lower()))
+				f(*m[1:])
+			except Exception as ex:
+				self.logger.error(ex)
+
+class _Transport(asyncio.Transport):
+	def get_extra_info(self, name: str, default: Any = None) -> Any:
+		return ('127.0.0.1', 1863)
+
+if __name__ == '__main__':
+	main()
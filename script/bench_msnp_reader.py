@@ -0,0 +1,76 @@
+from typing import List, Tuple
+import time
+
+from util.misc import Logger
+from front.msn.msnp import MSNPReader
+
+# Parse throughput of `MSNPReader` (MB/s and commands/s) over a synthetic client
+# transcript for each dialect, fed in full-size and in small TCP segments.
+# Run with `python -m script.bench_msnp_reader`.
+
+DIALECTS = [2, 5, 8, 11, 12, 13, 15, 18]
+SEGMENT_SIZES = [1460, 64]
+ROUNDS = 20
+CONTACTS = 500
+
+def main() -> None:
+	logger = _QuietLogger()
+	for dialect in DIALECTS:
+		data, commands = _transcript(dialect)
+		for segment in SEGMENT_SIZES:
+			chunks = [data[i:i + segment] for i in range(0, len(data), segment)]
+			start = time.perf_counter()
+			parsed = 0
+			for _ in range(ROUNDS):
+				reader = MSNPReader(logger)
+				for chunk in chunks:
+					for _ in reader.data_received(chunk):
+						parsed += 1
+			elapsed = time.perf_counter() - start
+			assert parsed == commands * ROUNDS
+			print("MSNP{:<3} {:5}B segments  {:8.2f} MB/s  {:10.0f} commands/s".format(
+				dialect, segment, len(data) * ROUNDS / elapsed / 1e6, parsed / elapsed,
+			))
+
+def _transcript(dialect: int) -> Tuple[bytes, int]:
+	lines = [] # type: List[bytes]
+	trid = 0
+	
+	def cmd(line: str, payload: bytes = b'') -> None:
+		nonlocal trid
+		trid += 1
+		if payload:
+			lines.append('{} {}\r\n'.format(line.format(trid), len(payload)).encode('utf-8') + payload)
+		else:
+			lines.append('{}\r\n'.format(line.format(trid)).encode('utf-8'))
+	
+	cmd('VER {{}} MSNP{} CVR0'.format(dialect))
+	cmd('CVR {} 0x0409 winnt 5.1 i386 MSNMSGR 8.5.1302 msmsgs bench@example.com')
+	cmd('USR {} TWN I bench@example.com')
+	cmd('USR {} TWN S t=ticket&p=profile')
+	if dialect < 13:
+		cmd('SYN {} 0 0')
+	else:
+		ml = '<ml l="1"><d n="example.com">{}</d></ml>'.format(''.join(
+			'<c n="contact{}" l="3" t="1" />'.format(i) for i in range(CONTACTS)
+		))
+		cmd('ADL {}', ml.encode('utf-8'))
+	cmd('CHG {} NLN 0')
+	if dialect >= 11:
+		cmd('UUX {}', '<Data><PSM>{}</PSM><CurrentMedia></CurrentMedia></Data>'.format('x' * 100).encode('utf-8'))
+	for i in range(200):
+		cmd('PNG')
+		cmd('MSG {} N', 'MIME-Version: 1.0\r\nContent-Type: text/plain; charset=UTF-8\r\n\r\nmessage {}'.format(i).encode('utf-8'))
+	cmd('OUT')
+	return b''.join(lines), len(lines)
+
+class _QuietLogger(Logger):
+	def __init__(self) -> None:
+		self.prefix = 'bench'
+		self._log = False
+	
+	def info(self, *args: object) -> None:
+		pass
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,98 @@
+from typing import Any, Iterable, List, Union
+import asyncio, contextlib, io, os, time
+
+from util.misc import Logger
+from front.msn.msnp import MSNPCtrl
+
+# Messages/s and transport writes for an SB chat fanning messages out to every
+# participant, with the old per-reply write path and the coalescing `send_reply`.
+# Run with `python -m script.bench_msnp_writer`.
+
+PARTICIPANTS = 50
+MESSAGES = 2000
+# Messages that arrive within one event loop turn
+MESSAGES_PER_TURN = 10
+
+def main() -> None:
+	loop = asyncio.get_event_loop()
+	payload = b'MIME-Version: 1.0\r\nContent-Type: text/plain; charset=UTF-8\r\nX-MMS-IM-Format: FN=Segoe%20UI; EF=; CO=0; CS=1; PF=0\r\n\r\n' + b'hello there ' * 5
+	
+	for name, ctrl_factory in [('before', _LegacyCtrl), ('after', _BenchCtrl)]:
+		ctrls = [ctrl_factory(_QuietLogger()) for _ in range(PARTICIPANTS)]
+		transports = [_CountingTransport() for _ in ctrls]
+		for ctrl, transport in zip(ctrls, transports):
+			ctrl.transport = transport
+		
+		async def run() -> None:
+			for i in range(MESSAGES):
+				for ctrl in ctrls:
+					ctrl.send_reply('MSG', 'alice@example.com', 'Alice Liddell', payload)
+				if i % MESSAGES_PER_TURN == MESSAGES_PER_TURN - 1:
+					await asyncio.sleep(0)
+			await asyncio.sleep(0)
+		
+		# The old writer printed every payload; send that somewhere cheap rather than the terminal
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+			start = time.perf_counter()
+			loop.run_until_complete(run())
+			elapsed = time.perf_counter() - start
+		writes = sum(t.writes for t in transports)
+		assert all(t.nbytes == transports[0].nbytes for t in transports)
+		print("{:7} {:10.0f} messages/s delivered  {:7} transport writes  {:7.1f} KB per write".format(
+			name, MESSAGES * PARTICIPANTS / elapsed, writes, sum(t.nbytes for t in transports) / writes / 1024,
+		))
+
+class _BenchCtrl(MSNPCtrl):
+	__slots__ = ()
+	
+	def on_connect(self) -> None:
+		pass
+	
+	def _on_close(self) -> None:
+		pass
+
+class _LegacyCtrl(_BenchCtrl):
+	# `send_reply` and `MSNPWriter.write` as they were before output coalescing
+	__slots__ = ()
+	
+	def send_reply(self, *m: Any) -> None:
+		buf = io.BytesIO()
+		_legacy_write(buf, m)
+		transport = self.transport
+		if transport is not None:
+			transport.write(buf.getvalue())
+
+def _legacy_write(buf: io.BytesIO, m: Iterable[Any]) -> None:
+	m = list(m)
+	data = None
+	if isinstance(m[-1], bytes):
+		data = m[-1]
+		m[-1] = len(data)
+	mt = tuple(str(x).replace(' ', '%20') for x in m if x is not None)
+	w = buf.write
+	w(' '.join(mt).encode('utf-8'))
+	w(b'\r\n')
+	if data is not None:
+		w(data)
+		print(data)
+
+class _CountingTransport(asyncio.WriteTransport):
+	def __init__(self) -> None:
+		super().__init__()
+		self.writes = 0
+		self.nbytes = 0
+	
+	def write(self, data: Union[bytes, bytearray, memoryview]) -> None:
+		self.writes += 1
+		self.nbytes += len(data)
+
+class _QuietLogger(Logger):
+	def __init__(self) -> None:
+		self.prefix = 'bench'
+		self._log = False
+	
+	def info(self, *args: object) -> None:
+		pass
+
+if __name__ == '__main__':
+	main()
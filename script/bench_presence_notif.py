@@ -0,0 +1,73 @@
+from typing import Any, Dict, List
+from datetime import datetime
+import time
+
+from core.models import User, UserStatus, UserDetail, Contact, ContactDetail, Lst, Substatus
+from front.msn.misc import build_presence_notif, presence_render_cache_stats
+
+# CPU per status change when one user's presence is rendered for 800 online
+# watchers spread over MSNP8-18, with and without the presence render cache.
+# Run with `python -m script.bench_presence_notif`.
+
+WATCHERS = 800
+DIALECTS = [8, 9, 11, 12, 13, 15, 16, 18]
+CHANGES = 50
+
+def main() -> None:
+	subject = _user('subject', 0)
+	subject.status.substatus = Substatus.Online
+	subject.status.set_status_message('listening to <things> & stuff')
+	subject.status.media = 'Music\\0Artist - Title'
+	backend = _Backend()
+	subject_sess = _Sess(subject, {
+		'msn': True, 'msn_capabilities': 2788999228, 'msn_capabilitiesex': 48, 'msn_pop_id': '8b0b42a5-5a0e-4e1b-9a2d-5ae3b6b43d17',
+		'msn_machineguid': '{8B0B42A5-5A0E-4E1B-9A2D-5AE3B6B43D17}', 'msn_sigsound': '', 'msn_msnobj_scene': '', 'msn_colorscheme': '-3',
+		'msn_msnobj': '<msnobj Creator="subject@example.com" Size="22344" Type="3" Location="0" Friendly="AAA=" SHA1D="trC8SlFx2sWQxZMIBAWSEnXc8oQ=" SHA1C="UU+o8PMB+Ow9w7UqpnbmLrRb/nY="/>',
+	})
+	backend.sessions[subject.uuid] = [subject_sess]
+	
+	watchers = []
+	for i in range(WATCHERS):
+		watcher = _user('watcher{}'.format(i), i + 1)
+		assert watcher.detail is not None
+		watcher.detail.contacts[subject.uuid] = Contact(subject, set(), Lst.FL | Lst.AL, subject.status, ContactDetail('2'))
+		watchers.append((watcher, DIALECTS[i % len(DIALECTS)]))
+	
+	for name, cached in [('uncached', False), ('cached', True)]:
+		start_stats = presence_render_cache_stats()
+		start = time.process_time()
+		for i in range(CHANGES):
+			subject.presence_version += 1
+			for watcher, dialect in watchers:
+				if not cached:
+					# Forces a miss for every watcher, i.e. the old behaviour
+					subject.presence_version += 1
+				for _ in build_presence_notif(None, subject, watcher, dialect, backend, True): pass # type: ignore
+		elapsed = time.process_time() - start
+		stats = presence_render_cache_stats()
+		hits = stats['hits'] - start_stats['hits']
+		misses = stats['misses'] - start_stats['misses']
+		print("{:9} {:8.2f}ms CPU per status change  hit rate {:5.1f}%".format(
+			name, elapsed / CHANGES * 1000, hits / max(1, hits + misses) * 100,
+		))
+
+def _user(name: str, id: int) -> User:
+	user = User(id, '00000000-0000-0000-0000-{:012}'.format(id), '{}@example.com'.format(name), True, UserStatus(name), {}, datetime.utcnow())
+	user.detail = UserDetail()
+	return user
+
+class _Sess:
+	def __init__(self, user: User, front_data: Dict[str, Any]) -> None:
+		self.user = user
+		self.front_data = front_data
+
+class _Backend:
+	# Just what `build_presence_notif` needs from `Backend`
+	def __init__(self) -> None:
+		self.sessions = {} # type: Dict[str, List[_Sess]]
+	
+	def util_get_sessions_by_user(self, user: User) -> List[_Sess]:
+		return self.sessions.get(user.uuid, [])
+
+if __name__ == '__main__':
+	main()
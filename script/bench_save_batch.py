@@ -0,0 +1,70 @@
+from typing import Callable, List, Tuple
+import time
+
+from core.models import Lst, Contact, ContactDetail, UserStatus
+from core.user import UserService
+
+from script.benchutil import temp_db, populate_users, StatementCounter
+
+# Reports SQL statements and wall time for `UserService.save_batch` on a
+# 1000-contact list, for a few typical kinds of change.
+# Run with `python -m script.bench_save_batch`.
+
+USERS = 1001
+CONTACTS_PER_USER = 1000
+ROUNDS = 5
+
+def main() -> None:
+	with temp_db() as engine:
+		uuids = populate_users(USERS, 0)
+		user_service = UserService()
+		user = user_service.get(uuids[0])
+		detail = user_service.get_detail(uuids[0])
+		assert user is not None and detail is not None
+		counter = StatementCounter(engine)
+		
+		for i, uuid in enumerate(uuids[1:CONTACTS_PER_USER + 1]):
+			head = user_service.get(uuid)
+			assert head is not None
+			detail.contacts[uuid] = Contact(head, set(), Lst.FL | Lst.AL, UserStatus(head.status.name), ContactDetail(str(i + 2)))
+		counter.reset()
+		start = time.perf_counter()
+		user_service.save_batch([(user, detail)])
+		print("{:22} {:6} statements  {:8.2f}ms".format('initial insert', counter.reset(), (time.perf_counter() - start) * 1000))
+		contacts = list(detail.contacts.values())
+		
+		def unchanged() -> None:
+			pass
+		
+		def rename_one() -> None:
+			contacts[0].status.name = (contacts[0].status.name or '') + '.'
+		
+		def move_ten() -> None:
+			for ctc in contacts[:10]:
+				ctc.lists ^= Lst.BL
+		
+		def rename_all() -> None:
+			for ctc in contacts:
+				ctc.status.name = (ctc.status.name or '') + '.'
+		
+		def status_message() -> None:
+			user.status.set_status_message(user.status.message + '.')
+		
+		scenarios = [
+			('unchanged', unchanged), ('rename 1 contact', rename_one), ('toggle BL on 10', move_ten),
+			('rename all contacts', rename_all), ('own status message', status_message),
+		] # type: List[Tuple[str, Callable[[], None]]]
+		for name, change in scenarios:
+			statements = 0
+			elapsed = 0.0
+			for _ in range(ROUNDS):
+				change()
+				counter.reset()
+				start = time.perf_counter()
+				user_service.save_batch([(user, detail)])
+				elapsed += time.perf_counter() - start
+				statements += counter.reset()
+			print("{:22} {:6.1f} statements  {:8.2f}ms per save".format(name, statements / ROUNDS, elapsed / ROUNDS * 1000))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,139 @@
+from typing import Any, List, Tuple
+import time
+
+import lxml.etree
+import lxml.objectify
+
+from front.msn import http
+
+# Parse + field lookup cost per SOAP request, for the old objectify path and the
+# `lxml.etree` one `front.msn.http` uses now, replaying typical request bodies
+# with the lookups their handlers do.
+# Run with `python -m script.bench_soap`.
+
+ROUNDS = 5000
+
+_ENVELOPE = '''<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+	<soap:Header>{header}</soap:Header>
+	<soap:Body>{body}</soap:Body>
+</soap:Envelope>'''
+
+_AB_HEADER = '''<ABApplicationHeader xmlns="http://www.msn.com/webservices/AddressBook">
+	<ApplicationId>CFE80F9D-180F-4399-82AB-413F33A1FA11</ApplicationId>
+	<IsMigration>false</IsMigration>
+	<PartnerScenario>ContactSave</PartnerScenario>
+</ABApplicationHeader>
+<ABAuthHeader xmlns="http://www.msn.com/webservices/AddressBook">
+	<ManagedGroupRequest>false</ManagedGroupRequest>
+	<TicketToken>t=0123456789abcdefghij&amp;p=</TicketToken>
+</ABAuthHeader>'''
+
+_AB_CONTACT_ADD = '''<ABContactAdd xmlns="http://www.msn.com/webservices/AddressBook">
+	<abId>00000000-0000-0000-0000-000000000000</abId>
+	<contacts><Contact><contactInfo>
+		<contactType>LivePending</contactType>
+		<passportName>foo@example.com</passportName>
+		<isMessengerUser>true</isMessengerUser>
+		<MessengerMemberInfo><DisplayName>foo</DisplayName></MessengerMemberInfo>
+		<annotations><Annotation><Name>AB.NickName</Name><Value>bar</Value></Annotation></annotations>
+	</contactInfo></Contact></contacts>
+	<options><EnableAllowListManagement>true</EnableAllowListManagement></options>
+</ABContactAdd>'''
+
+_ADD_MEMBER = '''<AddMember xmlns="http://www.msn.com/webservices/AddressBook">
+	<serviceHandle><Id>0</Id><Type>Messenger</Type><ForeignId></ForeignId></serviceHandle>
+	<memberships><Membership>
+		<MemberRole>Allow</MemberRole>
+		<Members><Member xsi:type="PassportMember">
+			<Type>Passport</Type><State>Accepted</State><PassportName>foo@example.com</PassportName>
+		</Member></Members>
+	</Membership></memberships>
+</AddMember>'''
+
+_AB_FIND_ALL = '''<ABFindAll xmlns="http://www.msn.com/webservices/AddressBook">
+	<abId>00000000-0000-0000-0000-000000000000</abId>
+	<abView>Full</abView>
+	<deltasOnly>true</deltasOnly>
+	<lastChange>2009-01-01T00:00:00.0000000-08:00</lastChange>
+</ABFindAll>'''
+
+_RSI_HEADER = '''<PassportCookie xmlns="http://www.hotmail.msn.com/ws/2004/09/oim/rsi">
+	<t>0123456789abcdefghij</t><p>p</p>
+</PassportCookie>'''
+
+_RSI_GET_MESSAGE = '''<GetMessage xmlns="http://www.hotmail.msn.com/ws/2004/09/oim/rsi">
+	<messageId>4B5B1A5C-7E7A-4F4B-9C1E-3C0E0E0E0E0E</messageId>
+	<alsoMarkAsRead>false</alsoMarkAsRead>
+</GetMessage>'''
+
+_OIM_HEADER = '''<From memberName="foo@example.com" friendlyName="=?utf-8?B?Zm9v?=" xml:lang="en-US" proxy="MSNMSGR" xmlns="http://messenger.msn.com/ws/2004/09/oim/" msnpVer="MSNP15" buildVer="8.5.1288.816"/>
+<To memberName="bar@example.com" xmlns="http://messenger.msn.com/ws/2004/09/oim/"/>
+<Ticket passport="t=0123456789abcdefghij&amp;p=" appid="PROD01065C%ZFN6F" lockkey="lockkey" xmlns="http://messenger.msn.com/ws/2004/09/oim/"/>
+<Sequence xmlns="http://schemas.xmlsoap.org/ws/2003/03/rm">
+	<Identifier xmlns="http://schemas.xmlsoap.org/ws/2002/07/utility">http://messenger.msn.com</Identifier>
+	<MessageNumber>1</MessageNumber>
+</Sequence>'''
+
+_OIM_STORE = '''<MessageType xmlns="http://messenger.msn.com/ws/2004/09/oim/">text</MessageType>
+<Content xmlns="http://messenger.msn.com/ws/2004/09/oim/">MIME-Version: 1.0
+Content-Type: text/plain; charset=UTF-8
+Content-Transfer-Encoding: base64
+X-OIM-Message-Type: OfflineMessage
+X-OIM-Run-Id: {3A3BE82C-1A4A-4B4B-8D8D-0C0C0C0C0C0C}
+X-OIM-Sequence-Num: 1
+
+{content}
+</Content>'''.replace('{content}', 'SGVsbG8sIHdvcmxkIQ==\n' * 40)
+
+CASES = [
+	('ABContactAdd', _AB_HEADER, _AB_CONTACT_ADD, [
+		'TicketToken', 'Header', 'Body/*[1]', 'deltasOnly', 'DeltasOnly', 'abId', 'contacts/Contact',
+		'contactType', 'passportName', 'Name', 'Value',
+	]),
+	('AddMember', _AB_HEADER, _ADD_MEMBER, [
+		'TicketToken', 'Header', 'Body/*[1]', 'deltasOnly', 'DeltasOnly', 'MemberRole', 'Type', 'State', 'PassportName',
+	]),
+	('ABFindAll (deltas)', _AB_HEADER, _AB_FIND_ALL, [
+		'TicketToken', 'Header', 'Body/*[1]', 'deltasOnly', 'lastChange', 'abId',
+	]),
+	('RSI GetMessage', _RSI_HEADER, _RSI_GET_MESSAGE, [
+		'Header', 'Body/*[1]', 'messageId', 'alsoMarkAsRead',
+	]),
+	('OIM Store', _OIM_HEADER, _OIM_STORE, [
+		'Header', 'Body/MessageType', 'Body/Content', 'Sequence/MessageNumber',
+	]),
+] # type: List[Tuple[str, str, str, List[str]]]
+
+def main() -> None:
+	for name, header, body, queries in CASES:
+		data = _ENVELOPE.format(header = header, body = body).encode('utf-8')
+		
+		start = time.perf_counter()
+		for _ in range(ROUNDS):
+			root = lxml.objectify.fromstring(data)
+			for query in queries:
+				_legacy_find_element(root, query)
+		legacy = (time.perf_counter() - start) / ROUNDS
+		
+		start = time.perf_counter()
+		for _ in range(ROUNDS):
+			parser = lxml.etree.XMLParser(resolve_entities = False, no_network = True)
+			parser.feed(data)
+			root = parser.close()
+			for query in queries:
+				http._find_element(root, query)
+		current = (time.perf_counter() - start) / ROUNDS
+		
+		print("{:20} {:6} bytes  objectify {:7.1f}us  etree {:7.1f}us".format(name, len(data), legacy * 1e6, current * 1e6))
+
+def _legacy_find_element(xml: Any, query: str) -> Any:
+	thing = xml.find('.//{*}' + query.replace('/', '/{*}'))
+	if isinstance(thing, lxml.objectify.StringElement):
+		thing = str(thing)
+	elif isinstance(thing, lxml.objectify.BoolElement):
+		thing = bool(thing)
+	return thing
+
+if __name__ == '__main__':
+	main()
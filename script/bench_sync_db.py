@@ -0,0 +1,59 @@
+from typing import List, Tuple
+import asyncio
+
+from core.models import User, UserDetail
+from core.user import UserService
+
+from script.benchutil import temp_db, populate_users, measure_loop_lag, pct
+
+# Measures event loop lag while a 1000-user contact list save runs,
+# once with the blocking `save_batch` and once with `save_batch_async`.
+# Run with `python -m script.bench_sync_db`.
+
+USERS = 1000
+CONTACTS_PER_USER = 20
+BATCH_SIZE = 100
+
+def main() -> None:
+	with temp_db():
+		uuids = populate_users(USERS, CONTACTS_PER_USER)
+		user_service = UserService()
+		batch = _load(user_service, uuids)
+		
+		async def blocking() -> None:
+			for i in range(0, len(batch), BATCH_SIZE):
+				chunk = batch[i:i + BATCH_SIZE]
+				_touch(chunk)
+				user_service.save_batch(chunk)
+				await asyncio.sleep(0)
+		
+		async def threaded() -> None:
+			for i in range(0, len(batch), BATCH_SIZE):
+				chunk = batch[i:i + BATCH_SIZE]
+				_touch(chunk)
+				await user_service.save_batch_async(chunk)
+		
+		loop = asyncio.get_event_loop()
+		for name, job in [('save_batch', blocking), ('save_batch_async', threaded)]:
+			total, lags = loop.run_until_complete(measure_loop_lag(job))
+			print("{:18} total {:7.3f}s  lag p50 {:7.2f}ms  p99 {:7.2f}ms  max {:7.2f}ms".format(
+				name, total, pct(lags, 50) * 1000, pct(lags, 99) * 1000, max(lags or [0]) * 1000,
+			))
+
+def _load(user_service: UserService, uuids: List[str]) -> List[Tuple[User, UserDetail]]:
+	batch = []
+	for uuid in uuids:
+		user = user_service.get(uuid)
+		detail = user_service.get_detail(uuid)
+		assert user is not None and detail is not None
+		batch.append((user, detail))
+	return batch
+
+def _touch(batch: List[Tuple[User, UserDetail]]) -> None:
+	# Rename every contact so each save has rows to write
+	for _, detail in batch:
+		for ctc in detail.contacts.values():
+			ctc.status.name = (ctc.status.name or '') + '.'
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,78 @@
+from typing import Any, List
+import asyncio, time, tracemalloc
+
+from util.timer import TimerWheel
+from script.benchutil import measure_loop_lag, pct
+
+# What 50k connection timeouts cost with one sleeping task per connection (the
+# old SB auth deadline and yfs expiry), with `loop.call_later` and with the
+# shared `TimerWheel`: tasks alive, memory, schedule/cancel time, and how late a
+# 1ms ticker gets woken up while they're all pending. Also times the 10s scan
+# over every session the closed-session reaper used to do.
+# Run with `python -m script.bench_timers`.
+
+CONNECTIONS = 50000
+DEADLINE = 60
+
+def main() -> None:
+	asyncio.run(_main())
+
+async def _main() -> None:
+	loop = asyncio.get_event_loop()
+	
+	async def sleeper() -> None:
+		await asyncio.sleep(DEADLINE)
+	
+	def make_tasks() -> List[Any]:
+		return [loop.create_task(sleeper()) for _ in range(CONNECTIONS)]
+	
+	def make_handles() -> List[Any]:
+		return [loop.call_later(DEADLINE, _noop) for _ in range(CONNECTIONS)]
+	
+	wheel = TimerWheel(loop)
+	
+	def make_timers() -> List[Any]:
+		return [wheel.call_later(DEADLINE, _noop) for _ in range(CONNECTIONS)]
+	
+	for name, make in (('task per conn', make_tasks), ('loop.call_later', make_handles), ('TimerWheel', make_timers)):
+		tracemalloc.start()
+		start = time.perf_counter()
+		items = make()
+		scheduled = time.perf_counter() - start
+		# Tasks only allocate their frames once they first run
+		await asyncio.sleep(0)
+		memory = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		tasks = len(asyncio.all_tasks())
+		
+		async def idle() -> None:
+			await asyncio.sleep(1)
+		_, lags = await measure_loop_lag(idle)
+		
+		start = time.perf_counter()
+		for item in items:
+			item.cancel()
+		cancelled = time.perf_counter() - start
+		await asyncio.sleep(0)
+		
+		print("{:16} {:6} tasks {:8.1f}MB  schedule {:5.2f}us  cancel {:5.2f}us  lag p50 {:6.3f}ms p99 {:6.3f}ms".format(
+			name, tasks, memory / 1e6, scheduled / CONNECTIONS * 1e6, cancelled / CONNECTIONS * 1e6,
+			pct(lags, 50) * 1000, pct(lags, 99) * 1000,
+		))
+	
+	sessions = [_Session() for _ in range(CONNECTIONS)]
+	start = time.perf_counter()
+	closed = [sess for sess in sessions if sess.closed]
+	print("{:16} {:8.2f}ms per 10s scan of {} sessions".format('session reaper', (time.perf_counter() - start) * 1000, len(sessions)))
+
+class _Session:
+	__slots__ = ('closed',)
+	
+	def __init__(self) -> None:
+		self.closed = False
+
+def _noop() -> None:
+	pass
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,67 @@
+from typing import List
+import time
+
+from util.misc import Logger, MultiDict
+from front.ymsg.misc import YMSGService, YMSGStatus
+from front.ymsg.ymsg_ctrl import YMSGEncoder, YMSGDecoder, KVS
+
+# Packets/s through `YMSGDecoder` for a burst of logins and for large `List` (0x55)
+# packets, fed whole and in small TCP segments.
+# Run with `python -m script.bench_ymsg_decoder`.
+
+LOGINS = 5000
+LIST_PACKETS = 200
+LIST_CONTACTS = 1000
+SEGMENT_SIZES = [1460, 64]
+
+def main() -> None:
+	logger = _QuietLogger()
+	
+	login_burst = []
+	for i in range(LOGINS):
+		login_burst.append(_encode(logger, YMSGService.Handshake, 0, MultiDict()))
+		login_burst.append(_encode(logger, YMSGService.Auth, i, MultiDict([(b'1', 'user{}'.format(i).encode('utf-8'))])))
+		login_burst.append(_encode(logger, YMSGService.AuthResp, i, MultiDict([
+			(b'1', 'user{}'.format(i).encode('utf-8')), (b'0', 'user{}'.format(i).encode('utf-8')),
+			(b'277', b'x' * 40), (b'278', b'y' * 40), (b'307', b'z' * 24), (b'244', b'4194239'),
+			(b'2', 'user{}'.format(i).encode('utf-8')), (b'2', b'1'), (b'59', b'B\t' + b'c' * 60), (b'98', b'us'), (b'135', b'9.0.0.2162'),
+		])))
+	
+	contacts = ','.join('contact{}'.format(i) for i in range(LIST_CONTACTS)).encode('utf-8')
+	list_kvs = MultiDict([(b'87', b'Friends:' + contacts + b'\n'), (b'88', b''), (b'89', b'user0'), (b'59', b'T\tz=' + b'a' * 200), (b'3', b'user0')]) # type: KVS
+	big_list = [_encode(logger, YMSGService.List, 1, list_kvs) for _ in range(LIST_PACKETS)]
+	
+	for name, packets in [('login burst', login_burst), ('List 0x55', big_list)]:
+		data = b''.join(packets)
+		for segment in SEGMENT_SIZES:
+			chunks = [data[i:i + segment] for i in range(0, len(data), segment)]
+			decoder = YMSGDecoder(logger)
+			decoded = 0
+			start = time.perf_counter()
+			for chunk in chunks:
+				for _ in decoder.data_received(chunk):
+					decoded += 1
+			elapsed = time.perf_counter() - start
+			assert decoded == len(packets)
+			print("{:12} {:5}B segments  {:10.0f} packets/s  {:8.2f} MB/s".format(
+				name, segment, decoded / elapsed, len(data) / elapsed / 1e6,
+			))
+
+def _encode(logger: Logger, service: YMSGService, session_id: int, kvs: KVS) -> bytes:
+	encoder = YMSGEncoder(logger)
+	encoder.encode(service, YMSGStatus.Available, session_id, kvs)
+	data = bytearray(encoder.flush())
+	# The encoder zeroes the version; clients send theirs
+	data[4:6] = b'\x00\x10'
+	return bytes(data)
+
+class _QuietLogger(Logger):
+	def __init__(self) -> None:
+		self.prefix = 'bench'
+		self._log = False
+	
+	def info(self, *args: object) -> None:
+		pass
+
+if __name__ == '__main__':
+	main()
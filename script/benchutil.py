@@ -0,0 +1,87 @@
+from typing import List, Tuple, Callable, Awaitable, Iterator, Any
+from contextlib import contextmanager
+from uuid import uuid4
+import asyncio, tempfile, time
+from pathlib import Path
+
+import sqlalchemy as sa
+
+from core import db
+from core.models import Lst
+
+# Shared helpers for the `script/bench_*.py` benchmarks.
+
+@contextmanager
+def temp_db() -> Iterator[Any]:
+	# Points `core.db` at a throwaway SQLite database for the duration of the benchmark
+	with tempfile.TemporaryDirectory() as tmp:
+		engine = sa.create_engine('sqlite:///{}'.format(Path(tmp) / 'bench.sqlite'))
+		db.session_factory.configure(bind = engine)
+		db.Base.metadata.create_all(engine)
+		try:
+			yield engine
+		finally:
+			engine.dispose()
+
+class StatementCounter:
+	__slots__ = ('count',)
+	
+	count: int
+	
+	def __init__(self, engine: Any) -> None:
+		self.count = 0
+		sa.event.listen(engine, 'before_cursor_execute', self._on_execute)
+	
+	def _on_execute(self, *args: Any) -> None:
+		self.count += 1
+	
+	def reset(self) -> int:
+		count = self.count
+		self.count = 0
+		return count
+
+def populate_users(n: int, contacts_per_user: int) -> List[str]:
+	# Every user gets the next `contacts_per_user` users on their FL/AL, with the matching RL
+	users = []
+	with db.Session() as sess:
+		for i in range(n):
+			dbuser = db.User(
+				uuid = str(uuid4()), email = 'bench{}@example.com'.format(i), verified = True,
+				name = 'Bench {}'.format(i), message = '', password = '', groups = [], settings = {},
+			)
+			sess.add(dbuser)
+			users.append(dbuser)
+		sess.flush()
+		contacts_per_user = min(contacts_per_user, n - 1)
+		for i, dbuser in enumerate(users):
+			for j in range(1, contacts_per_user + 1):
+				other = users[(i + j) % n]
+				sess.add(db.UserContact(
+					user_id = dbuser.id, user_uuid = dbuser.uuid, contact_id = other.id, uuid = other.uuid,
+					id = str(j + 1), name = other.name, message = '', lists = Lst.FL | Lst.AL | Lst.RL, groups = [], is_messenger_user = True,
+				))
+		return [dbuser.uuid for dbuser in users]
+
+async def measure_loop_lag(job: Callable[[], Awaitable[None]], *, tick: float = 0.001) -> Tuple[float, List[float]]:
+	# Runs `job` while a ticker records how late each `sleep(tick)` wakes up
+	lags = [] # type: List[float]
+	done = False
+	
+	async def ticker() -> None:
+		while not done:
+			t = time.perf_counter()
+			await asyncio.sleep(tick)
+			lags.append(max(0.0, time.perf_counter() - t - tick))
+	
+	task = asyncio.ensure_future(ticker())
+	start = time.perf_counter()
+	await job()
+	total = time.perf_counter() - start
+	done = True
+	await task
+	return total, lags
+
+def pct(values: List[float], p: int) -> float:
+	if not values: return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, len(values) * p // 100)]
@@ -0,0 +1,65 @@
+from typing import Any, Dict, List
+from pathlib import Path
+import json
+
+from dateutil import parser as iso_parser
+
+from core import db
+
+# Moves OIMs from the old `storage/oim/<recipient uuid>/<oim uuid>` JSON files
+# into `t_oim`/`t_oim_body`. Safe to re-run; messages already imported are skipped.
+
+def main(*, path: str = 'storage/oim', delete: bool = False) -> None:
+	root = Path(path)
+	if not root.is_dir():
+		print("Nothing to do.")
+		return
+	
+	imported = 0
+	skipped = 0
+	done = [] # type: List[Path]
+	with db.Session() as sess:
+		known = { uuid for uuid, in sess.query(db.OIM.uuid) }
+		for recipient_path in root.iterdir():
+			if not recipient_path.is_dir(): continue
+			for oim_path in recipient_path.iterdir():
+				if not oim_path.is_file(): continue
+				try:
+					json_oim = json.loads(oim_path.read_text())
+				except ValueError:
+					print("unreadable", oim_path)
+					continue
+				if json_oim['uuid'] not in known:
+					_import_oim(sess, recipient_path.name, json_oim)
+					known.add(json_oim['uuid'])
+					imported += 1
+				else:
+					skipped += 1
+				done.append(oim_path)
+	
+	print("imported", imported, "skipped", skipped)
+	if not delete: return
+	# Only once the import is committed
+	for oim_path in done:
+		oim_path.unlink()
+	for recipient_path in root.iterdir():
+		if recipient_path.is_dir() and not any(recipient_path.iterdir()):
+			recipient_path.rmdir()
+
+def _import_oim(sess: Any, recipient_uuid: str, json_oim: Dict[str, Any]) -> None:
+	message = json_oim['message']['text']
+	dboim = db.OIM(
+		uuid = json_oim['uuid'], recipient_uuid = recipient_uuid, run_id = json_oim['run_id'],
+		from_email = json_oim['from'], from_friendly = json_oim['from_friendly']['friendly_name'],
+		from_friendly_encoding = json_oim['from_friendly']['encoding'], from_friendly_charset = json_oim['from_friendly']['charset'],
+		from_user_id = json_oim['from_user_id'], sent = iso_parser.parse(json_oim['sent']).replace(tzinfo = None),
+		origin_ip = json_oim['origin_ip'], proxy = json_oim['proxy'], headers = json_oim['headers'],
+		utf8 = json_oim['message']['utf8'], size = len(message.encode('utf-8')), is_read = json_oim.get('is_read', False),
+	)
+	sess.add(dboim)
+	sess.flush()
+	sess.add(db.OIMBody(oim_id = dboim.id, message = message))
+
+if __name__ == '__main__':
+	import funcli
+	funcli.main()
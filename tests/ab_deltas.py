@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import jinja2
+from aiohttp import web
+
+import util.misc
+from core.models import User, UserDetail, UserStatus, Contact, ContactDetail, Lst
+from front.msn import http
+from front.msn.misc import cid_format
+
+def test_membership_deltas_only_delete_roles_left():
+	detail = UserDetail()
+	long_ago = datetime.utcnow() - timedelta(days = 1)
+	unchanged = _contact(1, Lst.FL | Lst.AL | Lst.RL, long_ago)
+	touched = _contact(2, Lst.FL | Lst.AL | Lst.RL, long_ago)
+	blocked = _contact(3, Lst.FL | Lst.AL | Lst.RL, long_ago)
+	for ctc in (unchanged, touched, blocked):
+		detail.contacts[ctc.head.uuid] = ctc
+	
+	since = datetime.utcnow() - timedelta(seconds = 1)
+	touched.touch(lists_before = touched.lists)
+	lists_before = blocked.lists
+	blocked.lists = Lst.FL | Lst.BL | Lst.RL
+	blocked.touch(lists_before = lists_before)
+	
+	content = _render('msn:sharing/FindMembershipResponse.xml', detail, since, lists = True)
+	assert unchanged.head.uuid not in content
+	assert _members(content, touched) == [('Allow', 'false'), ('Reverse', 'false')]
+	assert _members(content, blocked) == [('Allow', 'true'), ('Block', 'false'), ('Reverse', 'false')]
+
+def test_address_book_deltas_only_delete_contacts_left():
+	detail = UserDetail()
+	long_ago = datetime.utcnow() - timedelta(days = 1)
+	pending = _contact(1, Lst.RL, long_ago)
+	removed = _contact(2, Lst.FL | Lst.AL | Lst.RL, long_ago)
+	for ctc in (pending, removed):
+		detail.contacts[ctc.head.uuid] = ctc
+	
+	since = datetime.utcnow() - timedelta(seconds = 1)
+	pending.touch(lists_before = pending.lists)
+	lists_before = removed.lists
+	removed.lists = Lst.AL | Lst.RL
+	removed.touch(lists_before = lists_before)
+	
+	content = _render('msn:abservice/ABFindAllResponse.xml', detail, since)
+	assert pending.head.uuid not in content
+	assert '<contactId>{}</contactId>'.format(removed.head.uuid) in content
+	assert content.count('<fDeleted>true</fDeleted>') == 1
+
+def _render(tmpl_name, detail, since, *, lists = False):
+	app = web.Application()
+	app['jinja_env'] = jinja2.Environment(
+		loader = jinja2.PrefixLoader({}, delimiter = ':'),
+		autoescape = jinja2.select_autoescape(default = True),
+	)
+	util.misc.add_to_jinja_env(app, 'msn', http.TMPL_DIR, globals = {
+		'date_format': util.misc.date_format,
+		'cid_format': cid_format,
+		'bool_to_str': http._bool_to_str,
+		'contact_is_favorite': http._contact_is_favorite,
+		'datetime': datetime,
+	})
+	user = _user(0)
+	user.detail = detail
+	return app['jinja_env'].get_template(tmpl_name).render(
+		cachekey = 'x', host = 'localhost', session_id = 'x', Lst = Lst,
+		user = user, detail = detail, now = util.misc.date_format(datetime.utcnow()),
+		ab_id = '00000000-0000-0000-0000-000000000000', lists = [Lst.AL, Lst.BL],
+		groups = http._groups_changed_since(detail, since),
+		contacts = http._contacts_changed_since(detail, since, lists = lists),
+		since = since,
+	)
+
+def _members(content, ctc):
+	# (role, deleted) for each of `ctc`'s membership entries
+	members = []
+	for chunk in content.split('<MembershipId>')[1:]:
+		role, uuid = chunk[:chunk.index('<')].split('/')
+		if uuid != ctc.head.uuid: continue
+		deleted = chunk[chunk.index('<Deleted>') + len('<Deleted>'):chunk.index('</Deleted>')]
+		members.append((role, deleted))
+	return members
+
+def _contact(i, lists, date):
+	head = _user(i)
+	return Contact(
+		head, set(), lists, UserStatus(head.status.name), ContactDetail(str(i)),
+		date_modified = date, date_lists_modified = date,
+	)
+
+def _user(i):
+	return User(i, str(uuid4()), 'test{}@example.com'.format(i), True, UserStatus('Test {}'.format(i)), {}, datetime.utcnow())
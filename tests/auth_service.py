@@ -1,4 +1,4 @@
-from util.auth import AuthService
+from core.auth import AuthService
 
 def test_can_use_existing():
 	t = MockTime()
@@ -44,6 +44,33 @@ def test_multiple_out_of_order():
 	t.tick(1)
 	assert a.pop_token('xyz', token1) == 'data1'
 
+def test_sweep_drops_expired():
+	t = MockTime()
+	a = AuthService(time = t)
+	token1 = a.create_token('xyz', 'data1', lifetime = 10)
+	token2 = a.create_token('abc', 'data2', lifetime = 20)
+	a.create_token('abc', 'data3', lifetime = 20)
+	assert a.counts_by_purpose() == { 'xyz': 1, 'abc': 2 }
+	t.tick(15)
+	assert a.sweep() == 1
+	assert a.counts_by_purpose() == { 'abc': 2 }
+	assert a.get_token('xyz', token1) is None
+	assert a.pop_token('abc', token2) == 'data2'
+	assert a.counts_by_purpose() == { 'abc': 1 }
+	t.tick(10)
+	assert a.sweep() == 1
+	assert a.counts_by_purpose() == {}
+
+def test_reuse_popped_token():
+	t = MockTime()
+	a = AuthService(time = t)
+	token = a.create_token('xyz', 'data1', lifetime = 10)
+	assert a.pop_token('xyz', token) == 'data1'
+	a.create_token('xyz', 'data2', token = token, lifetime = 20)
+	t.tick(15)
+	assert a.sweep() == 0
+	assert a.get_token('xyz', token) == 'data2'
+
 class MockTime:
 	def __init__(self):
 		self.t = 0
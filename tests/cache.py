@@ -0,0 +1,78 @@
+from util.cache import Cache
+
+def test_lru_eviction():
+	c = Cache(maxsize = 2)
+	c.set('a', 1)
+	c.set('b', 2)
+	assert c.lookup('a') == (True, 1)
+	c.set('c', 3)
+	assert c.lookup('b') == (False, None)
+	assert c.lookup('a') == (True, 1)
+	assert c.evictions == 1
+
+def test_ttl_and_negative_ttl():
+	t = MockTime()
+	c = Cache(maxsize = 10, ttl = 100, negative_ttl = 10, time = t)
+	c.set('a', 1)
+	c.set('missing', None)
+	assert c.lookup('missing') == (True, None)
+	t.tick(11)
+	assert c.lookup('missing') == (False, None)
+	assert c.lookup('a') == (True, 1)
+	t.tick(90)
+	assert c.lookup('a') == (False, None)
+
+def test_hit_miss_counters():
+	c = Cache(maxsize = 10)
+	loads = []
+	def loader(key):
+		loads.append(key)
+		return key.upper()
+	assert c.get_or_load('x', loader) == 'X'
+	assert c.get_or_load('x', loader) == 'X'
+	assert loads == ['x']
+	assert (c.hits, c.misses) == (1, 1)
+
+def test_pinned_never_evicted_or_expired():
+	t = MockTime()
+	c = Cache(maxsize = 1, ttl = 10, time = t)
+	obj = Obj()
+	c.pin('a', obj)
+	c.set('b', Obj())
+	c.set('c', Obj())
+	t.tick(100)
+	assert c.lookup('a') == (True, obj)
+	c.unpin('a')
+	assert c.lookup('a') == (True, obj)
+	assert not c.is_pinned('a')
+
+def test_keep_identity():
+	t = MockTime()
+	c = Cache(maxsize = 1, ttl = 10, keep_identity = True, time = t)
+	obj = Obj()
+	c.set('a', obj)
+	c.set('b', Obj())
+	# Evicted, but still referenced here, so the same object comes back
+	assert c.lookup('a') == (True, obj)
+	t.tick(11)
+	c.invalidate('a')
+	assert c.setdefault('a', Obj()) is obj
+
+def test_invalidate_negative():
+	c = Cache(maxsize = 10, negative_ttl = 60)
+	c.set('a', None)
+	c.invalidate('a')
+	assert c.get_or_load('a', lambda key: 5) == 5
+
+class Obj:
+	pass
+
+class MockTime:
+	def __init__(self):
+		self.t = 0
+	
+	def tick(self, dt = 1):
+		self.t += dt
+	
+	def __call__(self):
+		return self.t
@@ -0,0 +1,68 @@
+from datetime import datetime
+
+import pytest
+
+from core import error
+from core.auth import AuthService
+from core.backend import Chat
+from core.models import User, UserStatus
+
+class Backend:
+	auth_service = AuthService
+	
+	def __init__(self):
+		self._chats_by_id = {}
+
+class BackendSession:
+	def __init__(self, user):
+		self.user = user
+
+class Evt:
+	def __init__(self):
+		self.joined = []
+		self.left = []
+	
+	def on_open(self):
+		pass
+	
+	def on_close(self, keep_future, idle):
+		pass
+	
+	def on_participant_joined(self, cs_other, first_pop):
+		self.joined.append((cs_other.user.email, first_pop))
+	
+	def on_participant_left(self, cs_other, idle, last_pop):
+		self.left.append((cs_other.user.email, last_pop))
+
+def _user(i):
+	return User(i, str(i), 'test{}@example.com'.format(i), True, UserStatus(None), {}, datetime.utcnow())
+
+def test_roster_index():
+	chat = Chat(Backend(), None)
+	user1 = _user(1)
+	user2 = _user(2)
+	
+	cs1a = chat.join('msn', BackendSession(user1), Evt(), pop_id = 'a')
+	cs2 = chat.join('msn', BackendSession(user2), Evt())
+	chat.send_participant_joined(cs1a)
+	cs1b = chat.join('msn', BackendSession(user1), Evt(), pop_id = 'b')
+	chat.send_participant_joined(cs1b)
+	with pytest.raises(error.AuthFail):
+		chat.join('msn', BackendSession(user1), Evt(), pop_id = 'A')
+	
+	assert cs1a.primary_pop and cs2.primary_pop and not cs1b.primary_pop
+	assert list(chat.get_roster_single()) == [cs1a, cs2]
+	assert list(chat.get_user_sessions(user1)) == [cs1a, cs1b]
+	
+	assert cs2.evt.joined == [(user1.email, True), (user1.email, False)]
+	assert chat.is_user_joined(user1) and not chat.is_user_joined(user2)
+	
+	cs1a.close()
+	assert cs1b.primary_pop
+	assert list(chat.get_roster_single()) == [cs1b, cs2]
+	assert cs2.evt.left == [(user1.email, False)]
+	
+	cs1b.close()
+	assert list(chat.get_roster_single()) == [cs2]
+	assert not chat.is_user_joined(user1)
+	assert cs2.evt.left[-1] == (user1.email, True)
@@ -0,0 +1,46 @@
+from util.dispatch import CommandTable, CommandHook, add_hook, remove_hook
+
+class Ctrl:
+	def __init__(self):
+		self.seen = []
+		self.logger = self
+	
+	def error(self, ex):
+		self.seen.append(('error', str(ex)))
+	
+	def _m_png(self):
+		self.seen.append('png')
+	
+	def _m_fail(self, reason):
+		raise ValueError(reason)
+
+TABLE = CommandTable(Ctrl, 'test', '_m_', str.upper)
+
+class DropHook(CommandHook):
+	def __init__(self):
+		self.after_calls = []
+	
+	def before(self, ctrl, frontend, command, args):
+		return command != 'png'
+	
+	def after(self, ctrl, frontend, command, elapsed, exc):
+		self.after_calls.append((frontend, command, type(exc)))
+
+def test_dispatch():
+	ctrl = Ctrl()
+	assert TABLE.dispatch(ctrl, 'PNG', ())
+	assert TABLE.dispatch(ctrl, 'FAIL', ('nope',))
+	assert not TABLE.dispatch(ctrl, 'XYZ', ())
+	assert ctrl.seen == ['png', ('error', 'nope')]
+
+def test_hooks():
+	ctrl = Ctrl()
+	hook = DropHook()
+	add_hook(hook)
+	try:
+		TABLE.dispatch(ctrl, 'PNG', ())
+		TABLE.dispatch(ctrl, 'FAIL', ('nope',))
+	finally:
+		remove_hook(hook)
+	assert ctrl.seen == [('error', 'nope')]
+	assert hook.after_calls == [('test', 'fail', ValueError)]
@@ -0,0 +1,67 @@
+import asyncio
+from datetime import datetime
+
+from util.misc import Logger
+from core.auth import AuthService
+from core.backend import Chat
+from core.models import User, UserStatus
+from front.irc.ctrl import IRCCtrl
+
+class Backend:
+	auth_service = AuthService
+	
+	def __init__(self, loop):
+		self.loop = loop
+		self.user_service = self
+		self._chats_by_id = {}
+	
+	async def login_async(self, email, password):
+		await asyncio.sleep(0.01)
+		return ('uuid' if password == 'ok' else None)
+	
+	def login(self, uuid, client, evt, option):
+		return BackendSession(User(1, uuid, 'test@example.com', True, UserStatus(None), {}, datetime.utcnow()))
+	
+	def chat_get(self, scope, id):
+		return self._chats_by_id.get((scope, id))
+	
+	def chat_create(self):
+		return Chat(self, None)
+
+class BackendSession:
+	def __init__(self, user):
+		self.user = user
+	
+	def me_update(self, fields):
+		pass
+
+class Transport:
+	def get_extra_info(self, name):
+		return ('127.0.0.1', 6667)
+
+def _run(password):
+	loop = asyncio.new_event_loop()
+	ctrl = IRCCtrl(Logger('IR', object()), 'direct', Backend(loop))
+	ctrl.data_received(Transport(), 'PASS {}\r\nNICK test\r\nUSER test@example.com x x :Test\r\nJOIN #chan\r\n'.format(password).encode('utf-8'))
+	assert ctrl.login_task is not None
+	loop.run_until_complete(ctrl.login_task)
+	loop.close()
+	return ctrl.flush().decode('utf-8').split('\r\n')
+
+def test_commands_wait_for_login():
+	lines = _run('ok')
+	assert lines[0].startswith(':localhost 001 test@example.com')
+	assert lines[1:3] == [':test@example.com JOIN #chan', ':localhost 353 test@example.com = #chan :test@example.com']
+
+def test_handshake_before_login():
+	loop = asyncio.new_event_loop()
+	ctrl = IRCCtrl(Logger('IR', object()), 'direct', Backend(loop))
+	ctrl.data_received(Transport(), b'CAP LS 302\r\nNICK test\r\nPING :abc\r\nPONG :def\r\n')
+	loop.close()
+	lines = ctrl.flush().decode('utf-8').split('\r\n')
+	assert lines == [':localhost 421 CAP :Not supported', ':localhost PONG localhost :abc', '']
+
+def test_not_registered_after_failed_login():
+	lines = _run('wrong')
+	assert lines[0].startswith(':localhost 464')
+	assert lines[1].startswith(':localhost 451 JOIN')
@@ -0,0 +1,39 @@
+import asyncio, os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from front.msn.keypool import RSAKeyPool
+
+def test_take_after_worker_dies():
+	async def run():
+		loop = asyncio.get_event_loop()
+		pool = RSAKeyPool(key_size = 1024, target = 0)
+		pool.start(loop)
+		broken = pool._executor
+		with pytest.raises(BrokenProcessPool):
+			await loop.run_in_executor(broken, os._exit, 1)
+		
+		key = await asyncio.wait_for(pool.take(), 60)
+		assert key.key_size == 1024
+		assert pool._executor is not broken
+		pool._executor.shutdown()
+	
+	asyncio.get_event_loop().run_until_complete(run())
+
+def test_waiter_served_when_generation_fails():
+	async def run():
+		loop = asyncio.get_event_loop()
+		pool = RSAKeyPool(key_size = 1024, target = 0)
+		pool.start(loop)
+		broken = pool._executor
+		# Queued ahead of the key, so the key's job fails with the pool
+		crash = loop.run_in_executor(broken, os._exit, 1)
+		key = await asyncio.wait_for(pool.take(), 60)
+		assert key.key_size == 1024
+		assert pool._executor is not broken
+		with pytest.raises(BrokenProcessPool):
+			await crash
+		pool._executor.shutdown()
+	
+	asyncio.get_event_loop().run_until_complete(run())
@@ -0,0 +1,33 @@
+from util.metrics import Registry
+
+def test_histogram_render():
+	r = Registry()
+	h = r.histogram('t_seconds', "Test", ('cmd',), buckets = (0.1, 1))
+	h.observe('usr', value = 0.05)
+	h.observe('usr', value = 0.5)
+	h.observe('usr', value = 5)
+	lines = r.render().split('\n')
+	assert '# TYPE t_seconds histogram' in lines
+	assert 't_seconds_bucket{cmd="usr",le="0.1"} 1' in lines
+	assert 't_seconds_bucket{cmd="usr",le="1"} 2' in lines
+	assert 't_seconds_bucket{cmd="usr",le="+Inf"} 3' in lines
+	assert 't_seconds_sum{cmd="usr"} 5.55' in lines
+	assert 't_seconds_count{cmd="usr"} 3' in lines
+
+def test_label_limit():
+	r = Registry()
+	c = r.counter('t_total', "Test", ('action',), max_children = 2)
+	for action in ('a', 'b', 'c', 'd', 'a'):
+		c.inc(action)
+	lines = r.render().split('\n')
+	assert 't_total{action="a"} 2' in lines
+	assert 't_total{action="other"} 2' in lines
+	assert not any('action="c"' in line for line in lines)
+
+def test_gauge_and_escaping():
+	r = Registry()
+	g = r.gauge('t_open', "Test", ('listener',))
+	g.inc('N"S')
+	g.inc('N"S')
+	g.dec('N"S')
+	assert 't_open{listener="N\\"S"} 1' in r.render().split('\n')
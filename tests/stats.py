@@ -0,0 +1,76 @@
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+from core import stats
+from core.client import Client
+from core.models import User, UserStatus
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+	engine = sa.create_engine('sqlite:///{}'.format(tmp_path / 'stats.sqlite'))
+	stats.Base.metadata.create_all(engine)
+	monkeypatch.setattr(stats, 'session_factory', sessionmaker(bind = engine))
+
+def test_hour_rollover(db):
+	t = MockTime(3600 * 10)
+	s = stats.Stats(time = t)
+	client = Client('msn', 'MSNP12', 'direct')
+	s.on_message_sent(_user(1), client)
+	s.on_messages_received(client, 3)
+	t.tick(3600)
+	s.on_message_sent(_user(1), client)
+	s.flush()
+	
+	assert _hourly() == [(10, 1, 3), (11, 1, 0)]
+
+def test_late_flush(db):
+	# Nothing happens after the hour ends, so only the flush notices it did
+	t = MockTime(3600 * 10)
+	s = stats.Stats(time = t)
+	s.on_message_sent(_user(1), Client('msn', 'MSNP12', 'direct'))
+	t.tick(7200)
+	s.flush()
+	
+	assert _hourly() == [(10, 1, 0)]
+	assert s.totals() == { 'messages_sent': 0, 'messages_received': 0 }
+
+def test_failed_flush_keeps_finished_hours(db, monkeypatch):
+	t = MockTime(3600 * 10)
+	s = stats.Stats(time = t)
+	client = Client('msn', 'MSNP12', 'direct')
+	s.on_message_sent(_user(1), client)
+	t.tick(3600)
+	
+	def fail(*args, **kwargs):
+		raise Exception("write failed")
+	with monkeypatch.context() as m:
+		m.setattr(stats, '_set_current', fail)
+		with pytest.raises(Exception):
+			s.flush()
+	assert _hourly() == []
+	assert client not in s._client_ids
+	
+	s.flush()
+	assert _hourly() == [(10, 1, 0)]
+	assert client in s._client_ids
+
+def _hourly():
+	with stats.Session() as sess:
+		return [
+			(row.hour, row.messages_sent, row.messages_received)
+			for row in sess.query(stats.HourlyClientStats).order_by(stats.HourlyClientStats.hour)
+		]
+
+def _user(i):
+	return User(i, str(i), 'test{}@example.com'.format(i), True, UserStatus(None), {}, None)
+
+class MockTime:
+	def __init__(self, t = 0):
+		self.t = t
+	
+	def tick(self, dt = 1):
+		self.t += dt
+	
+	def __call__(self):
+		return self.t
@@ -0,0 +1,157 @@
+from typing import Dict, Any, Optional, Callable, Tuple, Generic, TypeVar
+from collections import OrderedDict
+from time import monotonic as time_builtin
+import threading
+import weakref
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+class Cache(Generic[K, V]):
+	# LRU cache with a size bound and TTLs (a separate, usually shorter, one for `None` results).
+	# Pinned entries live outside the LRU and never expire or get evicted.
+	# With `keep_identity`, any object that's still referenced elsewhere is handed back
+	# instead of being reloaded after it drops out, so there's only ever one object per key.
+	# Executor threads read from it too, hence the lock.
+	__slots__ = (
+		'maxsize', 'ttl', 'negative_ttl', 'hits', 'misses', 'evictions',
+		'_time', '_lock', '_entries', '_pinned', '_alive',
+	)
+	
+	maxsize: int
+	ttl: Optional[float]
+	negative_ttl: Optional[float]
+	hits: int
+	misses: int
+	evictions: int
+	_time: Any
+	_lock: threading.RLock
+	# key -> (value, expiry)
+	_entries: 'OrderedDict[K, Tuple[Optional[V], Optional[float]]]'
+	_pinned: Dict[K, V]
+	_alive: Optional['weakref.WeakValueDictionary[K, Any]']
+	
+	def __init__(self, *, maxsize: int, ttl: Optional[float] = None, negative_ttl: Optional[float] = None, keep_identity: bool = False, time: Optional[Any] = None) -> None:
+		if time is None:
+			time = time_builtin
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._time = time
+		self._lock = threading.RLock()
+		self._entries = OrderedDict()
+		self._pinned = {}
+		self._alive = (weakref.WeakValueDictionary() if keep_identity else None)
+	
+	def __len__(self) -> int:
+		return len(self._entries) + len(self._pinned)
+	
+	def lookup(self, key: K) -> Tuple[bool, Optional[V]]:
+		# Returns (found, value); `value` may be a cached `None`
+		with self._lock:
+			found, value = self._lookup(key)
+			if found:
+				self.hits += 1
+			else:
+				self.misses += 1
+			return found, value
+	
+	def peek(self, key: K) -> Optional[V]:
+		# Like `lookup`, but doesn't count or reorder; for callers that only want a hint
+		with self._lock:
+			if key in self._pinned:
+				return self._pinned[key]
+			entry = self._entries.get(key)
+			if entry is not None and not self._expired(entry):
+				return entry[0]
+			if self._alive is not None:
+				return self._alive.get(key)
+			return None
+	
+	def get_or_load(self, key: K, loader: Callable[[K], Optional[V]]) -> Optional[V]:
+		found, value = self.lookup(key)
+		if found:
+			return value
+		return self.setdefault(key, loader(key))
+	
+	def setdefault(self, key: K, value: Optional[V]) -> Optional[V]:
+		# Stores `value` unless something is already cached for `key`; returns whichever is cached
+		with self._lock:
+			found, existing = self._lookup(key)
+			if found and existing is not None:
+				return existing
+			self._set(key, value)
+			return value
+	
+	def set(self, key: K, value: Optional[V]) -> None:
+		with self._lock:
+			self._set(key, value)
+	
+	def invalidate(self, key: K) -> None:
+		# Forgets `key` so the next lookup reloads it. Pinned entries, and with
+		# `keep_identity` objects still referenced elsewhere, keep being returned.
+		with self._lock:
+			self._entries.pop(key, None)
+	
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+	
+	def pin(self, key: K, value: V) -> None:
+		with self._lock:
+			self._entries.pop(key, None)
+			self._pinned[key] = value
+			if self._alive is not None:
+				self._alive[key] = value
+	
+	def unpin(self, key: K) -> None:
+		with self._lock:
+			value = self._pinned.pop(key, None)
+			if value is not None:
+				self._set(key, value)
+	
+	def is_pinned(self, key: K) -> bool:
+		return key in self._pinned
+	
+	def stats(self) -> Dict[str, int]:
+		return {
+			'size': len(self), 'pinned': len(self._pinned),
+			'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+		}
+	
+	def _lookup(self, key: K) -> Tuple[bool, Optional[V]]:
+		if key in self._pinned:
+			return True, self._pinned[key]
+		entry = self._entries.get(key)
+		if entry is not None:
+			if not self._expired(entry):
+				self._entries.move_to_end(key)
+				return True, entry[0]
+			del self._entries[key]
+		if self._alive is not None:
+			value = self._alive.get(key)
+			if value is not None:
+				self._set(key, value)
+				return True, value
+		return False, None
+	
+	def _set(self, key: K, value: Optional[V]) -> None:
+		if key in self._pinned:
+			if value is not None:
+				self._pinned[key] = value
+			return
+		ttl = (self.negative_ttl if value is None else self.ttl)
+		self._entries[key] = (value, (None if ttl is None else self._time() + ttl))
+		self._entries.move_to_end(key)
+		if value is not None and self._alive is not None:
+			self._alive[key] = value
+		while len(self._entries) > self.maxsize:
+			self._entries.popitem(last = False)
+			self.evictions += 1
+	
+	def _expired(self, entry: Tuple[Optional[V], Optional[float]]) -> bool:
+		expiry = entry[1]
+		return expiry is not None and expiry <= self._time()
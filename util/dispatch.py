@@ -0,0 +1,100 @@
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+import time
+
+from util import metrics
+
+class CommandHook:
+	# Attached with `add_hook`; runs around every command of every frontend.
+	# Hooks run inline on the event loop, so they have to be cheap and must not raise.
+	__slots__ = ()
+	
+	def before(self, ctrl: Any, frontend: str, command: str, args: Sequence[Any]) -> bool:
+		# Returning False drops the command (e.g. rate limiting)
+		return True
+	
+	def after(self, ctrl: Any, frontend: str, command: str, elapsed: float, exc: Optional[Exception]) -> None:
+		pass
+
+class CommandTable:
+	# Handlers of one controller class, found once when the class is created
+	# (see the controllers' `__init_subclass__`) instead of per command.
+	__slots__ = ('frontend', 'handlers')
+	
+	frontend: str
+	# key -> (command name, unbound handler)
+	handlers: Dict[Hashable, Tuple[str, Callable[..., Any]]]
+	
+	def __init__(self, cls: type, frontend: str, prefix: str, key: Callable[[str], Hashable]) -> None:
+		self.frontend = frontend
+		self.handlers = {}
+		for attr in dir(cls):
+			if not attr.startswith(prefix): continue
+			name = attr[len(prefix):]
+			self.handlers[key(name)] = (name, getattr(cls, attr))
+	
+	def dispatch(self, ctrl: Any, command: Hashable, args: Sequence[Any]) -> bool:
+		# False if there's no handler for `command`; exceptions from the handler are logged
+		entry = self.handlers.get(command)
+		if entry is None:
+			metrics.unknown_commands.inc(self.frontend)
+			return False
+		name, f = entry
+		if not _after_hooks:
+			for hook in _before_hooks:
+				if not hook.before(ctrl, self.frontend, name, args):
+					return True
+			try:
+				f(ctrl, *args)
+			except Exception as ex:
+				ctrl.logger.error(ex)
+			return True
+		for hook in _before_hooks:
+			if not hook.before(ctrl, self.frontend, name, args):
+				return True
+		exc = None
+		start = time.perf_counter()
+		try:
+			f(ctrl, *args)
+		except Exception as ex:
+			exc = ex
+			ctrl.logger.error(ex)
+		elapsed = time.perf_counter() - start
+		for hook in _after_hooks:
+			hook.after(ctrl, self.frontend, name, elapsed, exc)
+		return True
+
+class MetricsHook(CommandHook):
+	# Feeds `metrics.command_time` and `metrics.command_errors`; on by default
+	__slots__ = ('_children',)
+	
+	_children: Dict[Tuple[str, str], metrics.HistogramChild]
+	
+	def __init__(self) -> None:
+		self._children = {}
+	
+	def after(self, ctrl: Any, frontend: str, command: str, elapsed: float, exc: Optional[Exception]) -> None:
+		key = (frontend, command)
+		child = self._children.get(key)
+		if child is None:
+			child = metrics.command_time.labels(frontend, command)
+			self._children[key] = child
+		child.observe(elapsed)
+		if exc is not None:
+			metrics.command_errors.inc(frontend, command)
+
+def add_hook(hook: CommandHook) -> None:
+	# Only hooks that override `before`/`after` are called for them; with no `after` hooks, commands aren't timed
+	if type(hook).before is not CommandHook.before:
+		_before_hooks.append(hook)
+	if type(hook).after is not CommandHook.after:
+		_after_hooks.append(hook)
+
+def remove_hook(hook: CommandHook) -> None:
+	if hook in _before_hooks:
+		_before_hooks.remove(hook)
+	if hook in _after_hooks:
+		_after_hooks.remove(hook)
+
+_before_hooks = [] # type: List[CommandHook]
+_after_hooks = [] # type: List[CommandHook]
+add_hook(MetricsHook())
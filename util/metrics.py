@@ -0,0 +1,256 @@
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Sequence, Tuple
+from bisect import bisect_left
+import math, threading, time, traceback
+
+Labels = Tuple[str, ...]
+# (sample name, label names, label values, value)
+Sample = Tuple[str, Labels, Labels, float]
+# (name, type, help, samples)
+Family = Tuple[str, str, str, List[Sample]]
+
+class Counter:
+	__slots__ = ('name', 'help', 'labelnames', 'max_children', '_values')
+	
+	name: str
+	help: str
+	labelnames: Labels
+	max_children: int
+	_values: Dict[Labels, float]
+	
+	def __init__(self, name: str, help: str, labelnames: Labels = (), *, max_children: int = 1000) -> None:
+		self.name = name
+		self.help = help
+		self.labelnames = labelnames
+		self.max_children = max_children
+		self._values = {}
+	
+	def inc(self, *labels: str, amount: float = 1) -> None:
+		values = self._values
+		if labels not in values:
+			labels = _bounded_key(values, labels, self.max_children)
+			values.setdefault(labels, 0)
+		values[labels] += amount
+	
+	def collect(self) -> Iterable[Family]:
+		yield (self.name, 'counter', self.help, self._samples())
+	
+	def _samples(self) -> List[Sample]:
+		return [(self.name, self.labelnames, labels, value) for labels, value in list(self._values.items())]
+
+class Gauge(Counter):
+	__slots__ = ()
+	
+	def dec(self, *labels: str, amount: float = 1) -> None:
+		self.inc(*labels, amount = -amount)
+	
+	def set(self, *labels: str, value: float) -> None:
+		self._values[_bounded_key(self._values, labels, self.max_children)] = value
+	
+	def collect(self) -> Iterable[Family]:
+		yield (self.name, 'gauge', self.help, self._samples())
+
+class HistogramChild:
+	__slots__ = ('buckets', 'counts', 'sum', 'count')
+	
+	buckets: Sequence[float]
+	# Per bucket, not cumulative; the last one is `+Inf`
+	counts: List[int]
+	sum: float
+	count: int
+	
+	def __init__(self, buckets: Sequence[float]) -> None:
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+	
+	def observe(self, value: float) -> None:
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+class LockedHistogramChild(HistogramChild):
+	# For observations from executor threads (DB queries)
+	__slots__ = ('_lock',)
+	
+	_lock: threading.Lock
+	
+	def __init__(self, buckets: Sequence[float]) -> None:
+		super().__init__(buckets)
+		self._lock = threading.Lock()
+	
+	def observe(self, value: float) -> None:
+		with self._lock:
+			super().observe(value)
+
+class Histogram:
+	# Fixed buckets, so an observation is a bisect and three additions; children are
+	# looked up once per label set by `labels` and can be kept by the caller.
+	__slots__ = ('name', 'help', 'labelnames', 'buckets', 'max_children', '_children', '_child_type')
+	
+	name: str
+	help: str
+	labelnames: Labels
+	buckets: Sequence[float]
+	max_children: int
+	_children: Dict[Labels, HistogramChild]
+	_child_type: Any
+	
+	def __init__(self, name: str, help: str, labelnames: Labels = (), *, buckets: Sequence[float] = (), max_children: int = 1000, threadsafe: bool = False) -> None:
+		self.name = name
+		self.help = help
+		self.labelnames = labelnames
+		self.buckets = tuple(buckets or DEFAULT_BUCKETS)
+		self.max_children = max_children
+		self._children = {}
+		self._child_type = (LockedHistogramChild if threadsafe else HistogramChild)
+	
+	def labels(self, *labels: str) -> HistogramChild:
+		child = self._children.get(labels)
+		if child is None:
+			labels = _bounded_key(self._children, labels, self.max_children)
+			child = self._children.get(labels)
+			if child is None:
+				child = self._child_type(self.buckets)
+				self._children[labels] = child
+		return child
+	
+	def observe(self, *labels: str, value: float) -> None:
+		self.labels(*labels).observe(value)
+	
+	def collect(self) -> Iterable[Family]:
+		bucket_name = self.name + '_bucket'
+		le_labelnames = self.labelnames + ('le',)
+		samples = [] # type: List[Sample]
+		for labels, child in list(self._children.items()):
+			total = 0
+			for le, count in zip(self.buckets, child.counts):
+				total += count
+				samples.append((bucket_name, le_labelnames, labels + (_format_value(le),), total))
+			samples.append((bucket_name, le_labelnames, labels + ('+Inf',), child.count))
+			samples.append((self.name + '_sum', self.labelnames, labels, child.sum))
+			samples.append((self.name + '_count', self.labelnames, labels, child.count))
+		yield (self.name, 'histogram', self.help, samples)
+
+class Registry:
+	# Metrics in the Prometheus text format. Counters, gauges and histograms are
+	# updated as things happen; anything that already keeps its own numbers
+	# (caches, worklists, `stats()` methods) is read by a collector at scrape time.
+	__slots__ = ('_metrics', '_collectors')
+	
+	_metrics: Dict[str, Any]
+	_collectors: List[Callable[[], Iterable[Family]]]
+	
+	def __init__(self) -> None:
+		self._metrics = {}
+		self._collectors = []
+	
+	def counter(self, name: str, help: str, labelnames: Labels = (), **kwargs: Any) -> Counter:
+		return self._add(Counter(name, help, labelnames, **kwargs))
+	
+	def gauge(self, name: str, help: str, labelnames: Labels = (), **kwargs: Any) -> Gauge:
+		return self._add(Gauge(name, help, labelnames, **kwargs))
+	
+	def histogram(self, name: str, help: str, labelnames: Labels = (), **kwargs: Any) -> Histogram:
+		return self._add(Histogram(name, help, labelnames, **kwargs))
+	
+	def add_collector(self, collect: Callable[[], Iterable[Family]]) -> None:
+		self._collectors.append(collect)
+	
+	def render(self) -> str:
+		lines = [] # type: List[str]
+		for collect in [m.collect for m in self._metrics.values()] + self._collectors:
+			try:
+				families = list(collect())
+			except:
+				traceback.print_exc()
+				continue
+			for name, type, help, samples in families:
+				lines.append('# HELP {} {}'.format(name, help))
+				lines.append('# TYPE {} {}'.format(name, type))
+				for sample_name, labelnames, labels, value in samples:
+					lines.append('{}{} {}'.format(sample_name, _format_labels(labelnames, labels), _format_value(value)))
+		lines.append('')
+		return '\n'.join(lines)
+	
+	def _add(self, metric: Any) -> Any:
+		assert metric.name not in self._metrics, metric.name
+		self._metrics[metric.name] = metric
+		return metric
+
+def gauge_family(name: str, help: str, values: Mapping[Labels, float], labelnames: Labels = ()) -> Family:
+	return (name, 'gauge', help, [(name, labelnames, labels, float(value)) for labels, value in values.items()])
+
+def stats_family(name: str, help: str, stats: Mapping[str, Mapping[str, float]], labelname: str) -> Family:
+	# One sample per (key, stat) of a `{ key: stats() }` dict, e.g. caches by name
+	return gauge_family(name, help, {
+		(key, stat): value
+		for key, key_stats in stats.items()
+		for stat, value in key_stats.items()
+	}, (labelname, 'stat'))
+
+def time_queries(engine: Any, db_name: str) -> None:
+	# Query time on `engine`, as seen by the executor thread that ran it
+	import sqlalchemy as sa
+	
+	child = db_query_time.labels(db_name)
+	
+	def before_cursor_execute(conn: Any, *args: Any) -> None:
+		conn.info.setdefault('query_start', []).append(time.perf_counter())
+	
+	def after_cursor_execute(conn: Any, *args: Any) -> None:
+		child.observe(time.perf_counter() - conn.info['query_start'].pop())
+	
+	def handle_error(context: Any) -> None:
+		if context.connection is None: return
+		starts = context.connection.info.get('query_start')
+		if starts:
+			starts.pop()
+	
+	sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+	sa.event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+	sa.event.listen(engine, 'handle_error', handle_error)
+
+def add_caches(stats: Callable[[], Mapping[str, Mapping[str, float]]]) -> None:
+	# `stats` returns `{ name: Cache.stats() }`; all caches go in one family, labelled by name
+	_cache_stats.append(stats)
+
+def _collect_caches() -> Iterable[Family]:
+	by_name = {} # type: Dict[str, Mapping[str, float]]
+	for stats in _cache_stats:
+		by_name.update(stats())
+	yield stats_family('escargot_cache', "Cache size, hits, misses and evictions", by_name, 'cache')
+
+def _bounded_key(children: Dict[Labels, Any], labels: Labels, max_children: int) -> Labels:
+	# Labels can come from clients (e.g. SOAP action names); past `max_children` they all share one series
+	if labels in children or len(children) < max_children:
+		return labels
+	return tuple('other' for _ in labels)
+
+def _format_labels(labelnames: Labels, labels: Labels) -> str:
+	if not labelnames: return ''
+	return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in zip(labelnames, labels)) + '}'
+
+def _escape(value: str) -> str:
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value: float) -> str:
+	if math.isinf(value):
+		return ('+Inf' if value > 0 else '-Inf')
+	if value == int(value):
+		return str(int(value))
+	return repr(float(value))
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_cache_stats = [] # type: List[Callable[[], Mapping[str, Mapping[str, float]]]]
+
+registry = Registry()
+registry.add_collector(_collect_caches)
+command_time = registry.histogram('escargot_command_seconds', "Time handling one protocol command", ('frontend', 'command'))
+command_errors = registry.counter('escargot_command_errors_total', "Protocol commands that raised", ('frontend', 'command'))
+unknown_commands = registry.counter('escargot_unknown_commands_total', "Commands with no handler", ('frontend',))
+connections = registry.gauge('escargot_connections', "Open connections by listener (NS, SB, YH, IR)", ('listener',))
+loop_lag = registry.histogram('escargot_loop_lag_seconds', "How late a 1s sleep on the event loop wakes up")
+soap_time = registry.histogram('escargot_soap_seconds', "Time handling a SOAP request, by action", ('action',), max_children = 200)
+db_query_time = registry.histogram('escargot_db_query_seconds', "Time executing one DB statement", ('db',), threadsafe = True)
@@ -0,0 +1,134 @@
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+import asyncio, math, traceback
+
+class Timer:
+	__slots__ = ('expires', 'callback', 'args', '_wheel', '_bucket')
+	
+	# Tick at which the timer fires
+	expires: int
+	callback: Callable[..., Any]
+	args: Tuple[Any, ...]
+	_wheel: 'TimerWheel'
+	_bucket: Optional[Set['Timer']]
+	
+	def __init__(self, wheel: 'TimerWheel', expires: int, callback: Callable[..., Any], args: Tuple[Any, ...]) -> None:
+		self.expires = expires
+		self.callback = callback
+		self.args = args
+		self._wheel = wheel
+		self._bucket = None
+	
+	@property
+	def active(self) -> bool:
+		return self._bucket is not None
+	
+	def cancel(self) -> None:
+		bucket = self._bucket
+		if bucket is None: return
+		bucket.discard(self)
+		self._bucket = None
+		self._wheel._count -= 1
+
+class TimerWheel:
+	# Hierarchical timer wheel: `WHEEL_LEVELS` wheels of `WHEEL_SIZE` slots, each
+	# slot of level `n` spanning `WHEEL_SIZE ** n` ticks. Scheduling and cancelling
+	# are O(1); a timer is moved down a level at most `WHEEL_LEVELS - 1` times.
+	# The whole wheel is driven by a single `call_at` on the loop, and only while
+	# there are timers in it, so thousands of timeouts cost no tasks at all.
+	__slots__ = ('resolution', 'fired', '_loop', '_start', '_tick', '_levels', '_count', '_handle')
+	
+	resolution: float
+	fired: int
+	_loop: asyncio.AbstractEventLoop
+	_start: float
+	_tick: int
+	_levels: List[List[Set[Timer]]]
+	_count: int
+	_handle: Optional[asyncio.TimerHandle]
+	
+	def __init__(self, loop: asyncio.AbstractEventLoop, *, resolution: float = 1) -> None:
+		self.resolution = resolution
+		self.fired = 0
+		self._loop = loop
+		self._start = loop.time()
+		self._tick = 0
+		self._levels = [[set() for _ in range(WHEEL_SIZE)] for _ in range(WHEEL_LEVELS)]
+		self._count = 0
+		self._handle = None
+	
+	def __len__(self) -> int:
+		return self._count
+	
+	def call_later(self, delay: float, callback: Callable[..., Any], *args: Any) -> Timer:
+		# Fires `callback(*args)` after `delay` seconds, rounded up to the next tick
+		if self._handle is None:
+			# Nothing was scheduled, so the wheel is empty and can just skip ahead
+			self._tick = self._current_tick()
+		expires = max(self._tick + 1, math.ceil((self._loop.time() + delay - self._start) / self.resolution))
+		timer = Timer(self, expires, callback, args)
+		self._insert(timer)
+		self._count += 1
+		if self._handle is None:
+			self._schedule()
+		return timer
+	
+	def stats(self) -> Dict[str, int]:
+		return { 'timers': self._count, 'fired': self.fired }
+	
+	def _insert(self, timer: Timer) -> None:
+		delta = timer.expires - self._tick
+		for level in range(WHEEL_LEVELS):
+			if delta < WHEEL_SIZE ** (level + 1):
+				break
+		else:
+			# Beyond the last level; parked in its furthest slot and re-filed when that comes around
+			level = WHEEL_LEVELS - 1
+			delta = WHEEL_SIZE ** WHEEL_LEVELS - 1
+		index = ((self._tick + delta) >> (WHEEL_BITS * level)) & WHEEL_MASK
+		bucket = self._levels[level][index]
+		bucket.add(timer)
+		timer._bucket = bucket
+	
+	def _current_tick(self) -> int:
+		return int((self._loop.time() - self._start) / self.resolution)
+	
+	def _schedule(self) -> None:
+		self._handle = self._loop.call_at(self._start + (self._tick + 1) * self.resolution, self._on_tick)
+	
+	def _on_tick(self) -> None:
+		self._handle = None
+		target = self._current_tick()
+		while self._tick < target and self._count > 0:
+			self._tick += 1
+			self._cascade()
+			self._fire(self._levels[0][self._tick & WHEEL_MASK])
+		if self._count > 0:
+			self._schedule()
+	
+	def _cascade(self) -> None:
+		tick = self._tick
+		for level in range(1, WHEEL_LEVELS):
+			if (tick >> (WHEEL_BITS * (level - 1))) & WHEEL_MASK: break
+			bucket = self._levels[level][(tick >> (WHEEL_BITS * level)) & WHEEL_MASK]
+			if not bucket: continue
+			timers = list(bucket)
+			bucket.clear()
+			for timer in timers:
+				self._insert(timer)
+	
+	def _fire(self, bucket: Set[Timer]) -> None:
+		# One at a time, so a callback can still cancel a timer due on the same tick
+		while bucket:
+			timer = bucket.pop()
+			timer._bucket = None
+			self._count -= 1
+			self.fired += 1
+			try:
+				timer.callback(*timer.args)
+			except:
+				traceback.print_exc()
+
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+WHEEL_LEVELS = 3